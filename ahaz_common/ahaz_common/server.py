@@ -35,3 +35,10 @@ class RegisterTeamRequest(BaseModel):
             f"RegisterTeamRequest(team_id={self.team_id}, domain_name={self.domain_name}, "
             f"port={self.port}, protocol={self.protocol})"
         )
+
+
+class BulkRegisterTeamRequest(BaseModel):
+    teams: list[RegisterTeamRequest]
+
+    def __str__(self):
+        return f"BulkRegisterTeamRequest(teams={len(self.teams)})"
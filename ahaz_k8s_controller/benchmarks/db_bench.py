@@ -0,0 +1,166 @@
+"""
+Time the hot dboperator lookups on the original unindexed schema (migration 1)
+and on the current schema, with the same seeded data.
+
+Usage: python benchmarks/db_bench.py [--teams N] [--users N] [--lookups N] [--database NAME]
+
+Connects using the controller's DB_IP, DB_USERNAME and DB_PASSWORD. The benchmark
+database is dropped and created again for each schema, so it must not be the
+controller's database and the user needs privileges to create it.
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+from os import path
+from typing import Callable
+
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), "..", "k8s_controller"))
+
+import dboperator  # noqa: E402
+import migrate  # noqa: E402
+import mysql.connector  # noqa: E402
+
+# Roughly the size of a client config with an embedded key, certificates and tls-auth key
+CONFIG_SIZE = 4000
+CHALLENGES = 50
+PODS_PER_CHALLENGE = 4
+REGISTRATION_STATES = 7
+BATCH_SIZE = 500
+
+
+def recreate_database(database: str) -> None:
+    conn = mysql.connector.connect(
+        host=dboperator.DB_IP, user=dboperator.DB_USERNAME, password=dboperator.DB_PASSWORD
+    )
+    with conn, conn.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS `{database}`")
+        cursor.execute(f"CREATE DATABASE `{database}`")
+    # Make dboperator open a new pool for the fresh database
+    dboperator.DB_DBNAME = database
+    dboperator.pool = None
+
+
+def insert_batched(cursor, statement: str, rows: list[tuple]) -> None:
+    for i in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(statement, rows[i : i + BATCH_SIZE])
+
+
+def seed(teams: int, users: int) -> None:
+    config = "x" * CONFIG_SIZE
+    with dboperator.get_connection() as conn, conn.cursor() as cursor:
+        insert_batched(cursor, "INSERT INTO teams (name) VALUES (%s)", [(f"team{t}",) for t in range(teams)])
+        cursor.execute("SELECT teamID, name FROM teams")
+        team_ids = {name: team_id for team_id, name in cursor.fetchall()}
+        insert_batched(
+            cursor,
+            "INSERT INTO vpn_map (teamID, port) VALUES (%s, %s)",
+            [(team_ids[f"team{t}"], 20000 + t) for t in range(teams)],
+        )
+        insert_batched(
+            cursor,
+            "INSERT INTO vpn_storage (teamID, username, config) VALUES (%s, %s, %s)",
+            [(team_ids[f"team{u % teams}"], f"user{u}", config) for u in range(users)],
+        )
+        insert_batched(
+            cursor,
+            "INSERT INTO register_status (name, user, state, timestamp) VALUES (%s, %s, %s, %s)",
+            [
+                (f"team{u % teams}", f"user{u}", state, 0)
+                for u in range(users)
+                for state in range(REGISTRATION_STATES)
+            ],
+        )
+        cursor.execute("SHOW TABLES LIKE 'registration_state'")
+        if cursor.fetchall():
+            insert_batched(
+                cursor,
+                "INSERT INTO registration_state (name, user, state, updated_at) VALUES (%s, %s, %s, %s)",
+                [(f"team{t}", "", REGISTRATION_STATES - 1, 0) for t in range(teams)]
+                + [(f"team{u % teams}", f"user{u}", REGISTRATION_STATES - 1, 0) for u in range(users)],
+            )
+        insert_batched(
+            cursor,
+            "INSERT INTO challenges (name, ctfd_desc, ctfd_score, ctfd_type) VALUES (%s, %s, %s, %s)",
+            [(f"challenge{c}", "", 100, "dynamic") for c in range(CHALLENGES)],
+        )
+        insert_batched(
+            cursor,
+            "INSERT INTO pods (name, k8s_name, image, ram, cpu, visible_to_user) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            [
+                (f"challenge{c}", f"c{c}-pod{p}", "image:latest", "256Mi", 1, True)
+                for c in range(CHALLENGES)
+                for p in range(PODS_PER_CHALLENGE)
+            ],
+        )
+        conn.commit()
+
+
+def lookups(teams: int, users: int) -> dict[str, Callable[[], object]]:
+    def team() -> str:
+        return f"team{random.randrange(teams)}"
+
+    def user() -> tuple[str, str]:
+        u = random.randrange(users)
+        return f"team{u % teams}", f"user{u}"
+
+    def k8s_name() -> str:
+        return f"c{random.randrange(CHALLENGES)}-pod{random.randrange(PODS_PER_CHALLENGE)}"
+
+    return {
+        "get_team_id": lambda: dboperator.get_team_id(team()),
+        "get_team_port": lambda: dboperator.get_team_port(team()),
+        "get_port_team": lambda: dboperator.get_port_team(20000 + random.randrange(teams)),
+        "get_user_vpn_config": lambda: dboperator.get_user_vpn_config(*user()),
+        "get_registration_progress_team": lambda: dboperator.get_registration_progress_team(team()),
+        "get_registration_progress_user": lambda: dboperator.get_registration_progress_user(*user()),
+        "get_challenge_from_k8s_name": lambda: dboperator.get_challenge_from_k8s_name(k8s_name()),
+    }
+
+
+def run(name: str, target: int | None, args: argparse.Namespace) -> dict[str, tuple[float, float]]:
+    recreate_database(args.database)
+    migrate.upgrade(target)
+    seed(args.teams, args.users)
+
+    results = {}
+    for lookup, call in lookups(args.teams, args.users).items():
+        try:
+            call()
+        except mysql.connector.errors.ProgrammingError as e:
+            # The lookup reads a table this schema version does not have yet
+            print(f"{name:8s} {lookup:32s} n/a: {e.msg}")
+            continue
+        timings = []
+        for _ in range(args.lookups):
+            start = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - start) * 1000)
+        p99 = statistics.quantiles(timings, n=100)[98]
+        results[lookup] = (statistics.mean(timings), p99)
+        print(f"{name:8s} {lookup:32s} mean {results[lookup][0]:8.3f}ms  p99 {p99:8.3f}ms")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--teams", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--database", default="ahaz_bench")
+    args = parser.parse_args()
+
+    before = run("before", 1, args)
+    after = run("after", None, args)
+    for lookup, (mean, _) in before.items():
+        if lookup in after:
+            print(f"speedup  {lookup:32s} {mean / after[lookup][0]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Check that the dboperator and adboperator operations stay within their budget
+of connection checkouts and statements. Exits with status 1 if any operation
+exceeds it.
+
+Usage: python benchmarks/db_query_budget.py [--database NAME]
+
+Uses a scratch database in the same way as db_bench.py.
+"""
+
+import argparse
+import asyncio
+import sys
+from os import path
+from typing import Callable
+
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), "..", "k8s_controller"))
+
+import adboperator  # noqa: E402
+import db_bench  # noqa: E402
+import dboperator  # noqa: E402
+import migrate  # noqa: E402
+
+TEAM = "budget-team"
+USER = "budget-user"
+PORT = 29999
+# A client config in the layout certmanager renders, which is stored as team and user material
+CONFIG = "\n".join(
+    ["client", "\n<key>", "KEY", "</key>", "<cert>", "CERT", "</cert>", "<ca>", "CA", "</ca>"]
+    + ["key-direction 1", "<tls-auth>", "TA", "</tls-auth>"]
+)
+
+
+def poll_registration() -> None:
+    # What /autogenerate does on every poll
+    with dboperator.connection_scope():
+        dboperator.get_registration_progress_user(TEAM, USER)
+        dboperator.get_registration_progress_team(TEAM)
+
+
+async def poll_registration_async() -> None:
+    # The same from the asyncio layer the handler uses
+    async with adboperator.connection_scope():
+        await adboperator.get_registration_progress_user(TEAM, USER)
+        await adboperator.get_registration_progress_team(TEAM)
+
+
+# (operation, connection checkouts, statements, call), run in this order
+BUDGETS: list[tuple[str, int, int, Callable[[], object]]] = [
+    ("insert_team_into_db", 1, 1, lambda: dboperator.insert_team_into_db(TEAM)),
+    ("insert_vpn_port_into_db", 1, 1, lambda: dboperator.insert_vpn_port_into_db(TEAM, PORT)),
+    ("claim_team_registration", 1, 1, lambda: dboperator.claim_team_registration(TEAM)),
+    ("insert_user_vpn_config", 1, 4, lambda: dboperator.insert_user_vpn_config(TEAM, USER, CONFIG)),
+    (
+        "set_registration_progress_team",
+        1,
+        1,
+        lambda: dboperator.set_registration_progress_team(TEAM, USER, 6),
+    ),
+    ("get_team_id", 1, 1, lambda: dboperator.get_team_id(TEAM)),
+    ("get_team_port", 1, 1, lambda: dboperator.get_team_port(TEAM)),
+    ("get_port_team", 1, 1, lambda: dboperator.get_port_team(PORT)),
+    ("get_user_vpn_config", 1, 2, lambda: dboperator.get_user_vpn_config(TEAM, USER)),
+    ("get_user_vpn_config (cached)", 1, 1, lambda: dboperator.get_user_vpn_config(TEAM, USER)),
+    ("poll_registration (scoped)", 1, 2, poll_registration),
+    ("poll_registration (async)", 1, 2, lambda: asyncio.run(poll_registration_async())),
+    ("delete_user_vpn_config", 1, 4, lambda: dboperator.delete_user_vpn_config(TEAM, USER)),
+    ("delete_team_and_vpn", 1, 4, lambda: dboperator.delete_team_and_vpn(TEAM)),
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--database", default="ahaz_bench")
+    args = parser.parse_args()
+
+    db_bench.recreate_database(args.database)
+    migrate.upgrade()
+
+    failed = False
+    for operation, checkouts, statements, call in BUDGETS:
+        try:
+            with dboperator.assert_queries(checkouts, statements) as count:
+                call()
+            result = "ok"
+        except AssertionError as e:
+            failed = True
+            result = f"FAILED: {e}"
+        print(f"{operation:32s} {count.checkouts} checkouts, {count.statements} statements  {result}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
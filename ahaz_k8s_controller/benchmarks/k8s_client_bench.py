@@ -0,0 +1,131 @@
+"""
+Compare Kubernetes create calls per second with a new CoreV1Api per call, as
+the controller used to make them, against the shared pooled client of kube.py.
+
+Usage: python benchmarks/k8s_client_bench.py [--calls N] [--threads N] [--plain-http]
+
+The calls go to a local stand-in API server which answers every create with
+201 and the object it was sent, over TLS with a throwaway certificate unless
+--plain-http is given. No cluster is needed.
+"""
+
+import argparse
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+
+from kubernetes.client import ApiClient, Configuration, CoreV1Api, V1ConfigMap, V1ObjectMeta
+
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), "..", "k8s_controller"))
+
+import kube  # noqa: E402
+import pki  # noqa: E402
+
+
+class StandInApiServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    connections_lock = threading.Lock()
+
+    def setup(self) -> None:
+        super().setup()
+        # As the Go API server does, otherwise delayed ACKs stall every reused connection
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with StandInApiServer.connections_lock:
+            StandInApiServer.connections += 1
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def write_certificates(directory: str) -> tuple[str, str, str]:
+    """A CA and a localhost server certificate signed by it, returns the CA, certificate and key files"""
+    ca_key, ca_cert = pki.build_ca("k8s-client-bench")
+    key, cert = pki.build_cert(ca_key, ca_cert, "localhost", server=True)
+    contents = {
+        "ca.crt": pki.cert_to_pem(ca_cert),
+        "server.crt": pki.cert_to_pem(cert),
+        "server.key": pki.key_to_pem(key),
+    }
+    for filename, content in contents.items():
+        with open(path.join(directory, filename), "wb") as f:
+            f.write(content)
+    return (
+        path.join(directory, "ca.crt"),
+        path.join(directory, "server.crt"),
+        path.join(directory, "server.key"),
+    )
+
+
+def start_server(certdir: str | None) -> tuple[ThreadingHTTPServer, Configuration]:
+    server = ThreadingHTTPServer(("localhost", 0), StandInApiServer)
+    server.daemon_threads = True
+    configuration = Configuration()
+    scheme = "http"
+    if certdir is not None:
+        ca_file, cert_file, key_file = write_certificates(certdir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        configuration.ssl_ca_cert = ca_file
+        scheme = "https"
+    configuration.host = f"{scheme}://localhost:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, configuration
+
+
+def create_config_map(api: CoreV1Api, i: int) -> None:
+    body = V1ConfigMap(metadata=V1ObjectMeta(name=f"bench-{i}"), data={"key": "value"})
+    api.create_namespaced_config_map(namespace="bench", body=body)
+
+
+def run(name: str, new_api, calls: int, threads: int) -> float:
+    StandInApiServer.connections = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda i: create_config_map(new_api(), i), range(calls)))
+    elapsed = time.perf_counter() - start
+    rate = calls / elapsed
+    print(
+        f"{name:8s} {calls} creates in {elapsed:.2f}s ({rate:.0f} creates/s), "
+        + f"{StandInApiServer.connections} connections opened"
+    )
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--plain-http", action="store_true", help="serve plain HTTP instead of TLS")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as certdir:
+        server, configuration = start_server(None if args.plain_http else certdir)
+        try:
+            fresh = run("fresh", lambda: CoreV1Api(ApiClient(configuration)), args.calls, args.threads)
+            shared_client = kube.new_api_client(configuration, pool_size=max(args.threads, 1))
+            shared = run("shared", lambda: CoreV1Api(shared_client), args.calls, args.threads)
+        finally:
+            server.shutdown()
+    print(f"speedup  {shared / fresh:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Poll a running controller the way the CTFd plugin does and report the latency
+percentiles of each endpoint, to see how the request handlers hold up under
+many concurrent pollers.
+
+Usage: python benchmarks/load_test.py [--url URL] [--pollers N] [--duration SECONDS] [--teams N]
+
+Seeds --teams already registered teams with one user each straight into the
+controller's database (DB_IP, DB_DBNAME, DB_USERNAME, DB_PASSWORD), so the
+polls never start a registration, and deletes them again afterwards. Every
+poller loops over /autogenerate and /get_user for one of those users, while a
+single prober calls /ping, which does no database work and so shows how long
+requests wait for the event loop.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import requests
+
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), "..", "k8s_controller"))
+
+import dboperator  # noqa: E402
+
+TEAM_PREFIX = "loadtest-team"
+REGISTERED = 10
+PORT_BASE = 40000
+
+
+def seed(teams: int) -> list[tuple[str, str]]:
+    users = []
+    for t in range(teams):
+        team, user = f"{TEAM_PREFIX}{t}", f"user{t}"
+        with dboperator.connection_scope():
+            dboperator.delete_team_and_vpn(team)
+            dboperator.insert_team_into_db(team)
+            dboperator.insert_vpn_port_into_db(team, PORT_BASE + t)
+            dboperator.insert_user_vpn_config(team, user, "client\n<key>\n</key>")
+            dboperator.set_registration_progress_team(team, user, REGISTERED)
+        users.append((team, user))
+    return users
+
+
+def cleanup(users: list[tuple[str, str]]) -> None:
+    with dboperator.connection_scope():
+        for team, _ in users:
+            dboperator.delete_team_and_vpn(team)
+
+
+def poll(url: str, team: str, user: str, deadline: float, timings: dict[str, list[float]]) -> int:
+    errors = 0
+    body = json.dumps({"team_id": team, "user_id": user})
+    headers = {"Content-Type": "application/json"}
+    with requests.Session() as session:
+        while time.monotonic() < deadline:
+            for endpoint, method in (("/autogenerate", "POST"), ("/get_user", "GET")):
+                start = time.perf_counter()
+                response = session.request(method, url + endpoint, data=body, headers=headers)
+                timings[endpoint].append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    errors += 1
+    return errors
+
+
+def probe(url: str, deadline: float, timings: dict[str, list[float]]) -> int:
+    errors = 0
+    with requests.Session() as session:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            response = session.get(url + "/ping")
+            timings["/ping"].append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                errors += 1
+            time.sleep(0.01)
+    return errors
+
+
+def report(timings: dict[str, list[float]], duration: float) -> None:
+    for endpoint, samples in sorted(timings.items()):
+        if len(samples) < 2:
+            print(f"{endpoint:14s} not enough samples")
+            continue
+        percentiles = statistics.quantiles(samples, n=100)
+        print(
+            f"{endpoint:14s} {len(samples) / duration:8.1f} req/s  p50 {percentiles[49]:8.2f}ms  "
+            f"p95 {percentiles[94]:8.2f}ms  p99 {percentiles[98]:8.2f}ms  max {max(samples):8.2f}ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--pollers", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--teams", type=int, default=50)
+    args = parser.parse_args()
+
+    users = seed(args.teams)
+    timings: dict[str, list[float]] = defaultdict(list)
+    try:
+        deadline = time.monotonic() + args.duration
+        with ThreadPoolExecutor(max_workers=args.pollers + 1) as executor:
+            futures = [executor.submit(probe, args.url, deadline, timings)]
+            for i in range(args.pollers):
+                team, user = users[i % len(users)]
+                futures.append(executor.submit(poll, args.url, team, user, deadline, timings))
+            errors = sum(future.result() for future in futures)
+    finally:
+        cleanup(users)
+
+    report(timings, args.duration)
+    print(f"{args.pollers} pollers, {errors} non-200 responses")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compare team PKI generation throughput of the native backend against easyrsa.
+
+Usage: python benchmarks/pki_bench.py [--teams N] [--backend native|easyrsa|both]
+
+The easyrsa backend needs the easyrsa and openvpn binaries to be available,
+exactly as in the controller image.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), "..", "k8s_controller"))
+
+import certmanager  # noqa: E402
+import pki  # noqa: E402
+
+
+def gen_native(teamdir: str, cn: str) -> None:
+    pki.init_pki(teamdir, cn)
+
+
+def gen_easyrsa(teamdir: str, cn: str) -> None:
+    certmanager.init_pki(certmanager.get_easyrsa(), teamdir, cn)
+    certmanager.gen_ta_key(teamdir)
+
+
+def run(name: str, gen, teams: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        for i in range(teams):
+            teamdir = path.join(tmp, str(i))
+            certmanager.makedirs(teamdir)
+            gen(teamdir, certmanager.PUBLIC_DOMAINNAME)
+        elapsed = time.perf_counter() - start
+    rate = teams / elapsed
+    print(f"{name:8s} {teams} teams in {elapsed:.2f}s ({rate:.2f} teams/s)")
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--teams", type=int, default=50)
+    parser.add_argument("--backend", choices=("native", "easyrsa", "both"), default="both")
+    args = parser.parse_args()
+
+    rates = {}
+    if args.backend in ("native", "both"):
+        rates["native"] = run("native", gen_native, args.teams)
+    if args.backend in ("easyrsa", "both"):
+        try:
+            rates["easyrsa"] = run("easyrsa", gen_easyrsa, args.teams)
+        except (OSError, RuntimeError) as e:
+            print(f"easyrsa  skipped: {e}")
+
+    if len(rates) == 2:
+        print(f"speedup  {rates['native'] / rates['easyrsa']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+import asyncio
+import functools
+import logging
+import time
+import weakref
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from os import getenv
+from typing import Any, AsyncIterator, Coroutine, TypeVar
+
+import dboperator
+import queries
+import vpnconfig
+from mysql.connector import errors
+from mysql.connector.aio import MySQLConnectionAbstract, connect
+
+# asyncio counterpart of dboperator for the request handlers, the lookups they need as coroutines. The SQL
+# lives in queries.py and is shared with dboperator, add a coroutine here once a handler needs one.
+# Connections come from a separate pool per event loop and host, so awaiting a query never blocks the
+# loop and the background threads running dboperator keep their own connections. Replica routing
+# (DB_READ_HOSTS) works as in dboperator.
+# Query counting (dboperator.count_queries) covers both layers.
+
+DB_ASYNC_POOL_SIZE = int(getenv("DB_ASYNC_POOL_SIZE", "10"))
+# Idle connections older than this are pinged before they are handed out again
+DB_ASYNC_IDLE_PING = float(getenv("DB_ASYNC_IDLE_PING", "30"))
+
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+
+class _Pool:
+    """Opens up to `size` connections to `host` on demand, waiting for a free one once they are all in use"""
+
+    def __init__(self, size: int, host: str):
+        self.slots = asyncio.Semaphore(size)
+        self.idle: list[tuple[MySQLConnectionAbstract, float]] = []
+        self.host = host
+
+    async def _open(self) -> MySQLConnectionAbstract:
+        return await connect(
+            host=self.host,
+            database=dboperator.DB_DBNAME,
+            user=dboperator.DB_USERNAME,
+            password=dboperator.DB_PASSWORD,
+            autocommit=True,
+        )
+
+    async def acquire(self) -> MySQLConnectionAbstract:
+        await self.slots.acquire()
+        try:
+            while self.idle:
+                conn, released_at = self.idle.pop()
+                if time.monotonic() - released_at < DB_ASYNC_IDLE_PING or await conn.is_connected():
+                    return conn
+                await _close_quietly(conn)
+            return await self._open()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def release(self, conn: MySQLConnectionAbstract, broken: bool = False) -> None:
+        try:
+            if broken:
+                await _close_quietly(conn)
+            else:
+                self.idle.append((conn, time.monotonic()))
+        finally:
+            self.slots.release()
+
+
+async def _close_quietly(conn: MySQLConnectionAbstract) -> None:
+    try:
+        await conn.close()
+    except errors.Error:
+        pass
+
+
+# An asyncio.Semaphore belongs to the loop it is first used on, asyncio.run() in a thread gets its own pools
+_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, _Pool]]" = weakref.WeakKeyDictionary()
+
+
+def _get_pool(host: str | None = None) -> _Pool:
+    """The pool of `host` for the running loop, the primary by default"""
+    host = host or dboperator.DB_IP
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    if host not in pools:
+        logger.debug(f"Initializing async connection pool for {host}")
+        pools[host] = _Pool(DB_ASYNC_POOL_SIZE, host)
+    return pools[host]
+
+
+async def _close_pool(pool: _Pool) -> None:
+    while pool.idle:
+        conn, _ = pool.idle.pop()
+        await _close_quietly(conn)
+
+
+async def close_pools() -> None:
+    """Close the idle connections of the running loop and forget the pools of the loops that were closed
+
+    Connections of a closed loop can no longer be closed cleanly, which is why threads run their loops
+    through run()."""
+    running = asyncio.get_running_loop()
+    for loop, pools in list(_pools.items()):
+        if loop is running:
+            for pool in pools.values():
+                await _close_pool(pool)
+        elif loop.is_closed():
+            logger.warning(f"Dropping {len(pools)} async connection pools of a closed event loop")
+        else:
+            continue
+        del _pools[loop]
+
+
+def run(coro: Coroutine[Any, Any, T]) -> T:
+    """asyncio.run() closing the pools of its loop before the loop is closed, for event loops of threads"""
+
+    async def main() -> T:
+        try:
+            return await coro
+        finally:
+            await close_pools()
+
+    return asyncio.run(main())
+
+
+class _Lease:
+    def __init__(self, pool: _Pool, conn: MySQLConnectionAbstract):
+        self.pool = pool
+        self.conn = conn
+        self.broken = False
+
+
+async def _acquire(read: bool) -> _Lease:
+    """A connection to the next available replica if `read`, otherwise or if none is available the primary"""
+    host = dboperator.next_read_host() if read else None
+    if host is not None:
+        pool = _get_pool(host)
+        try:
+            conn = await pool.acquire()
+        except errors.Error as e:
+            dboperator.mark_read_host_down(host, e)
+        else:
+            dboperator.count_checkout()
+            return _Lease(pool, conn)
+    pool = _get_pool()
+    dboperator.count_checkout()
+    return _Lease(pool, await pool.acquire())
+
+
+class _Scope:
+    def __init__(self, replica_reads: bool = False):
+        self.lease: _Lease | None = None
+        self.read_lease: _Lease | None = None
+        # Reads go to a replica until the first write of the scope, from then on they see its writes
+        self.replica_reads = replica_reads
+        self.wrote = False
+
+    def reads_from_replica(self) -> bool:
+        return self.replica_reads and not self.wrote and bool(dboperator.DB_READ_HOSTS)
+
+
+# Set while connection_scope() is active
+_scope: ContextVar[_Scope | None] = ContextVar("adboperator_scope", default=None)
+
+
+@asynccontextmanager
+async def _using(lease: _Lease) -> AsyncIterator[MySQLConnectionAbstract]:
+    try:
+        yield lease.conn
+    except (errors.InterfaceError, errors.OperationalError):
+        lease.broken = True
+        raise
+
+
+@asynccontextmanager
+async def connection_scope(replica_reads: bool = False) -> AsyncIterator[None]:
+    """Share one pooled connection between all queries in the block, checked out on the first query
+
+    With `replica_reads`, lookups go to a replica from DB_READ_HOSTS until the block first writes"""
+    if _scope.get() is not None:
+        yield
+        return
+    scope = _Scope(replica_reads)
+    token = _scope.set(scope)
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+        for lease in (scope.read_lease, scope.lease):
+            if lease is not None:
+                await lease.pool.release(lease.conn, lease.broken)
+
+
+def _scoped(func, replica_reads: bool):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with connection_scope(replica_reads):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def scoped(func):
+    """Decorator running a coroutine function inside connection_scope()"""
+    return _scoped(func, replica_reads=False)
+
+
+def replica_scoped(func):
+    """Decorator running a coroutine function inside connection_scope(replica_reads=True)"""
+    return _scoped(func, replica_reads=True)
+
+
+@asynccontextmanager
+async def connection(read: bool = False) -> AsyncIterator[MySQLConnectionAbstract]:
+    """The connection of the current scope, or one from the pool for the duration of the block
+
+    Only `read` connections of a scope with replica reads go to a replica, any other connection
+    counts as a write of the scope."""
+    scope = _scope.get()
+    if scope is None:
+        lease = await _acquire(read=False)
+        try:
+            async with _using(lease) as conn:
+                yield conn
+        finally:
+            await lease.pool.release(lease.conn, lease.broken)
+        return
+    if read and scope.reads_from_replica():
+        if scope.read_lease is None:
+            scope.read_lease = await _acquire(read=True)
+        async with _using(scope.read_lease) as conn:
+            yield conn
+        return
+    scope.wrote = scope.wrote or not read
+    if scope.lease is None:
+        scope.lease = await _acquire(read=False)
+    async with _using(scope.lease) as conn:
+        yield conn
+
+
+async def execute(cursor, statement: str, params: tuple = ()) -> None:
+    dboperator.count_statement()
+    await cursor.execute(statement, params)
+
+
+async def fetchall(statement: str, params: tuple = ()) -> list[tuple]:
+    async with connection(read=True) as conn, await conn.cursor() as cursor:
+        await execute(cursor, statement, params)
+        return list(await cursor.fetchall())
+
+
+async def write(statement: str, params: tuple = ()) -> int:
+    """Run a single statement, returns the number of affected rows"""
+    async with connection() as conn, await conn.cursor() as cursor:
+        await execute(cursor, statement, params)
+        return cursor.rowcount
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[Any]:
+    """Cursor whose statements are committed together when the block exits, or rolled back on error"""
+    async with connection() as conn, await conn.cursor() as cursor:
+        dboperator.count_statement()
+        await conn.start_transaction()
+        try:
+            yield cursor
+        except BaseException:
+            await conn.rollback()
+            raise
+        dboperator.count_statement()
+        await conn.commit()
+
+
+def _first_or(rows: list[tuple], default: Any) -> Any:
+    if len(rows) == 0 or len(rows[0]) == 0:
+        return default
+    return rows[0][0]
+
+
+async def get_challenges_from_db() -> list[str]:
+    return [str(row[0]) for row in await fetchall(queries.CHALLENGES)]
+
+
+async def get_user_vpn_config(teamname: str, username: str) -> str:
+    """The rendered client config, only the material versions are read if it is in the render cache"""
+    async with connection(read=True) as conn, await conn.cursor() as cursor:
+        await execute(cursor, queries.USER_VPN_CONFIG_VERSION, (teamname, username))
+        rows = await cursor.fetchall()
+        if len(rows) == 0:
+            return "null"
+        team_id, storage_id, user_version, team_version = rows[0]
+        key = (team_id, storage_id, user_version, team_version)
+        config = vpnconfig.cached(key)
+        if config is not None:
+            return config
+        await execute(cursor, queries.USER_VPN_CONFIG, (team_id, username))
+        rows = await cursor.fetchall()
+
+    if len(rows) == 0:
+        return "null"
+    config = vpnconfig.from_row(rows[0])
+    vpnconfig.remember(key, config)
+    return config
+
+
+async def get_registration_progress_team(teamname: str) -> int:
+    return int(_first_or(await fetchall(queries.REGISTRATION_PROGRESS_TEAM, (teamname,)), -999))
+
+
+async def get_registration_progress_user(teamname: str, username: str) -> str:
+    return _first_or(await fetchall(queries.REGISTRATION_PROGRESS_USER, (teamname, username)), "null")
+
+
+async def compare_and_set_registration_progress(
+    teamname: str, username: str, expected: int | None, status: int
+) -> bool:
+    """Atomically set the progress to `status` if it is `expected` (None: not started), returns if it did"""
+    timestamp = dboperator.getUTCasStr()
+    if expected is None:
+        statement, params = queries.INSERT_REGISTRATION_PROGRESS, (teamname, username, status, timestamp)
+    else:
+        statement = queries.COMPARE_AND_SET_REGISTRATION_PROGRESS
+        params = (status, timestamp, teamname, username, expected)
+
+    if not dboperator.DB_REGISTRATION_HISTORY:
+        return await write(statement, params) == 1
+    async with transaction() as cursor:
+        await execute(cursor, statement, params)
+        updated = cursor.rowcount == 1
+        if updated:
+            await execute(cursor, queries.LOG_REGISTRATION_PROGRESS, (teamname, username, status, timestamp))
+    return updated
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from os import getenv
+
+import certmanager
+import controller
+import dboperator
+import ports
+import yaml
+from events import RedisEventManager
+
+from ahaz_common import RegisterTeamRequest
+
+# Bulk team provisioning: certificates are generated in a process pool, the
+# Kubernetes and database work runs in threads under a concurrency limit.
+
+logger = logging.getLogger()
+
+CERT_DIR_CONTAINER = getenv("CERT_DIR_CONTAINER", "/etc/ahaz/certs/")
+BULK_CERT_WORKERS = int(getenv("BULK_CERT_WORKERS", str(os.cpu_count() or 1)))
+BULK_K8S_CONCURRENCY = int(getenv("BULK_K8S_CONCURRENCY", "8"))
+
+
+@dboperator.scoped
+def reserve_team_port(team: RegisterTeamRequest) -> int:
+    """Insert the team and reserve its VPN port, the one of the roster if it is in the port ranges and free"""
+    try:
+        dboperator.insert_team_into_db(team.team_id)
+    except ValueError:
+        pass  # left over from an earlier run
+    return ports.reserve(team.team_id, preferred=team.port)
+
+
+def provision_team_resources(team: RegisterTeamRequest, port: int, bundle: dict[str, str]) -> None:
+    controller.create_team_namespace(team.team_id)
+    controller.create_team_vpn_container(team.team_id, bundle)
+    controller.expose_team_vpn_container(team.team_id, port)
+    # Mark the team as registered so /autogenerate only has to register users
+    dboperator.set_registration_progress_team(team.team_id, "", 6)
+
+
+class BulkProvisioner:
+    def __init__(
+        self, teams: list[RegisterTeamRequest], certdir: str, event_manager: RedisEventManager | None
+    ):
+        self.teams = teams
+        self.certdir = certdir
+        self.event_manager = event_manager
+        self.completed = 0
+        self.failed: list[str] = []
+
+    async def report(self, team: RegisterTeamRequest, stage: str, error: str | None = None) -> None:
+        if stage in ("done", "failed"):
+            self.completed += 1
+        if error is None:
+            logger.info(f"[{self.completed}/{len(self.teams)}] team {team.team_id}: {stage}")
+        else:
+            logger.error(f"[{self.completed}/{len(self.teams)}] team {team.team_id}: {stage}: {error}")
+
+        if self.event_manager is not None:
+            await self.event_manager.publish_event(
+                "ahaz_events",
+                json.dumps(
+                    {
+                        "type": "bulk_progress",
+                        "data": {
+                            "team_id": team.team_id,
+                            "stage": stage,
+                            "error": error,
+                            "completed": self.completed,
+                            "total": len(self.teams),
+                        },
+                    }
+                ),
+            )
+
+    async def provision_team(
+        self, team: RegisterTeamRequest, executor: Executor, semaphore: asyncio.Semaphore
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            port = await asyncio.to_thread(reserve_team_port, team)
+            # The pool's processes are shut down with the run, so the client stock is filled in the call
+            bundle = await loop.run_in_executor(
+                executor,
+                certmanager.gen_team,
+                team.team_id,
+                team.domain_name,
+                port,
+                team.protocol,
+                self.certdir,
+                False,
+            )
+            await self.report(team, "certificates")
+            async with semaphore:
+                await asyncio.to_thread(provision_team_resources, team, port, bundle)
+            await self.report(team, "done")
+        except Exception as e:
+            self.failed.append(team.team_id)
+            await self.report(team, "failed", str(e))
+
+    async def run(self) -> dict:
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(BULK_K8S_CONCURRENCY)
+        # spawn, as forking a process with running threads is not safe
+        with ProcessPoolExecutor(
+            BULK_CERT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            await asyncio.gather(*(self.provision_team(team, executor, semaphore) for team in self.teams))
+        elapsed = time.perf_counter() - start
+
+        summary = {
+            "teams": len(self.teams),
+            "succeeded": len(self.teams) - len(self.failed),
+            "failed": self.failed,
+            "elapsed_seconds": round(elapsed, 2),
+            "teams_per_second": round(len(self.teams) / elapsed, 2) if elapsed > 0 else 0,
+        }
+        logger.info(f"Bulk provisioning finished: {summary}")
+        if self.event_manager is not None:
+            await self.event_manager.publish_event(
+                "ahaz_events", json.dumps({"type": "bulk_summary", "data": summary})
+            )
+        return summary
+
+
+async def provision(
+    teams: list[RegisterTeamRequest], certdir: str, event_manager: RedisEventManager | None = None
+) -> dict:
+    try:
+        return await BulkProvisioner(teams, certdir, event_manager).run()
+    finally:
+        if event_manager is not None:
+            await event_manager.close()
+
+
+def read_roster(filename: str, domain_name: str, protocol: str) -> list[RegisterTeamRequest]:
+    """Read a YAML/JSON list of teams, each with a team_id, port and optionally domain_name and protocol"""
+    with open(filename, "r") as f:
+        roster = yaml.safe_load(f)
+    return [
+        RegisterTeamRequest(**{"domain_name": domain_name, "protocol": protocol, **team}) for team in roster
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Provision all teams in a roster file")
+    parser.add_argument("roster", help="YAML or JSON list of teams (team_id, port, protocol, domain_name)")
+    parser.add_argument("--protocol", default="tcp", help="default protocol for teams that do not set one")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getenv("LOGLEVEL", "INFO").upper())
+    teams = read_roster(args.roster, certmanager.PUBLIC_DOMAINNAME, args.protocol)
+    print(json.dumps(asyncio.run(provision(teams, CERT_DIR_CONTAINER)), indent=2))
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from os import getenv
+from threading import Lock
+from types import MappingProxyType
+from typing import Mapping
+
+import adboperator
+import dboperator
+import queries
+
+# In-memory challenge catalog.
+#
+# Challenge definitions (challenges, pods, net_rules and env_vars) are loaded
+# once into immutable ChallengeSpec/PodSpec objects, so starting a challenge
+# needs no queries. Whoever changes those tables bumps catalog_version, which
+# every worker polls at most once per CATALOG_CHECK_INTERVAL and reloads on a
+# change. CATALOG_MAX_AGE reloads regardless, in case the version was not
+# bumped after editing the tables by hand.
+
+logger = logging.getLogger()
+
+CATALOG_CHECK_INTERVAL = float(getenv("CATALOG_CHECK_INTERVAL", "5"))
+CATALOG_MAX_AGE = float(getenv("CATALOG_MAX_AGE", "3600"))
+# k8s_names not in the catalog whose lookup result is remembered until the next reload
+CATALOG_MISS_CACHE_SIZE = int(getenv("CATALOG_MISS_CACHE_SIZE", "1024"))
+
+
+@dataclass(frozen=True)
+class EnvVar:
+    name: str
+    value: str
+
+
+@dataclass(frozen=True)
+class PodSpec:
+    challenge: str
+    k8s_name: str
+    image: str
+    ram: str
+    cpu: int
+    visible_to_user: bool
+    networks: tuple[str, ...]
+    env_vars: tuple[EnvVar, ...]
+
+
+@dataclass(frozen=True)
+class ChallengeSpec:
+    name: str
+    pods: tuple[PodSpec, ...]
+    # netname -> k8s_name of every pod in that network
+    networks: Mapping[str, tuple[str, ...]]
+
+
+@dataclass(frozen=True)
+class Catalog:
+    version: int
+    loaded_at: float
+    challenges: Mapping[str, ChallengeSpec]
+    # Indexed by k8s_name
+    pods: Mapping[str, PodSpec]
+
+
+_lock = Lock()
+# Serialises the version checks of the request handlers of each event loop, like _lock for threads
+_async_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = (
+    weakref.WeakKeyDictionary()
+)
+_catalog: Catalog | None = None
+_checked_at = 0.0
+# k8s_name -> challenge name, or None for pods which are not part of a challenge
+_misses: OrderedDict[str, str | None] = OrderedDict()
+_misses_version = 0
+_misses_lock = Lock()
+
+
+def load(version: int) -> Catalog:
+    with dboperator.get_cursor(read=True) as cursor:
+        cursor.execute(queries.CATALOG_CHALLENGES)
+        names = [str(row[0]) for row in cursor.fetchall()]
+        cursor.execute(queries.CATALOG_PODS)
+        pod_rows = cursor.fetchall()
+        cursor.execute(queries.CATALOG_NET_RULES)
+        net_rules = cursor.fetchall()
+        cursor.execute(queries.CATALOG_ENV_VARS)
+        env_rows = cursor.fetchall()
+    return build(version, names, pod_rows, net_rules, env_rows)
+
+
+async def load_async(version: int) -> Catalog:
+    names = [str(row[0]) for row in await adboperator.fetchall(queries.CATALOG_CHALLENGES)]
+    pod_rows = await adboperator.fetchall(queries.CATALOG_PODS)
+    net_rules = await adboperator.fetchall(queries.CATALOG_NET_RULES)
+    env_rows = await adboperator.fetchall(queries.CATALOG_ENV_VARS)
+    return build(version, names, pod_rows, net_rules, env_rows)
+
+
+def build(version: int, names: list[str], pod_rows: list, net_rules: list, env_rows: list) -> Catalog:
+    """The catalog of the rows of CATALOG_CHALLENGES, CATALOG_PODS, CATALOG_NET_RULES and CATALOG_ENV_VARS"""
+    env_vars: dict[str, list[EnvVar]] = {}
+    for k8s_name, var_name, value in env_rows:
+        env_vars.setdefault(k8s_name, []).append(EnvVar(name=str(var_name).upper(), value=value))
+    pod_networks: dict[tuple[str, str], list[str]] = {}
+    networks: dict[str, dict[str, list[str]]] = {}
+    for name, netname, k8s_name in net_rules:
+        pod_networks.setdefault((name, k8s_name), []).append(netname)
+        networks.setdefault(name, {}).setdefault(netname, []).append(k8s_name)
+
+    challenge_pods: dict[str, list[PodSpec]] = {name: [] for name in names}
+    pods: dict[str, PodSpec] = {}
+    for name, k8s_name, image, ram, cpu, visible_to_user in pod_rows:
+        pod = PodSpec(
+            challenge=name,
+            k8s_name=k8s_name,
+            image=image,
+            ram=ram,
+            cpu=cpu,
+            visible_to_user=bool(visible_to_user),
+            networks=tuple(pod_networks.get((name, k8s_name), [])),
+            env_vars=tuple(env_vars.get(k8s_name, [])),
+        )
+        challenge_pods.setdefault(name, []).append(pod)
+        pods.setdefault(k8s_name, pod)
+
+    challenges = {
+        name: ChallengeSpec(
+            name=name,
+            pods=tuple(specs),
+            networks=MappingProxyType({k: tuple(v) for k, v in networks.get(name, {}).items()}),
+        )
+        for name, specs in challenge_pods.items()
+    }
+
+    logger.info(f"Loaded challenge catalog version {version}: {len(challenges)} challenges, {len(pods)} pods")
+    return Catalog(
+        version=version,
+        loaded_at=time.monotonic(),
+        challenges=MappingProxyType(challenges),
+        pods=MappingProxyType(pods),
+    )
+
+
+def get_version() -> int:
+    with dboperator.get_cursor(read=True) as cursor:
+        cursor.execute(queries.CATALOG_VERSION)
+        rows = cursor.fetchall()
+    return int(rows[0][0]) if rows else 0
+
+
+async def get_version_async() -> int:
+    rows = await adboperator.fetchall(queries.CATALOG_VERSION)
+    return int(rows[0][0]) if rows else 0
+
+
+def bump_version() -> None:
+    """Make every worker reload the catalog, call after changing the challenge tables"""
+    with dboperator.get_cursor() as cursor:
+        cursor.execute(queries.BUMP_CATALOG_VERSION)
+
+
+def _fresh_catalog(force_check: bool) -> Catalog | None:
+    """The current catalog if its version was checked within CATALOG_CHECK_INTERVAL"""
+    if force_check or time.monotonic() - _checked_at >= CATALOG_CHECK_INTERVAL:
+        return None
+    return _catalog
+
+
+def get_catalog(force_check: bool = False) -> Catalog:
+    """The current catalog, checking the version if it was not checked within CATALOG_CHECK_INTERVAL"""
+    global _catalog, _checked_at
+    catalog = _fresh_catalog(force_check)
+    if catalog is not None:
+        return catalog
+
+    with _lock:
+        catalog = _fresh_catalog(force_check)
+        if catalog is not None:
+            return catalog  # another thread checked while we waited
+        catalog, now = _catalog, time.monotonic()
+        version = get_version()
+        _checked_at = now
+        if catalog is None or catalog.version != version or now - catalog.loaded_at > CATALOG_MAX_AGE:
+            catalog = _catalog = load(version)
+    return catalog
+
+
+async def get_catalog_async(force_check: bool = False) -> Catalog:
+    """get_catalog() for the request handlers, checking and loading through adboperator"""
+    global _catalog, _checked_at
+    catalog = _fresh_catalog(force_check)
+    if catalog is not None:
+        return catalog
+
+    async with _async_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock()):
+        catalog = _fresh_catalog(force_check)
+        if catalog is not None:
+            return catalog
+        catalog, now = _catalog, time.monotonic()
+        version = await get_version_async()
+        _checked_at = now
+        if catalog is None or catalog.version != version or now - catalog.loaded_at > CATALOG_MAX_AGE:
+            catalog = _catalog = await load_async(version)
+    return catalog
+
+
+def get_challenge(name: str) -> ChallengeSpec | None:
+    challenge = get_catalog().challenges.get(name)
+    if challenge is None:
+        # Possibly added since the last check
+        challenge = get_catalog(force_check=True).challenges.get(name)
+    return challenge
+
+
+async def get_challenge_async(name: str) -> ChallengeSpec | None:
+    challenge = (await get_catalog_async()).challenges.get(name)
+    if challenge is None:
+        challenge = (await get_catalog_async(force_check=True)).challenges.get(name)
+    return challenge
+
+
+def get_pod(k8s_name: str) -> PodSpec | None:
+    return get_catalog().pods.get(k8s_name)
+
+
+def challenge_of(k8s_name: str) -> str | None:
+    """Name of the challenge the pod `k8s_name` belongs to, None if it does not belong to one"""
+    global _misses_version
+    catalog = get_catalog()
+    pod = catalog.pods.get(k8s_name)
+    if pod is not None:
+        return pod.challenge
+
+    # Pods the catalog does not know about, such as the VPN pods or pods of a challenge added without
+    # bumping the version, are looked up once per catalog version
+    with _misses_lock:
+        if _misses_version != catalog.version:
+            _misses.clear()
+            _misses_version = catalog.version
+        if k8s_name in _misses:
+            _misses.move_to_end(k8s_name)
+            return _misses[k8s_name]
+    try:
+        challenge = dboperator.get_challenge_from_k8s_name(k8s_name)
+    except IndexError:
+        challenge = None
+    with _misses_lock:
+        _misses[k8s_name] = challenge
+        if len(_misses) > CATALOG_MISS_CACHE_SIZE:
+            _misses.popitem(last=False)
+    return challenge
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the in-memory challenge catalog")
+    parser.add_argument("command", choices=("bump", "show"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getenv("LOGLEVEL", "INFO").upper())
+    if args.command == "bump":
+        bump_version()
+    catalog = get_catalog()
+    print(f"catalog version {catalog.version}")
+    for challenge in catalog.challenges.values():
+        print(f"{challenge.name}: {', '.join(pod.k8s_name for pod in challenge.pods)}")
@@ -8,12 +8,17 @@ import re
 import subprocess
 import tarfile
 from os import getenv, listdir, makedirs, path
-from shutil import rmtree
+from shutil import which
+from threading import Lock
 from typing import Any, Generator
 
+import certpool
 import dboperator
+import pki
+import pkistore
 import requests
 import yaml
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random
 
 logger = logging.getLogger()
 script_dir = path.dirname(path.realpath(__file__))
@@ -35,7 +40,11 @@ defaults = {
 }
 
 PUBLIC_DOMAINNAME = getenv("PUBLIC_DOMAINNAME", "ahaz.lan")
-TEAM_PORT_RANGE_START = int(getenv("TEAM_PORT_RANGE_START", "20000"))
+# "native" generates the PKI in-process, "easyrsa" uses the easyrsa/openvpn binaries
+PKI_BACKEND = getenv("PKI_BACKEND", "native")
+
+# Explicit path to the easyrsa executable, skips discovery
+EASYRSA_PATH = getenv("EASYRSA_PATH")
 
 GITHUB_RELEASE_API = "https://api.github.com/repos/OpenVPN/easy-rsa/releases/{:s}"
 EASYRSA_TAG = "v3.1.0"
@@ -82,9 +91,9 @@ def extract_release(release, dest) -> None:
         tarball.extractall(path=dest)
 
 
-def obtain_easyrsa(update=True) -> str | None:
+def obtain_easyrsa(update=False) -> str | None:
     """Returns the path to the default EasyRSA binary after checking for,
-    and possibly installing, the latest version"""
+    and if update is set, installing, the latest version"""
     installed = tuple(easyrsa_installations(tools_dir))
     latest_install = max([(str(v[0]), str(v[1])) for v in installed]) if installed else ("", "")
 
@@ -104,12 +113,45 @@ def obtain_easyrsa(update=True) -> str | None:
         except OSError:
             logger.warning("Failed to update EasyRSA")
 
-    if latest_install is not None:
+    if latest_install[1]:
         return path.join(latest_install[1], "easyrsa")
     else:
         return None
 
 
+_easyrsa = None
+
+
+def is_executable(filename: str | None) -> bool:
+    return filename is not None and path.isfile(filename) and os.access(filename, os.X_OK)
+
+
+def resolve_easyrsa() -> str:
+    """Locate and validate the easyrsa executable without touching the network"""
+    candidates = [EASYRSA_PATH] if EASYRSA_PATH else [obtain_easyrsa(update=False), which("easyrsa")]
+    for candidate in candidates:
+        if is_executable(candidate):
+            return path.abspath(candidate)  # type: ignore
+    raise RuntimeError(f"EasyRSA installation not found (tried {', '.join(str(c) for c in candidates)})")
+
+
+def get_easyrsa() -> str:
+    """Path to the easyrsa executable, resolved once for the lifetime of the process"""
+    global _easyrsa
+    if _easyrsa is None:
+        _easyrsa = resolve_easyrsa()
+        logger.info(f"Using EasyRSA at {_easyrsa}")
+    return _easyrsa
+
+
+def update_easyrsa() -> str:
+    """Install the pinned EasyRSA release if it is newer than the installed one. Needs network access."""
+    global _easyrsa
+    obtain_easyrsa(update=True)
+    _easyrsa = None
+    return get_easyrsa()
+
+
 def apply_defaults(config, defaults) -> None:
     # Expand the wildcard
     # Wildcard only makes sense when the value is a dict
@@ -237,6 +279,8 @@ set_var EASYRSA_DIGEST "sha512"
         # subprocess.run([easyrsa, "gen-dh"], **common_args)
         logger.info("Building server certificiate")
         subprocess.run([easyrsa, "build-server-full", cn, "nopass"], **common_args)
+        logger.info("Generating certificate revocation list (CRL)")
+        subprocess.run([easyrsa, "gen-crl"], **common_args)
     except subprocess.CalledProcessError as e:
         logger.error(f"Command '{e.cmd}' failed with exit code {e.returncode}")
         if e.output:
@@ -250,9 +294,8 @@ def append_domain(name: str, domain: str | None) -> str:
         return name
 
 
-def gen_configs_ovpn(directory: str, domainname: str, port: int, proto: str) -> None:
-    ovpn_env = open(directory + "/ovpn_env.sh", "x")
-    ovpn_env.write(f"""declare -x OVPN_AUTH=
+def render_ovpn_env(domainname: str, port: int, proto: str) -> str:
+    return f"""declare -x OVPN_AUTH=
 declare -x OVPN_CIPHER=
 declare -x OVPN_CLIENT_TO_CLIENT=
 declare -x OVPN_CN={domainname}
@@ -277,9 +320,11 @@ declare -x OVPN_ROUTES=([0]="192.168.254.0/24")
 declare -x OVPN_SERVER=192.168.255.0/24
 declare -x OVPN_SERVER_URL={proto}://{domainname}:{port}
 declare -x OVPN_TLS_CIPHER=
-""")
-    openvpn_conf = open(directory + "/openvpn.conf", "x")
-    openvpn_conf.write(f"""server 192.168.255.0 255.255.255.0
+"""
+
+
+def render_openvpn_conf(domainname: str, proto: str) -> str:
+    return f"""server 192.168.255.0 255.255.255.0
 verb 3
 key /etc/openvpn/pki/private/{domainname}.key
 ca /etc/openvpn/pki/ca.crt
@@ -289,6 +334,7 @@ ecdh-curve secp384r1
 # commented out for testing purposes
 tls-auth /etc/openvpn/pki/ta.key
 key-direction 0
+crl-verify /etc/openvpn/pki/crl.pem
 keepalive 10 60
 persist-key
 persist-tun
@@ -311,9 +357,11 @@ push "block-outside-dns"
 push "dhcp-option DNS 8.8.8.8"
 push "dhcp-option DNS 8.8.4.4"
 push "comp-lzo no"
-""")
-    up_sh = open(directory + "/up.sh", "x")
-    up_sh.write("""#!/bin/sh
+"""
+
+
+# The up/down scripts are the same for every team
+UP_SCRIPT = """#!/bin/sh
 # Copyright (c) 2006-2007 Gentoo Foundation
 # Distributed under the terms of the GNU General Public License v2
 # Contributed by Roy Marples (uberlord@gentoo.org)
@@ -395,9 +443,9 @@ fi
 exit 0
 
 # vim: ts=4 :
-""")
-    down_sh = open(directory + "/down.sh", "x")
-    down_sh.write("""#!/bin/sh
+"""
+
+DOWN_SCRIPT = """#!/bin/sh
 # Copyright (c) 2006-2007 Gentoo Foundation
 # Distributed under the terms of the GNU General Public License v2
 # Contributed by Roy Marples (uberlord@gentoo.org)
@@ -431,7 +479,22 @@ exit 0
 
 # vim: ts=4 :
 
-""")
+"""
+
+
+def render_server_bundle(certLocation: str, domainname: str, port: int, proto: str) -> dict[str, str]:
+    """Everything the team's OpenVPN server needs, keyed by its ConfigMap key"""
+    return {
+        "ovpn.conf": render_openvpn_conf(domainname, proto),
+        "server.key": get_server_key(certLocation),
+        "server.crt": get_server_cert(certLocation),
+        "ca.crt": get_server_ca(certLocation),
+        "ta.key": get_server_ta(certLocation),
+        "crl.pem": get_server_crl(certLocation),
+        "ovpn.env": render_ovpn_env(domainname, port, proto),
+        "up.sh": UP_SCRIPT,
+        "down.sh": DOWN_SCRIPT,
+    }
 
 
 def gen_ta_key(directory: str) -> None:
@@ -440,42 +503,109 @@ def gen_ta_key(directory: str) -> None:
     subprocess.run("/usr/sbin/openvpn --genkey --secret ta.key", cwd=pkidirectory, shell=True)
 
 
-def gen_team(teamname: str, domainname: str, port: int, protocol: str, certdirlocationContainer: str) -> int:
+# Writes to a team's PKI are retried if another replica modified it concurrently
+conflict_retry_opts = {
+    "retry": retry_if_exception_type(pkistore.StoreConflict),
+    "stop": stop_after_attempt(5),
+    "wait": wait_random(0, 0.5),
+    "reraise": True,
+}
+
+
+def gen_team(
+    teamname: str,
+    domainname: str,
+    port: int,
+    protocol: str,
+    certdirlocationContainer: str,
+    refill_in_background: bool = True,
+) -> dict[str, str]:
+    """Generate the team's PKI and return the rendered OpenVPN server bundle
+
+    Without `refill_in_background` the team's client key stock is filled before returning, for
+    callers such as the bulk process pool whose threads do not outlive the call."""
     try:
         # Cert Generation
         # print("=1", end="")
-        teamdirContainer = certdirlocationContainer + teamname
+        store = pkistore.get_store(certdirlocationContainer)
         logger.debug("=2")
-        makedirs(teamdirContainer)
-        logger.debug("=3")
-        easyrsa = obtain_easyrsa()
-        if easyrsa is None:
-            raise RuntimeError("EasyRSA installation not found")
-        logger.debug("=4")
-        init_pki(easyrsa, teamdirContainer, domainname)
-        logger.debug("=5")
-        gen_configs_ovpn(teamdirContainer, domainname, port, protocol)
-        logger.debug("=6")
-        gen_ta_key(teamdirContainer)
-        logger.debug("=7")
-        # namespace creation
-        return 0
+        with store.create(teamname) as teamdirContainer:
+            logger.debug("=3")
+            if PKI_BACKEND == "easyrsa":
+                logger.debug("=4")
+                init_pki(get_easyrsa(), teamdirContainer, domainname)
+                logger.debug("=6")
+                gen_ta_key(teamdirContainer)
+            else:
+                logger.debug("=4")
+                if not (
+                    certpool.enabled()
+                    and certpool.claim(certdirlocationContainer, teamdirContainer, domainname)
+                ):
+                    pki.init_pki(teamdirContainer, domainname)
+            logger.debug("=7")
+            bundle = render_server_bundle(teamdirContainer, domainname, port, protocol)
+        if PKI_BACKEND != "easyrsa" and refill_in_background:
+            refill_clients_background(teamname, certdirlocationContainer)
+        elif PKI_BACKEND != "easyrsa" and certpool.client_stock_enabled():
+            refill_clients(teamname, certdirlocationContainer)
+        return bundle
     except Exception as e:
         logger.error("failed to create team " + teamname + " VPN directory: " + str(e))
         raise e
 
 
+@retry(**conflict_retry_opts)
+def refill_clients(teamname: str, certdirlocationContainer: str) -> int:
+    with pkistore.get_store(certdirlocationContainer).checkout(teamname, write=True) as teamdir:
+        return certpool.refill_clients(path.join(teamdir, "pki"))
+
+
+def refill_clients_background(teamname: str, certdirlocationContainer: str) -> None:
+    certpool.refill_clients_background(teamname, lambda: refill_clients(teamname, certdirlocationContainer))
+
+
 def del_team(teamname: str, certdirlocationContainer: str) -> None:
     try:
         logger.debug("called del_team function")
-        teamdirContainer = certdirlocationContainer + teamname
         logger.debug("about to delete team " + teamname + " VPN directory")
-        rmtree(teamdirContainer)
+        pkistore.get_store(certdirlocationContainer).delete(teamname)
         logger.debug("deleted team " + teamname + " VPN directory")
     except Exception as e:
         logger.error("failed to delete container directory for team " + teamname + ": " + str(e))
 
 
+# pki directory -> ((ca.crt mtime, ta.key mtime), ca.crt, ta.key)
+_team_material_cache: dict[str, tuple[tuple[int, int], str, str]] = {}
+_team_material_lock = Lock()
+
+
+def get_team_material(easyrsa_pki: str) -> tuple[str, str]:
+    """CA certificate and tls-auth key of a team, cached until either file changes"""
+    ca_path = os.path.join(easyrsa_pki, "ca.crt")
+    ta_path = os.path.join(easyrsa_pki, "ta.key")
+    try:
+        mtimes = (os.stat(ca_path).st_mtime_ns, os.stat(ta_path).st_mtime_ns)
+    except FileNotFoundError:
+        with _team_material_lock:
+            _team_material_cache.pop(easyrsa_pki, None)
+        raise
+
+    with _team_material_lock:
+        cached = _team_material_cache.get(easyrsa_pki)
+    if cached is not None and cached[0] == mtimes:
+        return cached[1], cached[2]
+
+    with open(ca_path, "r") as f:
+        ca_content = f.read().strip()
+    with open(ta_path, "r") as f:
+        ta_content = f.read().strip()
+
+    with _team_material_lock:
+        _team_material_cache[easyrsa_pki] = (mtimes, ca_content, ta_content)
+    return ca_content, ta_content
+
+
 def get_client_ovpn_config(
     ovpn_cn: str,
     cn: str,
@@ -505,25 +635,14 @@ def get_client_ovpn_config(
     try:
         key_path = os.path.join(easyrsa_pki, "private", f"{cn}.key")
         cert_path = os.path.join(easyrsa_pki, "issued", f"{cn}.crt")
-        ca_path = os.path.join(easyrsa_pki, "ca.crt")
-        ta_path = os.path.join(easyrsa_pki, "ta.key")
 
         with open(key_path, "r") as f:
             key_content = f.read()
 
-        # The original script uses `openssl x509 -in ...`. This is often
-        # equivalent to just reading the certificate file if it's in PEM format.
-        # If a specific conversion is required, use the subprocess line instead.
-        result = subprocess.run(
-            ["openssl", "x509", "-in", cert_path], capture_output=True, text=True, check=True
-        )
-        cert_content = result.stdout
-
-        with open(ca_path, "r") as f:
-            ca_content = f.read()
+        with open(cert_path, "r") as f:
+            cert_content = pki.normalise_pem(f.read())
 
-        with open(ta_path, "r") as f:
-            ta_content = f.read()
+        ca_content, ta_content = get_team_material(easyrsa_pki)
 
         config.extend(
             [
@@ -534,20 +653,20 @@ def get_client_ovpn_config(
                 cert_content.strip(),
                 "</cert>",
                 "<ca>",
-                ca_content.strip(),
+                ca_content,
                 "</ca>",
                 "key-direction 1",
                 "<tls-auth>",
-                ta_content.strip(),
+                ta_content,
                 "</tls-auth>",
             ]
         )
     except FileNotFoundError as e:
         logger.error(f"Configuration file not found at {e.filename}")
         return f"Error: Configuration file not found at {e.filename}"
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error executing openssl: {e.stderr}")
-        return f"Error executing openssl: {e.stderr}"
+    except ValueError as e:
+        logger.error(f"Invalid certificate for {cn}: {e}")
+        return f"Error: Invalid certificate for {cn}: {e}"
 
     logger.debug("\n".join(config))
 
@@ -556,17 +675,33 @@ def get_client_ovpn_config(
 
 def get_team_vpn_pod_port(team_id: str) -> int:
     port_resp = dboperator.get_team_port(team_id)
-    if port_resp != "null":
-        return int(port_resp)
-    else:
-        return TEAM_PORT_RANGE_START + int(team_id) - 1
+    if port_resp == "null":
+        raise ValueError(f"team {team_id} has no VPN port")
+    return int(port_resp)
+
+
+@retry(**conflict_retry_opts)
+def generate_user(team_id: str, user_id: str, certdirlocationContainer: str) -> str:
+    with pkistore.get_store(certdirlocationContainer).checkout(team_id, write=True) as teamVPNDirectory:
+        if PKI_BACKEND == "easyrsa":
+            build_client_easyrsa(user_id, teamVPNDirectory)
+        else:
+            pki_dir = path.join(teamVPNDirectory, "pki")
+            if not (certpool.client_stock_enabled() and certpool.claim_client(pki_dir, user_id)):
+                pki.build_client_full(pki_dir, user_id)
+        config = get_client_ovpn_config(
+            PUBLIC_DOMAINNAME,
+            user_id,
+            path.join(teamVPNDirectory, "pki"),
+            ovpn_port=get_team_vpn_pod_port(team_id),
+        )
+    if PKI_BACKEND != "easyrsa":
+        refill_clients_background(team_id, certdirlocationContainer)
+    return config
 
 
-def generate_user(team_id: str, user_id: str, teamVPNDirectory: str) -> str:
-    easyrsa = obtain_easyrsa()
-    if easyrsa is None:
-        raise RuntimeError("EasyRSA installation not found")
-    easyrsa = path.abspath(easyrsa)
+def build_client_easyrsa(user_id: str, teamVPNDirectory: str) -> None:
+    easyrsa = get_easyrsa()
     debug = logger.isEnabledFor(logging.DEBUG)
     common_args = {
         "check": True,
@@ -576,23 +711,43 @@ def generate_user(team_id: str, user_id: str, teamVPNDirectory: str) -> str:
         "universal_newlines": True,
     }
     subprocess.run([easyrsa, "build-client-full", user_id, "nopass"], **common_args)
-    return get_client_ovpn_config(
-        PUBLIC_DOMAINNAME,
-        user_id,
-        path.join(teamVPNDirectory, "pki"),
-        # HACK: make a better way of setting the port the client should connect to
-        ovpn_port=get_team_vpn_pod_port(team_id),
-    )
 
 
-def get_user(team_id: str, user_id: str, teamVPNDirectory: str) -> str:
-    return get_client_ovpn_config(
-        PUBLIC_DOMAINNAME,
-        user_id,
-        path.join(teamVPNDirectory, "pki"),
-        # HACK: make a better way of setting the port the client should connect to
-        ovpn_port=get_team_vpn_pod_port(team_id),
-    )
+def revoke_client_easyrsa(user_id: str, teamVPNDirectory: str) -> None:
+    easyrsa = get_easyrsa()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    common_args = {
+        "check": True,
+        "cwd": teamVPNDirectory,
+        "stdout": subprocess.PIPE if not debug else None,
+        "stderr": subprocess.PIPE if not debug else None,
+        "universal_newlines": True,
+    }
+    subprocess.run([easyrsa, "--batch", "revoke", user_id], **common_args)
+    subprocess.run([easyrsa, "gen-crl"], **common_args)
+
+
+@retry(**conflict_retry_opts)
+def revoke_user(team_id: str, user_id: str, certdirlocationContainer: str) -> str:
+    """Revoke the user's client certificate and return the team's updated CRL"""
+    with pkistore.get_store(certdirlocationContainer).checkout(team_id, write=True) as teamVPNDirectory:
+        if PKI_BACKEND == "easyrsa":
+            revoke_client_easyrsa(user_id, teamVPNDirectory)
+        else:
+            pki_dir = path.join(teamVPNDirectory, "pki")
+            pki.revoke(pki_dir, user_id)
+            pki.gen_crl(pki_dir)
+        return get_server_crl(teamVPNDirectory)
+
+
+def get_user(team_id: str, user_id: str, certdirlocationContainer: str) -> str:
+    with pkistore.get_store(certdirlocationContainer).checkout(team_id) as teamVPNDirectory:
+        return get_client_ovpn_config(
+            PUBLIC_DOMAINNAME,
+            user_id,
+            path.join(teamVPNDirectory, "pki"),
+            ovpn_port=get_team_vpn_pod_port(team_id),
+        )
 
 
 def get_server_key(certLocation: str) -> str:
@@ -623,29 +778,21 @@ def get_server_ta(certLocation: str) -> str:
     return ta_content
 
 
-def get_server_ovpn_config(certLocation: str) -> str:
-    ovpn_conf_path = os.path.join(certLocation, "openvpn.conf")
-    with open(ovpn_conf_path, "r") as f:
-        ovpn_conf_content = f.read()
-    return ovpn_conf_content
-
+def get_server_crl(certLocation: str) -> str:
+    crl_path = os.path.join(certLocation, "pki", "crl.pem")
+    with open(crl_path, "r") as f:
+        crl_content = f.read()
+    return crl_content
 
-def get_openvpn_env(certLocation: str) -> str:
-    ovpn_env_path = os.path.join(certLocation, "ovpn_env.sh")
-    with open(ovpn_env_path, "r") as f:
-        ovpn_env_content = f.read()
-    return ovpn_env_content
-
-
-def get_up_script(certLocation: str) -> str:
-    up_sh_path = os.path.join(certLocation, "up.sh")
-    with open(up_sh_path, "r") as f:
-        up_sh_content = f.read()
-    return up_sh_content
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the PKI tooling of the controller")
+    parser.add_argument(
+        "command",
+        choices=("update-easyrsa",),
+        help="install the pinned EasyRSA release into the tools directory if it is newer",
+    )
+    args = parser.parse_args()
 
-def get_down_script(certLocation: str) -> str:
-    down_sh_path = os.path.join(certLocation, "down.sh")
-    with open(down_sh_path, "r") as f:
-        down_sh_content = f.read()
-    return down_sh_content
+    logging.basicConfig(level=getenv("LOGLEVEL", "INFO").upper())
+    print(f"Using EasyRSA at {update_easyrsa()}")
@@ -0,0 +1,259 @@
+import logging
+import time
+import uuid
+from os import getenv, listdir, makedirs, path, rename
+from shutil import rmtree
+from threading import Lock, Thread
+from typing import Callable
+
+import pki
+
+# Warm pool of pre-generated team PKI bundles.
+#
+# Bundles are built in <certdir>/.pool/building-<id> and published by renaming
+# them to <certdir>/.pool/ready-<id>. A claim renames a ready bundle onto the
+# (empty) team directory, which is atomic, so concurrent claims from several
+# workers can never hand out the same bundle twice.
+#
+# The same idea is applied to client keys: every team keeps a stock of
+# pre-generated client keys in pki/stock/<id>, each published by a single rename
+# once complete. Registering a user claims a key by renaming its directory and
+# issues the user's certificate for it, so the CN is still the user's ID.
+
+logger = logging.getLogger()
+
+TEAM_POOL_SIZE = int(getenv("TEAM_POOL_SIZE", "0"))
+TEAM_POOL_LOW_WATER = int(getenv("TEAM_POOL_LOW_WATER", str(TEAM_POOL_SIZE // 2)))
+TEAM_POOL_REFILL_INTERVAL = float(getenv("TEAM_POOL_REFILL_INTERVAL", "5"))
+CLIENT_STOCK_SIZE = int(getenv("CLIENT_STOCK_SIZE", "0"))
+# Stock directories being built or claimed for longer than this were left behind by a killed process
+CLIENT_STOCK_STALE_SECONDS = 600
+
+POOL_DIRNAME = ".pool"
+READY_PREFIX = "ready-"
+BUILDING_PREFIX = "building-"
+CLAIMING_PREFIX = ".claiming-"
+
+_stats_lock = Lock()
+_stats = {
+    "claims": 0,
+    "misses": 0,
+    "claim_latency_last_ms": 0.0,
+    "claim_latency_max_ms": 0.0,
+    "claim_latency_total_ms": 0.0,
+    "generated": 0,
+}
+
+
+def enabled() -> bool:
+    return TEAM_POOL_SIZE > 0
+
+
+def pool_dir(certdir: str) -> str:
+    return path.join(certdir, POOL_DIRNAME)
+
+
+def ready_bundles(certdir: str) -> list[str]:
+    directory = pool_dir(certdir)
+    if not path.isdir(directory):
+        return []
+    return [
+        path.join(directory, name) for name in sorted(listdir(directory)) if name.startswith(READY_PREFIX)
+    ]
+
+
+def depth(certdir: str) -> int:
+    return len(ready_bundles(certdir))
+
+
+def add_bundle(certdir: str, domainname: str) -> None:
+    bundle_id = uuid.uuid4().hex
+    building = path.join(pool_dir(certdir), BUILDING_PREFIX + bundle_id)
+    try:
+        pki.init_pki(building, domainname)
+        refill_clients(path.join(building, "pki"))
+        rename(building, path.join(pool_dir(certdir), READY_PREFIX + bundle_id))
+    except Exception:
+        rmtree(building, ignore_errors=True)
+        raise
+    with _stats_lock:
+        _stats["generated"] += 1
+
+
+def refill(certdir: str, domainname: str) -> int:
+    """Top the pool up to TEAM_POOL_SIZE if it is at or below the low-water mark"""
+    current = depth(certdir)
+    if current > TEAM_POOL_LOW_WATER:
+        return 0
+
+    added = 0
+    for _ in range(TEAM_POOL_SIZE - current):
+        add_bundle(certdir, domainname)
+        added += 1
+    logger.info(f"Refilled team PKI pool with {added} bundles (depth {current + added})")
+    return added
+
+
+def claim(certdir: str, teamdir: str, domainname: str) -> bool:
+    """Move a ready bundle onto the empty directory `teamdir`. Returns False if the pool is empty."""
+    start = time.perf_counter()
+    for bundle in ready_bundles(certdir):
+        if not path.exists(path.join(bundle, "pki", "issued", f"{domainname}.crt")):
+            # Generated for a different domain name, throw it away
+            rmtree(bundle, ignore_errors=True)
+            continue
+        try:
+            rename(bundle, teamdir)
+        except FileNotFoundError:
+            # Claimed by someone else in the meantime
+            continue
+
+        elapsed = (time.perf_counter() - start) * 1000
+        with _stats_lock:
+            _stats["claims"] += 1
+            _stats["claim_latency_last_ms"] = elapsed
+            _stats["claim_latency_max_ms"] = max(_stats["claim_latency_max_ms"], elapsed)
+            _stats["claim_latency_total_ms"] += elapsed
+        logger.debug(f"Claimed pooled PKI bundle {path.basename(bundle)} for {teamdir} in {elapsed:.2f}ms")
+        return True
+
+    with _stats_lock:
+        _stats["misses"] += 1
+    logger.warning("Team PKI pool is empty, generating team PKI on demand")
+    return False
+
+
+def get_stats(certdir: str) -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    claims = stats["claims"]
+    stats["claim_latency_avg_ms"] = stats.pop("claim_latency_total_ms") / claims if claims else 0.0
+    stats["depth"] = depth(certdir)
+    stats["size"] = TEAM_POOL_SIZE
+    stats["low_water"] = TEAM_POOL_LOW_WATER
+    return stats
+
+
+def refill_worker(certdir: str, domainname: str) -> None:
+    """Keep the pool topped up. Meant to be run in a daemon thread of a single process."""
+    directory = pool_dir(certdir)
+    if path.isdir(directory):
+        # Leftovers from a refill interrupted by a restart
+        for name in listdir(directory):
+            if name.startswith(BUILDING_PREFIX):
+                rmtree(path.join(directory, name), ignore_errors=True)
+
+    logger.info(
+        f"Starting team PKI pool refill worker (size {TEAM_POOL_SIZE}, low water {TEAM_POOL_LOW_WATER})"
+    )
+    while True:
+        try:
+            refill(certdir, domainname)
+        except Exception as e:
+            logger.error(f"Failed to refill team PKI pool: {e}")
+        time.sleep(TEAM_POOL_REFILL_INTERVAL)
+
+
+def client_stock_enabled() -> bool:
+    return CLIENT_STOCK_SIZE > 0
+
+
+def stock_dir(pki_dir: str) -> str:
+    return path.join(pki_dir, pki.STOCK_DIR)
+
+
+def client_stock(pki_dir: str) -> list[str]:
+    """IDs of the stocked client keys of a team"""
+    directory = stock_dir(pki_dir)
+    if not path.isdir(directory):
+        return []
+    # Keys being built or claimed are hidden, as are the flat files of the stock layout before keys
+    # had directories of their own
+    return sorted(
+        name
+        for name in listdir(directory)
+        if not name.startswith(".") and path.isdir(path.join(directory, name))
+    )
+
+
+def remove_stale_stock(pki_dir: str) -> None:
+    directory = stock_dir(pki_dir)
+    for name in listdir(directory):
+        if not name.startswith("."):
+            continue
+        stale = path.join(directory, name)
+        try:
+            age = time.time() - path.getmtime(stale)
+        except FileNotFoundError:
+            # Published or claimed in the meantime
+            continue
+        if age > CLIENT_STOCK_STALE_SECONDS:
+            logger.warning(f"Removing client key stock leftover {stale}")
+            rmtree(stale, ignore_errors=True)
+
+
+def refill_clients(pki_dir: str) -> int:
+    makedirs(stock_dir(pki_dir), exist_ok=True)
+    remove_stale_stock(pki_dir)
+    added = 0
+    for _ in range(CLIENT_STOCK_SIZE - len(client_stock(pki_dir))):
+        pki.build_client_stock(pki_dir, uuid.uuid4().hex)
+        added += 1
+    return added
+
+
+_refilling_lock = Lock()
+_refilling: set[str] = set()
+
+
+def _refill_clients_once(teamname: str, refill: Callable[[], int]) -> None:
+    try:
+        added = refill()
+        logger.debug(f"Added {added} client keys to the stock of team {teamname}")
+    except Exception as e:
+        logger.error(f"Failed to refill client key stock of team {teamname}: {e}")
+    finally:
+        with _refilling_lock:
+            _refilling.discard(teamname)
+
+
+def refill_clients_background(teamname: str, refill: Callable[[], int]) -> None:
+    """Run `refill` for a team in a daemon thread, unless a refill is already running for it"""
+    if not client_stock_enabled():
+        return
+    with _refilling_lock:
+        if teamname in _refilling:
+            return
+        _refilling.add(teamname)
+    Thread(target=_refill_clients_once, args=(teamname, refill), daemon=True).start()
+
+
+def claim_client(pki_dir: str, user_id: str) -> bool:
+    """Issue the certificate of `user_id` for a stocked client key. Returns False if the stock is empty."""
+    key_path = path.join(pki_dir, "private", f"{user_id}.key")
+    cert_path = path.join(pki_dir, "issued", f"{user_id}.crt")
+    if path.exists(key_path) or path.exists(cert_path):
+        raise FileExistsError(f"certificate for {user_id} already exists")
+
+    for stock_id in client_stock(pki_dir):
+        claimed = path.join(stock_dir(pki_dir), CLAIMING_PREFIX + stock_id)
+        try:
+            # Renaming the directory claims the key, whoever loses the race gets FileNotFoundError
+            rename(path.join(stock_dir(pki_dir), stock_id), claimed)
+        except FileNotFoundError:
+            continue
+        try:
+            key = pki.load_key(path.join(claimed, pki.STOCK_KEY))
+        except (OSError, ValueError) as e:
+            logger.error(f"Discarding broken stocked client key {stock_id}: {e}")
+            rmtree(claimed, ignore_errors=True)
+            continue
+        try:
+            pki.build_client_full(pki_dir, user_id, key)
+        finally:
+            rmtree(claimed, ignore_errors=True)
+        logger.debug(f"Issued certificate of {user_id} for stocked client key {stock_id}")
+        return True
+
+    logger.warning(f"Client key stock of {pki_dir} is empty, issuing on demand")
+    return False
@@ -1,16 +1,25 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
 import time
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Callable
 
+import catalog
 import certmanager
 import dboperator
 import events
-from kubernetes import config, watch
+import kube
+import podview
+from kube import ensure_kube_config_loaded
+from kubernetes import watch
 from kubernetes.client import (
     CoreV1Api,
-    NetworkingV1Api,
     V1Affinity,
     V1Capabilities,
     V1ConfigMap,
@@ -36,6 +45,7 @@ from kubernetes.client import (
     V1Pod,
     V1PodList,
     V1PodSpec,
+    V1PodStatus,
     V1ResourceRequirements,
     V1Secret,
     V1SecurityContext,
@@ -48,6 +58,7 @@ from kubernetes.client import (
     V1VolumeMount,
 )
 from kubernetes.client.rest import ApiException
+from kubernetes.stream import stream
 from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 # This file has `#type: ignore` comments to ignore type checking errors from the kubernetes client library,
@@ -62,45 +73,22 @@ K8S_IMAGEPULLSECRET_NAME = os.getenv("K8S_IMAGEPULLSECRET_NAME", "regcred")
 CERT_DIR_CONTAINER = os.getenv("CERT_DIR_CONTAINER", "/etc/ahaz/certdir")
 OVPN_IMAGE = os.getenv("OVPN_IMAGE", "lisenet/openvpn")
 OVPN_TAG = os.getenv("OVPN_TAG", "latest")
-
-
-# Quick heuristic to determine if the kube folder has a valid kubeconfig file
-# or merely a service account token.
-def is_valid_kubeconfig(kube_folder: str) -> bool:
-    # Check for the presence of a valid kubeconfig file
-    kubeconfig_path = os.path.join(kube_folder, "config")
-    if os.path.exists(kubeconfig_path):
-        return True
-
-    # Check for the presence of a service account token
-    token_path = os.path.join(kube_folder, "token")
-    if os.path.exists(token_path):
-        return True
-
-    return False
-
-
-def load_kube_config():
-    # Load kube config based on environment
-    if is_valid_kubeconfig("/.kube"):
-        config.load_kube_config(config_file="/.kube/config")
-    else:
-        config.load_incluster_config()
-
-
-_kube_config_loaded = False
-
-
-def ensure_kube_config_loaded():
-    global _kube_config_loaded
-    if not _kube_config_loaded:
-        try:
-            load_kube_config()
-        except Exception as e:
-            logger.error(f"Failed to load Kubernetes configuration: {e}")
-            raise e
-
-        _kube_config_loaded = True
+# Ephemeral storage limit of every challenge pod
+CHALLENGE_POD_STORAGE = "2Gb"
+# Pod, service and network policy creations of challenge starts running at the same time
+CHALLENGE_START_CONCURRENCY = int(os.getenv("CHALLENGE_START_CONCURRENCY", "8"))
+START_TIME_ANNOTATION = "ahaz-controller/started-at"
+START_PODS_ANNOTATION = "ahaz-controller/start-pods"
+# Challenge starts whose pods are not all running yet, kept by the watcher
+CHALLENGE_START_TRACKING = 1024
+# Pods the watcher follows: challenge and VPN pods, all labelled with their team
+MANAGED_POD_SELECTOR = "team"
+# Seconds after which the API server ends a pod watch, which is then resumed from the last resource version
+K8S_WATCH_TIMEOUT = int(os.getenv("K8S_WATCH_TIMEOUT", "300"))
+# Seconds to wait before resuming a pod watch which failed
+WATCH_RETRY_DELAY = 5
+# Seconds to wait for a new CRL to show up in the VPN pod before giving up on the reload
+VPN_RELOAD_TIMEOUT = int(os.getenv("VPN_RELOAD_TIMEOUT", "120"))
 
 
 def should_retry_request(exception):
@@ -132,178 +120,215 @@ retry_opts = {
     "wait": wait_exponential(multiplier=1, min=2, max=10),  # Exponential backoff
 }
 
+_start_executor = ThreadPoolExecutor(CHALLENGE_START_CONCURRENCY, thread_name_prefix="challenge-start")
 
-@retry(**retry_opts)
-def create_network_policy_deny_all(namespace: str) -> V1NetworkPolicy:
-    ensure_kube_config_loaded()
 
-    try:
-        policy = V1NetworkPolicy(
-            api_version="networking.k8s.io/v1",
-            kind="NetworkPolicy",
-            metadata=V1ObjectMeta(name="deny-all"),
-            spec=V1NetworkPolicySpec(
-                pod_selector=V1LabelSelector(match_labels={}),
-                policy_types=["Ingress", "Egress"],
-                ingress=[],
-                egress=[],
-            ),
-        )
-        return policy
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating deny-all network policy: {e}")
-        raise e
+def team_deny_all_policy_manifest() -> V1NetworkPolicy:
+    policy = V1NetworkPolicy(
+        api_version="networking.k8s.io/v1",
+        kind="NetworkPolicy",
+        metadata=V1ObjectMeta(name="deny-all"),
+        spec=V1NetworkPolicySpec(
+            pod_selector=V1LabelSelector(match_labels={}),
+            policy_types=["Ingress", "Egress"],
+            ingress=[],
+            egress=[],
+        ),
+    )
+    return policy
+
+
+def team_vpn_access_policy_manifest(namespace: str) -> V1NetworkPolicy:
+    policy = V1NetworkPolicy(
+        api_version="networking.k8s.io/v1",
+        kind="NetworkPolicy",
+        metadata=V1ObjectMeta(name="restrict-vpn-access"),
+        spec=V1NetworkPolicySpec(
+            pod_selector=V1LabelSelector(match_labels={"name": "vpn-container-pod"}),
+            policy_types=["Ingress", "Egress"],
+            ingress=[
+                V1NetworkPolicyIngressRule(
+                    ports=[
+                        V1NetworkPolicyPort(protocol="TCP", port=1194),
+                        V1NetworkPolicyPort(protocol="UDP", port=1194),
+                    ]
+                )
+            ],
+            egress=[
+                # Explicitly deny all egress traffic by default
+                # Allow communication only within the same namespace
+                V1NetworkPolicyEgressRule(
+                    to=[V1NetworkPolicyPeer(pod_selector=V1LabelSelector(match_labels={"team": namespace}))]
+                )
+            ],
+        ),
+    )
+    return policy
 
 
 @retry(**retry_opts)
-def create_network_policy(namespace: str) -> V1NetworkPolicy:
+def apply_manifest(namespace: str, manifest: kube.Manifest) -> None:
+    """Server-side apply `manifest`, retries and repeated applies of the same manifest are no-ops"""
     ensure_kube_config_loaded()
-
+    kind, name = manifest.kind, manifest.metadata.name
     try:
-        policy = V1NetworkPolicy(
-            api_version="networking.k8s.io/v1",
-            kind="NetworkPolicy",
-            metadata=V1ObjectMeta(name="restrict-vpn-access"),
-            spec=V1NetworkPolicySpec(
-                pod_selector=V1LabelSelector(match_labels={"name": "vpn-container-pod"}),
-                policy_types=["Ingress", "Egress"],
-                ingress=[
-                    V1NetworkPolicyIngressRule(
-                        ports=[
-                            V1NetworkPolicyPort(protocol="TCP", port=1194),
-                            V1NetworkPolicyPort(protocol="UDP", port=1194),
-                        ]
-                    )
-                ],
-                egress=[
-                    # Explicitly deny all egress traffic by default
-                    # Allow communication only within the same namespace
-                    V1NetworkPolicyEgressRule(
-                        to=[
-                            V1NetworkPolicyPeer(
-                                pod_selector=V1LabelSelector(match_labels={"team": namespace})
+        applied = kube.apply(namespace, manifest)
+    except ApiException as e:
+        if e.status != 403:
+            logger.error(f"API Exception when applying {kind} {name} in namespace {namespace}: {e}")
+        raise e
+    # Applying to an object being deleted succeeds, but it is gone soon after
+    if applied.metadata and applied.metadata.deletion_timestamp is not None:
+        raise Exception(f"{kind} {name} in namespace {namespace} is still being deleted")
+    logger.debug(f"Applied {kind} {name} in namespace {namespace}")
+
+
+def challenge_pod_manifest(
+    teamname: str, pod: catalog.PodSpec, taskname: str, annotations: dict[str, str] | None = None
+) -> V1Pod:
+    k8s_name = pod.k8s_name
+    taskname = taskname.replace(" ", "-")
+    # FIXME: Gb and Gi are not strictly equivalent!
+    storage = CHALLENGE_POD_STORAGE.replace("Gb", "Gi")
+    ram = pod.ram.replace("Gb", "Gi")
+    pod_manifest = V1Pod(
+        api_version="v1",
+        kind="Pod",
+        metadata=V1ObjectMeta(
+            name=k8s_name,
+            labels={
+                "team": teamname,
+                # used to identify if this pods IP address will be shown to user.
+                "visible": str(int(pod.visible_to_user)),
+                "task": taskname,  # identifies task pod is part of, used for network policies
+                "name": k8s_name,  # used for service selector
+            },
+            annotations=annotations,
+        ),
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    image=pod.image,
+                    name="container",
+                    env=[V1EnvVar(name=var.name, value=var.value) for var in pod.env_vars],
+                    resources=V1ResourceRequirements(
+                        limits={
+                            "memory": ram,
+                            "cpu": str(pod.cpu),
+                            "ephemeral-storage": storage,
+                        },
+                        requests={
+                            "memory": "0",
+                            "cpu": "0",
+                            "ephemeral-storage": "0",
+                        },
+                    ),
+                )
+            ],
+            tolerations=[
+                V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="task"),
+                V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="shared"),
+            ],
+            affinity=V1Affinity(
+                node_affinity=V1NodeAffinity(
+                    required_during_scheduling_ignored_during_execution=V1NodeSelector(
+                        node_selector_terms=[
+                            V1NodeSelectorTerm(
+                                match_expressions=[
+                                    V1NodeSelectorRequirement(
+                                        key="ahaz-controller/node-role",
+                                        operator="In",
+                                        values=["task", "shared"],
+                                    )
+                                ]
                             )
                         ]
                     )
-                ],
+                )
             ),
-        )
-        return policy
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating restrict-vpn-access network policy: {e}")
-        raise e
+            image_pull_secrets=[{"name": K8S_IMAGEPULLSECRET_NAME}],
+        ),
+    )
+    logger.debug(f"Pod manifest: {pod_manifest}")
+    return pod_manifest
+
+
+def challenge_manifests(
+    teamname: str, challenge: catalog.ChallengeSpec, annotations: dict[str, str] | None = None
+) -> list[kube.Manifest]:
+    """Every object of a started challenge: its pods, their services and its network policies"""
+    taskname = challenge.name.replace(" ", "-")
+    return [
+        *(challenge_pod_manifest(teamname, pod, challenge.name, annotations) for pod in challenge.pods),
+        *(pod_service_manifest(teamname, taskname, pod.k8s_name) for pod in challenge.pods),
+        *challenge_network_policies(teamname, challenge),
+    ]
+
+
+def start_challenge(teamname: str, challenge: catalog.ChallengeSpec) -> int:
+    """Apply the pods, services and network policies of a challenge, at most CHALLENGE_START_CONCURRENCY
+    applies at a time across all starts"""
+    challengename = challenge.name
+    logger.info(f"Starting challenge {challengename} for team {teamname}")
+    started_at = time.time()
+    # read back by the watcher to report the time until all pods are running
+    annotations = {
+        START_TIME_ANNOTATION: f"{started_at:.3f}",
+        START_PODS_ANNOTATION: str(len(challenge.pods)),
+    }
+    futures = [
+        _start_executor.submit(apply_manifest, teamname, manifest)
+        for manifest in challenge_manifests(teamname, challenge, annotations)
+    ]
+    # every apply logs its own failure, wait for all of them before reporting the first
+    failures = [e for e in (future.exception() for future in futures) if e is not None]
+    if failures:
+        raise failures[0]
+    logger.info(
+        f"Submitted challenge {challengename} for team {teamname}: {len(futures)} resources "
+        + f"in {time.time() - started_at:.2f}s"
+    )
+    return 0
 
 
-# TODO: fix unused params
-@retry(**retry_opts)
-def start_challenge_pod(
-    teamname: str,
-    k8s_name: str,
-    image: str,
-    ram: str,
-    cpu: str,
-    storage: str,
-    visible_to_user: bool,
-    networklist: list[str],  # FIXME: Is this used?
-    taskname: str,
-) -> None:
-    ensure_kube_config_loaded()
-    try:
-        core_api = CoreV1Api()
-        taskname = taskname.replace(" ", "-")
-        # FIXME: Gb and Gi are not strictly equivalent!
-        storage = storage.replace("Gb", "Gi")
-        ram = ram.replace("Gb", "Gi")
-        env_vars = dboperator.get_env_vars(k8s_name)
-        pod_manifest = V1Pod(
-            metadata=V1ObjectMeta(
-                name=k8s_name,
-                labels={
-                    "team": teamname,
-                    "visible": str(
-                        visible_to_user
-                    ),  # used to identify if this pods IP address will be shown to user.
-                    "task": taskname,  # identifies task pod is part of, used for network policies
-                    "name": k8s_name,  # used for service selector
-                },
-            ),
-            spec=V1PodSpec(
-                containers=[
-                    V1Container(
-                        image=image,
-                        name="container",
-                        env=[V1EnvVar(name=var["name"], value=var["value"]) for var in env_vars],
-                        resources=V1ResourceRequirements(
-                            limits={
-                                "memory": ram,
-                                "cpu": str(cpu),
-                                "ephemeral-storage": storage,
-                            },
-                            requests={
-                                "memory": "0",
-                                "cpu": "0",
-                                "ephemeral-storage": "0",
-                            },
-                        ),
-                    )
-                ],
-                tolerations=[
-                    V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="task"),
-                    V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="shared"),
-                ],
-                affinity=V1Affinity(
-                    node_affinity=V1NodeAffinity(
-                        required_during_scheduling_ignored_during_execution=V1NodeSelector(
-                            node_selector_terms=[
-                                V1NodeSelectorTerm(
-                                    match_expressions=[
-                                        V1NodeSelectorRequirement(
-                                            key="ahaz-controller/node-role",
-                                            operator="In",
-                                            values=["task", "shared"],
-                                        )
-                                    ]
-                                )
-                            ]
-                        )
-                    )
-                ),
-                image_pull_secrets=[{"name": K8S_IMAGEPULLSECRET_NAME}],
-            ),
-        )
-        logger.debug(f"Creating pod {k8s_name} in namespace {teamname} with image {image}")
-        logger.debug(f"Pod manifest: {pod_manifest}")
-        core_api.create_namespaced_pod(namespace=teamname, body=pod_manifest)
-        create_pod_service(teamname, taskname, k8s_name)
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when starting challenge pod: {e}")
-        raise e
+def summarise_pod(pod: V1Pod) -> dict | None:
+    """The summary of a pod shown to its team, None if the pod is missing metadata or status"""
+    # Test whether we have all the values we expect
+    if not pod.metadata:
+        logger.warning("Pod is missing metadata:")
+        logger.warning(pod)
+        return None
 
+    if pod.status is None:
+        logger.warning(f"Pod {pod.metadata.name} in namespace {pod.metadata.namespace} has no status.")
+        return None
 
-@retry(**retry_opts)
-def start_challenge(teamname: str, challengename: str) -> int:
-    try:
-        logger.info(f"Starting challenge {challengename} for team {teamname}")
-        db_pods_data = dboperator.get_pods(challengename)
-        for i in db_pods_data:
-            k8s_name, image, ram, cpu, visible_to_user = i[1:]
-            storage = "2Gb"
-            netnames = dboperator.get_k8s_name_networks(k8s_name)
-            networklist = []
-            for i in netnames:
-                networklist.append(i.replace("teamnet", teamname))
-            start_challenge_pod(
-                teamname, k8s_name, image, ram, cpu, storage, visible_to_user, networklist, challengename
+    # Test if pod is visible
+    if "visible" in pod.metadata.labels:
+        pod_visible = int(pod.metadata.labels["visible"])
+    else:
+        if pod.metadata.name != "vpn-container-pod":
+            logger.warning(
+                f"Pod {pod.metadata.name} in namespace {pod.metadata.namespace} missing 'visible' label."
             )
-        create_challenge_network_policies(teamname, challengename)
-        return 0
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when starting challenge: {e}")
-        raise e
+        pod_visible = 1  # default to visible if label is missing
+
+    # Get pod status
+    is_vpn = pod.metadata.name == "vpn-container-pod"
+
+    # because python k8s api does not show status terminating :/
+    if pod.metadata.deletion_timestamp is not None and pod.status.phase in ("Pending", "Running"):
+        state = "Terminating"
+    else:
+        state = str(pod.status.phase)
+
+    return {
+        "status": state,
+        "ip": pod.status.pod_ip,
+        "visibleIP": pod_visible,
+        "task": catalog.challenge_of(pod.metadata.labels["name"]) if not is_vpn else None,
+        "name": pod.metadata.labels["name"],
+    }
 
 
 def summarise_pods_list(pod_list: V1PodList, showInvisible: bool) -> list[dict[str, str]]:
@@ -312,50 +337,9 @@ def summarise_pods_list(pod_list: V1PodList, showInvisible: bool) -> list[dict[s
 
     pod_info = []
     for pod in pod_list.items:
-        pod = pod  # type: V1Pod
-
-        # Test whether we have all the values we expect
-        if not pod.metadata:
-            logger.warning("Pod is missing metadata:")
-            logger.warning(pod)
-            continue
-
-        if pod.status is None:
-            logger.warning(f"Pod {pod.metadata.name} in namespace {pod.metadata.namespace} has no status.")
+        pod_data = summarise_pod(pod)
+        if pod_data is None or (pod_data["visibleIP"] != 1 and not showInvisible):
             continue
-
-        # Test if pod is visible
-        if "visible" in pod.metadata.labels:
-            pod_visible = int(pod.metadata.labels["visible"])
-        else:
-            if pod.metadata.name != "vpn-container-pod":
-                logger.warning(
-                    f"Pod {pod.metadata.name} in namespace {pod.metadata.namespace} missing 'visible' label."
-                )
-            pod_visible = 1  # default to visible if label is missing
-
-        if pod_visible != 1 and not showInvisible:
-            continue
-
-        # Get pod status
-        is_vpn = pod.metadata.name == "vpn-container-pod"
-
-        # because python k8s api does not show status terminating :/
-        if pod.metadata.deletion_timestamp is not None and pod.status.phase in ("Pending", "Running"):
-            state = "Terminating"
-        else:
-            state = str(pod.status.phase)
-
-        pod_data = {
-            "status": state,
-            "ip": pod.status.pod_ip,
-            "visibleIP": pod_visible,
-            "task": dboperator.get_challenge_from_k8s_name(pod.metadata.labels["name"])
-            if not is_vpn
-            else None,
-            "name": pod.metadata.labels["name"],
-        }
-
         pod_info.append(pod_data)
 
     return pod_info
@@ -365,7 +349,7 @@ def summarise_pods_list(pod_list: V1PodList, showInvisible: bool) -> list[dict[s
 def get_pods_namespace(teamname: str, showInvisible: bool) -> str:
     ensure_kube_config_loaded()
     try:
-        core_api = CoreV1Api()
+        core_api = kube.core_api()
         pod_list: V1PodList = core_api.list_namespaced_pod(teamname)
 
         if not pod_list.items:
@@ -379,154 +363,118 @@ def get_pods_namespace(teamname: str, showInvisible: bool) -> str:
         raise e
 
 
-@retry(**retry_opts)
-def create_pod_service(teamname: str, taskname: str, k8s_name: str) -> None:
-    ensure_kube_config_loaded()
-    try:
-        core_api = CoreV1Api()
-
-        service = V1Service(
-            metadata=V1ObjectMeta(
-                name=k8s_name,  # FIXME: (which one?) could also be f"{challengename}-service"
-                namespace=teamname,
-                labels={"task": taskname},
-            ),
-            spec=V1ServiceSpec(
-                cluster_ip="None",  # headless service
-                selector={"name": k8s_name},
-                # ports=[
-                #    V1ServicePort(
-                #        protocol="TCP",
-                #        port=0,
-                #        target_port=0
-                #    )
-                # ]
-            ),
-        )
-
-        # Create the service in Kubernetes
-        api_response: V1Service = core_api.create_namespaced_service(namespace=teamname, body=service)  # type: ignore
-        logger.debug(f"Service created. Status='{api_response.status}'")
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating service for pod {k8s_name}: {e}")
-        raise e
+def pod_service_manifest(teamname: str, taskname: str, k8s_name: str) -> V1Service:
+    return V1Service(
+        api_version="v1",
+        kind="Service",
+        metadata=V1ObjectMeta(
+            name=k8s_name,  # FIXME: (which one?) could also be f"{challengename}-service"
+            namespace=teamname,
+            labels={"task": taskname},
+        ),
+        spec=V1ServiceSpec(
+            cluster_ip="None",  # headless service
+            selector={"name": k8s_name},
+            # ports=[
+            #    V1ServicePort(
+            #        protocol="TCP",
+            #        port=0,
+            #        target_port=0
+            #    )
+            # ]
+        ),
+    )
 
 
-# FIXME: Is teamname used?
-@retry(**retry_opts)
-def create_network_policy_deny_all_task(teamname: str, challengename: str) -> V1NetworkPolicy:
-    ensure_kube_config_loaded()
-    try:
-        sanitized_challengename = challengename.replace(" ", "-").lower()
-        taskname = challengename.replace(" ", "-")
-
-        policy = V1NetworkPolicy(
-            api_version="networking.k8s.io/v1",
-            kind="NetworkPolicy",
-            metadata=V1ObjectMeta(
-                name="deny-all-" + sanitized_challengename, labels={"task": challengename.replace(" ", "-")}
-            ),
-            spec=V1NetworkPolicySpec(
-                pod_selector=V1LabelSelector(match_labels={"task": taskname}),
-                policy_types=["Ingress", "Egress"],
-                ingress=[],
-                egress=[],
-            ),
-        )
-        return policy
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating deny-all network policy for {challengename}: {e}")
-        raise e
+def task_deny_all_policy_manifest(challengename: str) -> V1NetworkPolicy:
+    sanitized_challengename = challengename.replace(" ", "-").lower()
+    taskname = challengename.replace(" ", "-")
+
+    policy = V1NetworkPolicy(
+        api_version="networking.k8s.io/v1",
+        kind="NetworkPolicy",
+        metadata=V1ObjectMeta(
+            name="deny-all-" + sanitized_challengename, labels={"task": challengename.replace(" ", "-")}
+        ),
+        spec=V1NetworkPolicySpec(
+            pod_selector=V1LabelSelector(match_labels={"task": taskname}),
+            policy_types=["Ingress", "Egress"],
+            ingress=[],
+            egress=[],
+        ),
+    )
+    return policy
 
 
-@retry(**retry_opts)
-def create_network_policy_allow_task(
-    teamname: str, challengename: str, network_pods: list[str], netname: str
+def task_network_policy_manifest(
+    challengename: str, network_pods: list[str], netname: str
 ) -> V1NetworkPolicy:
-    ensure_kube_config_loaded()
-    try:
-        # Explicitly allow DNS
-        dns_peer = V1NetworkPolicyPeer(
-            namespace_selector=V1LabelSelector(match_labels={"kubernetes.io/metadata.name": "kube-system"}),
-            pod_selector=V1LabelSelector(match_labels={"k8s-app": "kube-dns"}),
-        )
-        dns_egress_rule = V1NetworkPolicyEgressRule(
-            to=[dns_peer],
-            ports=[
-                V1NetworkPolicyPort(protocol="UDP", port=53),
-                V1NetworkPolicyPort(protocol="TCP", port=53),
-            ],
-        )
-        # Explicitly allow the pods within the network
-        pod_selector = V1LabelSelector(
+    # Explicitly allow DNS
+    dns_peer = V1NetworkPolicyPeer(
+        namespace_selector=V1LabelSelector(match_labels={"kubernetes.io/metadata.name": "kube-system"}),
+        pod_selector=V1LabelSelector(match_labels={"k8s-app": "kube-dns"}),
+    )
+    dns_egress_rule = V1NetworkPolicyEgressRule(
+        to=[dns_peer],
+        ports=[
+            V1NetworkPolicyPort(protocol="UDP", port=53),
+            V1NetworkPolicyPort(protocol="TCP", port=53),
+        ],
+    )
+    # Explicitly allow the pods within the network
+    pod_selector = V1LabelSelector(
+        match_expressions=[V1LabelSelectorRequirement(key="name", operator="In", values=network_pods)]
+    )
+
+    peer_selector = V1NetworkPolicyPeer(
+        pod_selector=V1LabelSelector(
             match_expressions=[V1LabelSelectorRequirement(key="name", operator="In", values=network_pods)]
         )
+    )
+
+    ingress_rule = V1NetworkPolicyIngressRule(_from=[peer_selector])
+    egress_rule = V1NetworkPolicyEgressRule(to=[peer_selector])
 
-        peer_selector = V1NetworkPolicyPeer(
-            pod_selector=V1LabelSelector(
-                match_expressions=[V1LabelSelectorRequirement(key="name", operator="In", values=network_pods)]
+    pod_selector = V1LabelSelector(
+        match_expressions=[
+            V1LabelSelectorRequirement(
+                key="name",
+                operator="In",
+                values=network_pods,  # your array of pod names
             )
-        )
+        ]
+    )
 
-        ingress_rule = V1NetworkPolicyIngressRule(_from=[peer_selector])
-        egress_rule = V1NetworkPolicyEgressRule(to=[peer_selector])
+    policy = V1NetworkPolicy(
+        api_version="networking.k8s.io/v1",
+        kind="NetworkPolicy",
+        metadata=V1ObjectMeta(
+            # Network names are only unique within a challenge, and applying takes over a policy of the
+            # same name from another challenge
+            name=f"allow-all-{netname}-" + challengename.replace(" ", "-").lower(),
+            labels={"task": challengename.replace(" ", "-")},
+        ),
+        spec=V1NetworkPolicySpec(
+            pod_selector=pod_selector,
+            policy_types=["Ingress", "Egress"],
+            ingress=[ingress_rule],
+            egress=[dns_egress_rule, egress_rule],
+        ),
+    )
+    return policy
 
-        pod_selector = V1LabelSelector(
-            match_expressions=[
-                V1LabelSelectorRequirement(
-                    key="name",
-                    operator="In",
-                    values=network_pods,  # your array of pod names
-                )
-            ]
-        )
 
-        policy = V1NetworkPolicy(
-            api_version="networking.k8s.io/v1",
-            kind="NetworkPolicy",
-            metadata=V1ObjectMeta(
-                name="allow-all-" + netname, labels={"task": challengename.replace(" ", "-")}
-            ),
-            spec=V1NetworkPolicySpec(
-                pod_selector=pod_selector,
-                policy_types=["Ingress", "Egress"],
-                ingress=[ingress_rule],
-                egress=[dns_egress_rule, egress_rule],
-            ),
-        )
-        return policy
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating allow-all network policy for network {netname}: {e}")
-        raise e
+def challenge_network_policies(teamname: str, challenge: catalog.ChallengeSpec) -> list[V1NetworkPolicy]:
+    challengename = challenge.name
+    policies = [task_deny_all_policy_manifest(challengename)]
+    for netname, k8s_names in challenge.networks.items():  # all networks that will need to be created
+        network_pods = list(k8s_names)
 
+        if netname == "teamnet":  # if it is teamnet, include the vpn pod in whitelist
+            network_pods.append("vpn-container-pod")
 
-@retry(**retry_opts)
-def create_challenge_network_policies(teamname: str, challengename: str) -> None:
-    ensure_kube_config_loaded()
-    try:
-        net_api = NetworkingV1Api()
-        deny_policy = create_network_policy_deny_all_task(teamname, challengename)
-        net_api.create_namespaced_network_policy(namespace=teamname, body=deny_policy)
-
-        networklist = dboperator.get_unique_networks(challengename)
-        for netname in networklist:  # understand all networks that will need to be created
-            temp_network_pods = dboperator.get_pods_in_network(challengename, netname)
-            network_pods = [x for x in temp_network_pods]  # make a copy
-
-            if netname == "teamnet":  # if it is teamnet, include the vpn pod in whitelist
-                network_pods.append("vpn-container-pod")
-                netname = netname + "-" + "".join(char for char in challengename.lower())
-                netname = netname.replace(" ", "-")
-
-            allow_policy = create_network_policy_allow_task(teamname, challengename, network_pods, netname)
-            net_api.create_namespaced_network_policy(namespace=teamname, body=allow_policy)
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating challenge network policies for {challengename}: {e}")
-        raise e
+        policies.append(task_network_policy_manifest(challengename, network_pods, netname))
+    return policies
 
 
 @retry(**retry_opts)
@@ -535,8 +483,8 @@ def stop_challenge(teamname: str, task: str) -> str:
     try:
         task = task.replace(" ", "-")
 
-        core_api = CoreV1Api()
-        net_api = NetworkingV1Api()
+        core_api = kube.core_api()
+        net_api = kube.networking_api()
 
         label_selector = f"task={task}"
 
@@ -578,7 +526,7 @@ def stop_challenge(teamname: str, task: str) -> str:
 def create_secret_in_namespace(teamname: str, secret_data: V1Secret) -> None:
     ensure_kube_config_loaded()
     try:
-        core_api = CoreV1Api()
+        core_api = kube.core_api()
         core_api.create_namespaced_secret(namespace=teamname, body=secret_data)
         logger.debug(f"Created secret {secret_data.metadata.name} in namespace {teamname}")  # type: ignore
     except ApiException as e:
@@ -593,7 +541,7 @@ def create_secret_in_namespace(teamname: str, secret_data: V1Secret) -> None:
 def check_namespaced_service_account_exists(namespace: str, service_account_name: str) -> bool:
     ensure_kube_config_loaded()
     try:
-        core_api = CoreV1Api()
+        core_api = kube.core_api()
         core_api.read_namespaced_service_account(name=service_account_name, namespace=namespace)
         logger.debug(f"Service account {service_account_name} exists in namespace {namespace}")
         return True
@@ -627,7 +575,7 @@ def patch_namespaced_service_account(
     ensure_kube_config_loaded()
 
     try:
-        core_api = CoreV1Api()
+        core_api = kube.core_api()
         core_api.patch_namespaced_service_account(name=service_account_name, namespace=namespace, body=body)
         logger.debug(f"Patched service account {service_account_name} in namespace {namespace}")
     except ApiException as e:
@@ -651,11 +599,25 @@ def patch_namespaced_service_account(
 
 # old functions from old controller
 @retry(**retry_opts)
-def create_team_namespace(teamname: str) -> None:
+def create_namespace(teamname: str) -> None:
     ensure_kube_config_loaded()
     try:
-        core_api = CoreV1Api()
+        core_api = kube.core_api()
         core_api.create_namespace(V1Namespace(metadata=V1ObjectMeta(name=teamname)))
+        logger.debug(f"Created namespace {teamname}")
+    except ApiException as e:
+        if e.status != 403:
+            logger.error(f"API Exception when creating namespace {teamname}: {e}")
+        else:
+            logger.debug(f"API Exception when creating namespace {teamname}: {e}")
+        raise e
+
+
+@retry(**retry_opts)
+def copy_image_pull_secret(teamname: str) -> None:
+    ensure_kube_config_loaded()
+    try:
+        core_api = kube.core_api()
         logger.debug(f"Moving regcred into namespace {teamname}")
 
         regcred: V1Secret = core_api.read_namespaced_secret(
@@ -669,204 +631,247 @@ def create_team_namespace(teamname: str) -> None:
         regcred.metadata.namespace = teamname
         regcred.metadata.resource_version = None
         create_secret_in_namespace(teamname, regcred)
-        # patch the default service account to disallow auto-mounting of the token
-        patch_namespaced_service_account(
-            namespace=teamname,
-            service_account_name="default",
-            body=V1ServiceAccount(automount_service_account_token=False),
-        )
     except ApiException as e:
         if e.status != 403:
-            logger.error(f"API Exception when creating namespace {teamname}: {e}")
+            logger.error(f"API Exception when copying regcred into namespace {teamname}: {e}")
         else:
-            logger.debug(f"API Exception when creating namespace {teamname}: {e}")
-        raise e
-    except Exception as e:
-        logger.error(f"General Exception when creating namespace {teamname}: {e}")
+            logger.debug(f"API Exception when copying regcred into namespace {teamname}: {e}")
         raise e
 
 
-@retry(**retry_opts)
-def create_team_vpn_configmap(teamname) -> None:
-    ensure_kube_config_loaded()
-    try:
-        core_api = CoreV1Api()
-        teamCertDir = CERT_DIR_CONTAINER + teamname
-
-        ovpn_config = certmanager.get_server_ovpn_config(teamCertDir)
-        server_key = certmanager.get_server_key(teamCertDir)
-        server_cert = certmanager.get_server_cert(teamCertDir)
-        server_ca = certmanager.get_server_ca(teamCertDir)
-        server_ta = certmanager.get_server_ta(teamCertDir)
-        ovpn_env = certmanager.get_openvpn_env(teamCertDir)
-        up_script = certmanager.get_up_script(teamCertDir)
-        down_script = certmanager.get_down_script(teamCertDir)
-
-        config_map = V1ConfigMap(
-            api_version="v1",
-            kind="ConfigMap",
-            metadata=V1ObjectMeta(name=f"vpn-config-{teamname}"),
-            data={
-                "ovpn.conf": ovpn_config,
-                "server.key": server_key,
-                "server.crt": server_cert,
-                "ca.crt": server_ca,
-                "ta.key": server_ta,
-                "ovpn.env": ovpn_env,
-                "up.sh": up_script,
-                "down.sh": down_script,
-            },
-        )
+def disable_default_token_automount(teamname: str) -> None:
+    # patch the default service account to disallow auto-mounting of the token
+    patch_namespaced_service_account(
+        namespace=teamname,
+        service_account_name="default",
+        body=V1ServiceAccount(automount_service_account_token=False),
+    )
 
-        core_api.create_namespaced_config_map(namespace=teamname, body=config_map)
-        logger.debug(f"Created ConfigMap vpn-config-{teamname} in namespace {teamname}")
-    except ApiException as e:
-        if e.status != 403:
-            logger.error(f"API Exception when creating VPN ConfigMap for team {teamname}: {e}")
-        raise e
 
+def create_team_namespace(teamname: str) -> None:
+    """Create the team namespace with the image pull secret, steps that may also be run separately"""
+    create_namespace(teamname)
+    copy_image_pull_secret(teamname)
+    disable_default_token_automount(teamname)
+
+
+def team_vpn_configmap_manifest(teamname: str, bundle: dict[str, str]) -> V1ConfigMap:
+    """The VPN ConfigMap of a server bundle rendered by certmanager.render_server_bundle"""
+    return V1ConfigMap(
+        api_version="v1",
+        kind="ConfigMap",
+        metadata=V1ObjectMeta(name=f"vpn-config-{teamname}"),
+        data=bundle,
+    )
 
-@retry(**retry_opts)
-def create_team_vpn_container(teamname: str) -> None:
-    ensure_kube_config_loaded()
-    try:
-        create_team_vpn_configmap(teamname)
-        core_api = CoreV1Api()
-        pod_manifest = V1Pod(
-            metadata=V1ObjectMeta(
-                name="vpn-container-pod",
-                labels={"name": "vpn-container-pod", "team": teamname},
-            ),
-            spec=V1PodSpec(
-                containers=[
-                    V1Container(
-                        image=f"{OVPN_IMAGE}:{OVPN_TAG}",
-                        name="vpn-container",
-                        volume_mounts=[
-                            V1VolumeMount(
-                                mount_path="/etc/openvpn",
-                                name="vpn-volume",
-                                read_only=True,  # might need to be changed later
-                            ),
-                            V1VolumeMount(mount_path="/dev/net/tun", name="dev-net-tun", read_only=False),
-                        ],
-                        # NOTE: NET_ADMIN is required for OpenVPN function
-                        security_context=V1SecurityContext(capabilities=V1Capabilities(add=["NET_ADMIN"])),
-                        env=[V1EnvVar(name="DEBUG", value="1")],
-                    )
-                ],
-                volumes=[
-                    V1Volume(
-                        name="vpn-volume",
-                        config_map=V1ConfigMapVolumeSource(
-                            name=f"vpn-config-{teamname}",
-                            items=[
-                                V1KeyToPath(key="ovpn.conf", path="openvpn.conf"),
-                                V1KeyToPath(key="server.key", path=f"pki/private/{PUBLIC_DOMAINNAME}.key"),
-                                V1KeyToPath(key="server.crt", path=f"pki/issued/{PUBLIC_DOMAINNAME}.crt"),
-                                V1KeyToPath(key="ca.crt", path="pki/ca.crt"),
-                                V1KeyToPath(key="ta.key", path="pki/ta.key"),
-                                V1KeyToPath(key="ovpn.env", path="ovpn_env.sh"),
-                                V1KeyToPath(key="up.sh", path="up.sh"),
-                                V1KeyToPath(key="down.sh", path="down.sh"),
-                            ],
+
+def team_vpn_pod_manifest(teamname: str) -> V1Pod:
+    return V1Pod(
+        api_version="v1",
+        kind="Pod",
+        metadata=V1ObjectMeta(
+            name="vpn-container-pod",
+            labels={"name": "vpn-container-pod", "team": teamname},
+        ),
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    image=f"{OVPN_IMAGE}:{OVPN_TAG}",
+                    name="vpn-container",
+                    volume_mounts=[
+                        V1VolumeMount(
+                            mount_path="/etc/openvpn",
+                            name="vpn-volume",
+                            read_only=True,  # might need to be changed later
                         ),
+                        V1VolumeMount(mount_path="/dev/net/tun", name="dev-net-tun", read_only=False),
+                    ],
+                    # NOTE: NET_ADMIN is required for OpenVPN function
+                    security_context=V1SecurityContext(capabilities=V1Capabilities(add=["NET_ADMIN"])),
+                    env=[V1EnvVar(name="DEBUG", value="1")],
+                )
+            ],
+            volumes=[
+                V1Volume(
+                    name="vpn-volume",
+                    config_map=V1ConfigMapVolumeSource(
+                        name=f"vpn-config-{teamname}",
+                        items=[
+                            V1KeyToPath(key="ovpn.conf", path="openvpn.conf"),
+                            V1KeyToPath(key="server.key", path=f"pki/private/{PUBLIC_DOMAINNAME}.key"),
+                            V1KeyToPath(key="server.crt", path=f"pki/issued/{PUBLIC_DOMAINNAME}.crt"),
+                            V1KeyToPath(key="ca.crt", path="pki/ca.crt"),
+                            V1KeyToPath(key="ta.key", path="pki/ta.key"),
+                            V1KeyToPath(key="crl.pem", path="pki/crl.pem"),
+                            V1KeyToPath(key="ovpn.env", path="ovpn_env.sh"),
+                            V1KeyToPath(key="up.sh", path="up.sh"),
+                            V1KeyToPath(key="down.sh", path="down.sh"),
+                        ],
                     ),
-                    V1Volume(name="dev-net-tun", host_path=V1HostPathVolumeSource(path="/dev/net/tun")),
-                ],
-                tolerations=[
-                    V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="vpn"),
-                    V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="shared"),
-                ],
-                affinity=V1Affinity(
-                    node_affinity=V1NodeAffinity(
-                        required_during_scheduling_ignored_during_execution=V1NodeSelector(
-                            node_selector_terms=[
-                                V1NodeSelectorTerm(
-                                    match_expressions=[
-                                        V1NodeSelectorRequirement(
-                                            key="ahaz-controller/node-role",
-                                            operator="In",
-                                            values=["vpn", "shared"],
-                                        )
-                                    ]
-                                )
-                            ]
-                        )
-                    )
                 ),
+                V1Volume(name="dev-net-tun", host_path=V1HostPathVolumeSource(path="/dev/net/tun")),
+            ],
+            tolerations=[
+                V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="vpn"),
+                V1Toleration(key="ahaz-controller/node-role", operator="Equal", value="shared"),
+            ],
+            affinity=V1Affinity(
+                node_affinity=V1NodeAffinity(
+                    required_during_scheduling_ignored_during_execution=V1NodeSelector(
+                        node_selector_terms=[
+                            V1NodeSelectorTerm(
+                                match_expressions=[
+                                    V1NodeSelectorRequirement(
+                                        key="ahaz-controller/node-role",
+                                        operator="In",
+                                        values=["vpn", "shared"],
+                                    )
+                                ]
+                            )
+                        ]
+                    )
+                )
             ),
+        ),
+    )
+
+
+def team_vpn_service_manifest(teamname: str, externalport: int) -> V1Service:
+    return V1Service(
+        api_version="v1",
+        kind="Service",
+        metadata=V1ObjectMeta(
+            name="vpn-container-service",
+            namespace=teamname,
+        ),
+        spec=V1ServiceSpec(
+            selector={"name": "vpn-container-pod"},  # Selector to match the pod labels
+            ports=[
+                V1ServicePort(
+                    port=1194,  # Port exposed by the service (VPN port)
+                    target_port=1194,  # Container's port
+                    node_port=externalport,  # NodePort; k8s will allocate one if not specified
+                )
+            ],
+            type="NodePort",  # Service type is NodePort
+        ),
+    )
+
+
+def create_team_vpn_container(teamname: str, bundle: dict[str, str]) -> None:
+    apply_manifest(teamname, team_vpn_configmap_manifest(teamname, bundle))
+    apply_manifest(teamname, team_vpn_pod_manifest(teamname))
+
+
+def create_team_vpn_service(teamname: str, externalport: int) -> None:
+    logger.info(f"Exposing VPN container for team {teamname} on port {externalport}")
+    apply_manifest(teamname, team_vpn_service_manifest(teamname, externalport))
+
+
+def create_team_network_policies(teamname: str) -> None:
+    policy_deny = team_deny_all_policy_manifest()
+    policy = team_vpn_access_policy_manifest(teamname)
+    logger.debug("The following network policies will be applied:")
+    logger.debug(f"Deny-all policy: {policy_deny}")
+    logger.debug(f"Restrict-vpn-access policy: {policy}")
+    apply_manifest(teamname, policy)
+    apply_manifest(teamname, policy_deny)
+    logger.debug("Successfully applied network policy")
+
+
+def expose_team_vpn_container(teamname: str, externalport: int) -> None:
+    create_team_vpn_service(teamname, externalport)
+    create_team_network_policies(teamname)
+
+
+def register_user_ovpn(teamname: str, username: str) -> str:
+    result = certmanager.generate_user(teamname, username, CERT_DIR_CONTAINER)
+    dboperator.insert_user_vpn_config(teamname, username, result)
+    return "successfully registered"
+
+
+@retry(**retry_opts)
+def update_team_vpn_crl(teamname: str, crl: str) -> None:
+    ensure_kube_config_loaded()
+    try:
+        core_api = kube.core_api()
+        core_api.patch_namespaced_config_map(
+            name=f"vpn-config-{teamname}", namespace=teamname, body={"data": {"crl.pem": crl}}
         )
-        core_api.create_namespaced_pod(body=pod_manifest, namespace=teamname)
+        logger.debug(f"Updated CRL in ConfigMap vpn-config-{teamname}")
     except ApiException as e:
         if e.status != 403:
-            logger.error(f"API Exception when creating VPN container for team {teamname}: {e}")
+            logger.error(f"API Exception when updating VPN CRL for team {teamname}: {e}")
         raise e
 
 
 @retry(**retry_opts)
-def expose_team_vpn_container(teamname: str, externalport: int) -> None:
+def check_team_vpn_crl(teamname: str) -> None:
+    """Raise a RuntimeError if the team's VPN server does not check a CRL, as for teams registered before
+    revocation was supported"""
     ensure_kube_config_loaded()
     try:
-        logger.info(f"Exposing VPN container for team {teamname} on port {externalport}")
-        core_api = CoreV1Api()
-        service = V1Service(
-            metadata=V1ObjectMeta(
-                name="vpn-container-service",
-                namespace=teamname,
-            ),
-            spec=V1ServiceSpec(
-                selector={"name": "vpn-container-pod"},  # Selector to match the pod labels
-                ports=[
-                    V1ServicePort(
-                        port=1194,  # Port exposed by the service (VPN port)
-                        target_port=1194,  # Container's port
-                        node_port=externalport,  # NodePort; k8s will allocate one if not specified
-                    )
-                ],
-                type="NodePort",  # Service type is NodePort
-            ),
-        )
-        api_service_response: V1Service = core_api.create_namespaced_service(
-            namespace=teamname,
-            body=service,
-        )  # type: ignore
-        logger.debug(f"Service created. Status: '{api_service_response.status}'")
-
-        policy_deny = create_network_policy_deny_all(teamname)
-        policy = create_network_policy(teamname)
-        logger.debug("The following network policies will be applied:")
-        logger.debug(f"Deny-all policy: {policy_deny}")
-        logger.debug(f"Restrict-vpn-access policy: {policy}")
-
-        net_api = NetworkingV1Api()
-        logger.debug("Applying network policies...")
-        api_network_response: V1NetworkPolicy = net_api.create_namespaced_network_policy(
-            namespace=teamname, body=policy
-        )  # type: ignore
-        logger.debug(f"Restrict-vpn-access policy created. Status: '{api_network_response}'")
-
-        api_network_response_deny: V1NetworkPolicy = net_api.create_namespaced_network_policy(
-            namespace=teamname, body=policy_deny
+        config_map: V1ConfigMap = kube.core_api().read_namespaced_config_map(
+            name=f"vpn-config-{teamname}", namespace=teamname
         )  # type: ignore
-        logger.debug(f"Deny-all policy created. Status: '{api_network_response_deny}'")
-        logger.debug("Successfully applied network policy")
     except ApiException as e:
         if e.status != 403:
-            logger.error(f"API Exception when exposing VPN container for team {teamname}: {e}")
+            logger.error(f"API Exception when reading VPN ConfigMap of team {teamname}: {e}")
         raise e
+    data = config_map.data or {}
+    if "crl.pem" not in data or "crl-verify" not in data.get("ovpn.conf", ""):
+        raise RuntimeError(
+            f"VPN server of team {teamname} was created without CRL support, "
+            + "the team must be re-registered before users can be revoked"
+        )
 
 
-def register_user_ovpn(teamname: str, username: str) -> str:
-    vpnDirLocation = CERT_DIR_CONTAINER + teamname
-    result = certmanager.generate_user(teamname, username, vpnDirLocation)
-    dboperator.insert_user_vpn_config(teamname, username, result)
-    return "successfully registered"
+def reload_team_vpn(teamname: str, crl: str) -> None:
+    """Wait until the kubelet has synced `crl` into the VPN pod, then make OpenVPN reconnect all clients"""
+    ensure_kube_config_loaded()
+    digest = hashlib.sha256(crl.encode()).hexdigest()
+    # OpenVPN rereads the CRL on every handshake, SIGUSR1 forces already connected clients to do one
+    script = f"""i=0
+while [ "$(sha256sum /etc/openvpn/pki/crl.pem | cut -d ' ' -f 1)" != "{digest}" ]; do
+    i=$((i + 1))
+    [ "$i" -ge {VPN_RELOAD_TIMEOUT} ] && exit 1
+    sleep 1
+done
+kill -USR1 1
+"""
+    # stream() patches the client it is given, so the exec gets a client of its own
+    core_api = CoreV1Api(kube.new_api_client(pool_size=1))
+    resp = stream(
+        core_api.connect_get_namespaced_pod_exec,
+        "vpn-container-pod",
+        teamname,
+        container="vpn-container",
+        command=["/bin/sh", "-c", script],
+        stderr=True,
+        stdin=False,
+        stdout=True,
+        tty=False,
+        _preload_content=False,
+    )
+    resp.run_forever(timeout=VPN_RELOAD_TIMEOUT + 10)
+    if resp.returncode != 0:
+        raise TimeoutError(f"VPN pod of team {teamname} did not pick up the new CRL: {resp.read_stderr()}")
+    logger.info(f"Reloaded VPN server of team {teamname}")
+
+
+def revoke_user_ovpn(teamname: str, username: str) -> str:
+    """Revoke a user's VPN certificate and push the new CRL to the team's VPN server"""
+    # Before changing anything, the server would never pick the CRL up
+    check_team_vpn_crl(teamname)
+    crl = certmanager.revoke_user(teamname, username, CERT_DIR_CONTAINER)
+    update_team_vpn_crl(teamname, crl)
+    dboperator.delete_user_vpn_config(teamname, username)
+    reload_team_vpn(teamname, crl)
+    return "successfully revoked"
 
 
 def obtain_user_ovpn_config(teamname: str, username: str) -> str:
-    vpnDirLocation = CERT_DIR_CONTAINER + teamname
-    result = certmanager.get_user(teamname, username, vpnDirLocation)
+    result = certmanager.get_user(teamname, username, CERT_DIR_CONTAINER)
     result = str(result).replace("\\n", "\n")
     return result
 
@@ -874,7 +879,7 @@ def obtain_user_ovpn_config(teamname: str, username: str) -> str:
 def delete_namespace(teamname: str, timeout: int = 300, interval: int = 5) -> int:
     ensure_kube_config_loaded()
     try:
-        core_api = CoreV1Api()
+        core_api = kube.core_api()
         try:
             logger.info(f"Deleting namespace: {teamname}")
             core_api.delete_namespace(name=teamname)
@@ -921,59 +926,224 @@ def delete_namespace(teamname: str, timeout: int = 300, interval: int = 5) -> in
         raise e
 
 
-async def k8s_watcher(event_manager: events.RedisEventManager) -> None:
+# (namespace, started-at annotation) -> pods of that challenge start seen running, None once reported
+_running_starts: OrderedDict[tuple[str, str], set[str] | None] = OrderedDict()
+
+
+def record_challenge_pod_running(namespace: str, pod_name: str, labels: dict, annotations: dict) -> None:
+    """Log the time to running of a challenge start once all of its pods are running"""
+    started_at = annotations.get(START_TIME_ANNOTATION)
+    if started_at is None:
+        return
+    key = (namespace, started_at)
+    running = _running_starts.setdefault(key, set())
+    if len(_running_starts) > CHALLENGE_START_TRACKING:
+        _running_starts.popitem(last=False)
+    if running is None:
+        return
+    running.add(pod_name)
+    if len(running) < int(annotations.get(START_PODS_ANNOTATION, "1")):
+        return
+    _running_starts[key] = None
+    logger.info(
+        f"Challenge {labels.get('task')} of team {namespace} running "
+        + f"{time.time() - float(started_at):.1f}s after it was started"
+    )
+
+
+def list_managed_pods() -> V1PodList:
+    return kube.core_api().list_pod_for_all_namespaces(label_selector=MANAGED_POD_SELECTOR)  # type: ignore
+
+
+def stream_managed_pods(w: watch.Watch, resource_version: str, emit: Callable[[dict], None]) -> str:
+    """Pass the pod events after `resource_version` to `emit` until the watch ends, returns the last
+    resource version seen, bookmarks included"""
+    for event in w.stream(
+        kube.core_api().list_pod_for_all_namespaces,
+        label_selector=MANAGED_POD_SELECTOR,
+        resource_version=resource_version,
+        allow_watch_bookmarks=True,
+        timeout_seconds=K8S_WATCH_TIMEOUT,
+        # Notice a connection which died silently, the API server ends the watch before this
+        _request_timeout=K8S_WATCH_TIMEOUT + 30,
+    ):
+        # Bookmarks only carry the resource version, which w.stream() keeps track of
+        if event["type"] != "BOOKMARK":
+            emit(event)
+        resource_version = w.resource_version or resource_version
+    return resource_version
+
+
+def watch_managed_pods(emit: Callable[[dict], None]) -> None:
+    """List and then watch the managed pods forever, passing a RELIST event with the pod list and every
+    pod event after it to `emit`
+
+    A watch which ended or dropped is resumed from the last resource version seen, the pods are only
+    listed again once that version is too old to resume from (410 Gone)."""
     ensure_kube_config_loaded()
-    core_api = CoreV1Api()
     w = watch.Watch()
-    logger.info("Starting Kubernetes watcher...")
-    for event_untyped in w.stream(core_api.list_pod_for_all_namespaces):
+    resource_version: str | None = None
+    while True:
         try:
-            event: V1PodList = event_untyped  # type: ignore
-
-            # Publish pod name, labels, status, ip to the event manager
-            pod: V1Pod = event["object"]  # type: ignore
-            event_type: str = event["type"]  # type: ignore
-            pod_name: str = pod.metadata.name if pod.metadata and pod.metadata.name else "unknown"
-            pod_namespace: str = (
-                pod.metadata.namespace if pod.metadata and pod.metadata.namespace else "unknown"
-            )
-            pod_labels: dict[str, str] = pod.metadata.labels if pod.metadata and pod.metadata.labels else {}
-            pod_status: str = pod.status.phase if pod.status and pod.status.phase else "unknown"
-            pod_ip: str = pod.status.pod_ip if pod.status and pod.status.pod_ip else "unknown"
-
-            challenge_name: str | None = None
-
-            if "name" in pod_labels:
-                try:
-                    challenge_name = dboperator.get_challenge_from_k8s_name(pod_labels.get("name", ""))
-                except Exception:
-                    pass
-
-            if pod_status == "Failed":
-                # Hide failed status. It shows up for a split second when pod is deleted.
-                pod_status = "Terminating"
-
-            if (pod.metadata.deletion_timestamp if pod.metadata else None) is not None and pod_status in (
-                "Pending",
-                "Running",
-            ):
-                pod_status = "Terminating"
-
-            event_data = {
-                "event_type": event_type,
-                "pod_name": pod_name,
-                "pod_namespace": pod_namespace,
-                "pod_status": pod_status,
-                "pod_ip": pod_ip,
-                "visible": int(pod_labels.get("visible", "0")),
-                "challenge": challenge_name,
-            }
-
-            await event_manager.publish_event(
-                "ahaz_events", json.dumps({"type": "pod_event", "data": event_data})
-            )
+            if resource_version is None:
+                pod_list = list_managed_pods()
+                resource_version = pod_list.metadata.resource_version  # type: ignore
+                emit({"type": "RELIST", "object": pod_list})
+            resource_version = stream_managed_pods(w, resource_version, emit)  # type: ignore
+        except ApiException as e:
+            if e.status == 410:
+                logger.info(f"Pod watch at resource version {resource_version} expired, listing pods again")
+                resource_version = None
+                continue
+            logger.error(f"API Exception when watching pods: {e}")
+            time.sleep(WATCH_RETRY_DELAY)
+        except Exception as e:
+            logger.warning(f"Pod watch interrupted, resuming from resource version {resource_version}: {e}")
+            time.sleep(WATCH_RETRY_DELAY)
+
+
+def last_seen_pod(namespace: str, name: str, summary: dict) -> V1Pod:
+    """A pod as far as its summary in the pod view tells"""
+    return V1Pod(
+        metadata=V1ObjectMeta(
+            name=name,
+            namespace=namespace,
+            labels={"team": namespace, "name": summary["name"], "visible": str(summary["visibleIP"])},
+        ),
+        status=V1PodStatus(phase=summary["status"], pod_ip=summary["ip"]),
+    )
+
+
+def summarise_listed_pods(pod_list: V1PodList) -> tuple[dict[str, dict[str, dict]], list[V1Pod]]:
+    """The summaries of the listed pods, namespace -> pod name -> summary, and the pods which could be
+    summarised"""
+    pods: dict[str, dict[str, dict]] = {}
+    listed: list[V1Pod] = []
+    for pod in pod_list.items:
+        try:
+            summary = summarise_pod(pod)
         except Exception as e:
-            logger.error("Error processing Kubernetes event:")
-            logger.error(e)
-            logger.error(traceback.format_exc())
+            logger.error(f"Skipping pod {pod.metadata.namespace}/{pod.metadata.name} while relisting: {e}")
             continue
+        listed.append(pod)
+        if summary is not None:
+            pods.setdefault(pod.metadata.namespace, {})[pod.metadata.name] = summary
+    return pods, listed
+
+
+async def relist_pods(
+    event_manager: events.RedisEventManager, pod_view: podview.PodView, pod_list: V1PodList
+) -> None:
+    """Replace the pod view with `pod_list` and publish every listed pod, and every pod of the view
+    which is not listed anymore, as if it was added or deleted"""
+    # Summarising looks the challenges up in the catalog, which may query the database
+    pods, listed = await asyncio.to_thread(summarise_listed_pods, pod_list)
+    # Pods deleted while the watch could not be resumed
+    gone = [
+        last_seen_pod(namespace, name, summary)
+        for namespace, summaries in pod_view.snapshot().items()
+        for name, summary in summaries.items()
+        if name not in pods.get(namespace, {})
+    ]
+    try:
+        await pod_view.load(pods)
+    except Exception as e:
+        # The view stays not ready and pods are listed from the API server
+        logger.error(f"Error loading pod view: {e}")
+    # The view already holds the listed pods, only publish them
+    for pod in listed:
+        await handle_pod_event(event_manager, pod_view, {"type": "ADDED", "object": pod}, update_view=False)
+    for pod in gone:
+        await handle_pod_event(event_manager, pod_view, {"type": "DELETED", "object": pod}, update_view=False)
+
+
+async def update_pod_view(pod_view: podview.PodView, event_type: str, pod: V1Pod) -> None:
+    if not pod.metadata:
+        return
+    summary = await asyncio.to_thread(summarise_pod, pod) if event_type != "DELETED" else None
+    await pod_view.update(pod.metadata.namespace, pod.metadata.name, summary)
+
+
+async def k8s_watcher(event_manager: events.RedisEventManager, pod_view: podview.PodView) -> None:
+    """Publish the events of the managed pods and keep the pod view, without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    # Filled by the blocking watch in its own thread
+    queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    def emit(event: dict) -> None:
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    logger.info("Starting Kubernetes watcher...")
+    # A view left behind by the previous watcher is out of date until the first list is loaded
+    await pod_view.stop()
+    Thread(target=watch_managed_pods, args=(emit,), name="pod-watch", daemon=True).start()
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), podview.READY_REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                await pod_view.keep_ready()
+                continue
+            if event["type"] == "RELIST":
+                await relist_pods(event_manager, pod_view, event["object"])
+            else:
+                await handle_pod_event(event_manager, pod_view, event)
+            await pod_view.keep_ready()
+    finally:
+        await pod_view.stop()
+
+
+async def handle_pod_event(
+    event_manager: events.RedisEventManager, pod_view: podview.PodView, event: dict, update_view: bool = True
+) -> None:
+    try:
+        # Publish pod name, labels, status, ip to the event manager
+        pod: V1Pod = event["object"]  # type: ignore
+        event_type: str = event["type"]  # type: ignore
+        pod_name: str = pod.metadata.name if pod.metadata and pod.metadata.name else "unknown"
+        pod_namespace: str = pod.metadata.namespace if pod.metadata and pod.metadata.namespace else "unknown"
+        pod_labels: dict[str, str] = pod.metadata.labels if pod.metadata and pod.metadata.labels else {}
+        pod_status: str = pod.status.phase if pod.status and pod.status.phase else "unknown"
+        pod_ip: str = pod.status.pod_ip if pod.status and pod.status.pod_ip else "unknown"
+
+        challenge_name: str | None = None
+
+        if "name" in pod_labels:
+            try:
+                challenge_name = await asyncio.to_thread(catalog.challenge_of, pod_labels.get("name", ""))
+            except Exception:
+                pass
+
+        if pod_status == "Failed":
+            # Hide failed status. It shows up for a split second when pod is deleted.
+            pod_status = "Terminating"
+
+        if (pod.metadata.deletion_timestamp if pod.metadata else None) is not None and pod_status in (
+            "Pending",
+            "Running",
+        ):
+            pod_status = "Terminating"
+
+        if event_type == "MODIFIED" and pod_status == "Running" and pod.metadata:
+            record_challenge_pod_running(pod_namespace, pod_name, pod_labels, pod.metadata.annotations or {})
+
+        if update_view:
+            await update_pod_view(pod_view, event_type, pod)
+
+        event_data = {
+            "event_type": event_type,
+            "pod_name": pod_name,
+            "pod_namespace": pod_namespace,
+            "pod_status": pod_status,
+            "pod_ip": pod_ip,
+            "visible": int(pod_labels.get("visible", "0")),
+            "challenge": challenge_name,
+        }
+
+        await event_manager.publish_event(
+            "ahaz_events", json.dumps({"type": "pod_event", "data": event_data})
+        )
+    except Exception as e:
+        logger.error("Error processing Kubernetes event:")
+        logger.error(e)
+        logger.error(traceback.format_exc())
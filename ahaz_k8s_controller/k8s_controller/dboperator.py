@@ -1,57 +1,294 @@
 import datetime
+import functools
+import inspect
 import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from os import getenv
+from threading import Lock
+from typing import Any, Iterator
 
-from mysql.connector import pooling
+import queries
+import vpnconfig
+from mysql.connector import errorcode, errors, pooling
 
 DB_IP = getenv("DB_IP", "10.33.0.3")
 DB_DBNAME = getenv("DB_DBNAME", "ahaz")
 DB_USERNAME = getenv("DB_USERNAME", "dbeaver")
 DB_PASSWORD = getenv("DB_PASSWORD", "dbeaver")
-K8S_IP_RANGE = getenv("K8S_IP_RANGE", "10.42.0.0 255.255.0.0")
+# Comma-separated replicas for the lookups of request handlers, empty to read from DB_IP only
+DB_READ_HOSTS = [host.strip() for host in getenv("DB_READ_HOSTS", "").split(",") if host.strip()]
+# Seconds a replica which could not be connected to is skipped for
+DB_READ_HOST_RETRY = float(getenv("DB_READ_HOST_RETRY", "30"))
+# Also log every registration progress update to register_status
+DB_REGISTRATION_HISTORY = getenv("DB_REGISTRATION_HISTORY", "false").lower() == "true"
 
 logger = logging.getLogger()
 
 pool = None
 
 
+@dataclass
+class QueryCount:
+    checkouts: int = 0
+    statements: int = 0
+
+
+# Set while count_queries() is active
+_query_count: ContextVar[QueryCount | None] = ContextVar("dboperator_query_count", default=None)
+
+
+class _Scope:
+    def __init__(self, replica_reads: bool = False):
+        self.conn: pooling.PooledMySQLConnection | None = None
+        self.read_conn: pooling.PooledMySQLConnection | None = None
+        # Reads go to a replica until the first write of the scope, from then on they see its writes
+        self.replica_reads = replica_reads
+        self.wrote = False
+
+    def reads_from_replica(self) -> bool:
+        return self.replica_reads and not self.wrote and bool(DB_READ_HOSTS)
+
+
+# Set while connection_scope() is active
+_scope: ContextVar[_Scope | None] = ContextVar("dboperator_scope", default=None)
+
+_read_pools: dict[str, pooling.MySQLConnectionPool] = {}
+_read_hosts_lock = Lock()
+_read_host_turn = 0
+# host -> time.monotonic() until which it is skipped after failing
+_read_host_down_until: dict[str, float] = {}
+
+
+def _open_pool(name: str, host: str) -> pooling.MySQLConnectionPool:
+    return pooling.MySQLConnectionPool(
+        pool_name=name,
+        pool_size=10,
+        pool_reset_session=True,
+        # Writes spanning several statements use transaction(), so reads never see a stale snapshot
+        autocommit=True,
+        host=host,
+        database=DB_DBNAME,
+        user=DB_USERNAME,
+        password=DB_PASSWORD,
+    )
+
+
 def get_connection() -> pooling.PooledMySQLConnection:
+    """A connection to the primary"""
     global pool
     if pool is None:
         logger.debug("Initializing connection pool")
-        pool = pooling.MySQLConnectionPool(
-            pool_name="mypool",
-            pool_size=10,
-            pool_reset_session=True,
-            host=DB_IP,
-            database=DB_DBNAME,
-            user=DB_USERNAME,
-            password=DB_PASSWORD,
-        )
+        pool = _open_pool("mypool", DB_IP)
+    count_checkout()
     return pool.get_connection()
 
 
+def next_read_host() -> str | None:
+    """The next replica in turn which is not marked down, None if there is none"""
+    global _read_host_turn
+    now = time.monotonic()
+    with _read_hosts_lock:
+        for _ in range(len(DB_READ_HOSTS)):
+            host = DB_READ_HOSTS[_read_host_turn % len(DB_READ_HOSTS)]
+            _read_host_turn += 1
+            if _read_host_down_until.get(host, 0.0) <= now:
+                return host
+    return None
+
+
+def mark_read_host_down(host: str, e: Exception) -> None:
+    logger.warning(f"Database replica {host} unavailable, reading from the primary instead: {e}")
+    with _read_hosts_lock:
+        _read_host_down_until[host] = time.monotonic() + DB_READ_HOST_RETRY
+
+
+def get_read_connection() -> pooling.PooledMySQLConnection:
+    """A connection to the next available replica, or to the primary if none is available"""
+    host = next_read_host()
+    if host is None:
+        return get_connection()
+    try:
+        with _read_hosts_lock:
+            if host not in _read_pools:
+                logger.debug(f"Initializing connection pool for replica {host}")
+                _read_pools[host] = _open_pool(f"read-{host}", host)
+            read_pool = _read_pools[host]
+        conn = read_pool.get_connection()
+    except errors.Error as e:
+        mark_read_host_down(host, e)
+        return get_connection()
+    count_checkout()
+    return conn
+
+
+@contextmanager
+def connection_scope(replica_reads: bool = False) -> Iterator[None]:
+    """Share one pooled connection between all queries in the block, checked out on the first query
+
+    With `replica_reads`, lookups go to a replica from DB_READ_HOSTS until the block first writes"""
+    if _scope.get() is not None:
+        yield
+        return
+    scope = _Scope(replica_reads)
+    token = _scope.set(scope)
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+        for conn in (scope.read_conn, scope.conn):
+            if conn is not None:
+                conn.close()
+
+
+def _scoped(func, replica_reads: bool):
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with connection_scope(replica_reads):
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with connection_scope(replica_reads):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def scoped(func):
+    """Decorator running a (coroutine) function inside connection_scope()"""
+    return _scoped(func, replica_reads=False)
+
+
+def replica_scoped(func):
+    """Decorator running a (coroutine) function inside connection_scope(replica_reads=True)"""
+    return _scoped(func, replica_reads=True)
+
+
+@contextmanager
+def connection(read: bool = False) -> Iterator[pooling.PooledMySQLConnection]:
+    """The connection of the current scope, or one from the pool for the duration of the block
+
+    Only `read` connections of a scope with replica reads go to a replica, any other connection
+    counts as a write of the scope."""
+    scope = _scope.get()
+    if scope is None:
+        with get_connection() as conn:
+            yield conn
+        return
+    if read and scope.reads_from_replica():
+        if scope.read_conn is None:
+            scope.read_conn = get_read_connection()
+        yield scope.read_conn
+        return
+    scope.wrote = scope.wrote or not read
+    if scope.conn is None:
+        scope.conn = get_connection()
+    yield scope.conn
+
+
+class _CountingCursor:
+    def __init__(self, cursor, counter: QueryCount):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs) -> Any:
+        self._counter.statements += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs) -> Any:
+        self._counter.statements += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+
+def count_checkout() -> None:
+    counter = _query_count.get()
+    if counter is not None:
+        counter.checkouts += 1
+
+
+def count_statement() -> None:
+    counter = _query_count.get()
+    if counter is not None:
+        counter.statements += 1
+
+
+@contextmanager
+def get_cursor(read: bool = False) -> Iterator[Any]:
+    """Cursor on the connection(read) of the current scope, pass `read` for lookups only"""
+    with connection(read) as conn, conn.cursor() as cursor:
+        counter = _query_count.get()
+        yield cursor if counter is None else _CountingCursor(cursor, counter)
+
+
+@contextmanager
+def transaction() -> Iterator[Any]:
+    """Cursor whose statements are committed together when the block exits, or rolled back on error"""
+    with connection() as conn, conn.cursor() as cursor:
+        counter = _query_count.get()
+        count_statement()
+        conn.start_transaction()
+        try:
+            yield cursor if counter is None else _CountingCursor(cursor, counter)
+        except BaseException:
+            conn.rollback()
+            raise
+        count_statement()
+        conn.commit()
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCount]:
+    """Count the connection checkouts and statements made from this context inside the block"""
+    counter = QueryCount()
+    token = _query_count.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_count.reset(token)
+
+
+@contextmanager
+def assert_queries(checkouts: int | None = None, statements: int | None = None) -> Iterator[QueryCount]:
+    """Raise AssertionError if the block needs more connection checkouts or statements than given"""
+    with count_queries() as counter:
+        yield counter
+    if checkouts is not None and counter.checkouts > checkouts:
+        raise AssertionError(f"expected at most {checkouts} connection checkouts, got {counter.checkouts}")
+    if statements is not None and counter.statements > statements:
+        raise AssertionError(f"expected at most {statements} statements, got {counter.statements}")
+
+
 def getUTCasStr() -> str:
     return str(int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000))
 
 
 def get_challenges_from_db() -> list[str]:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("SELECT name FROM challenges")
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.CHALLENGES)
         rows = cursor.fetchall()
     return [str(row[0]) for row in rows]
 
 
 def get_pods(name: str) -> list[tuple]:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("SELECT * FROM pods WHERE name = %s", (name,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.PODS, (name,))
         rows = cursor.fetchall()
     return list(rows)
 
 
 def get_env_vars(k8s_name: str) -> list[dict]:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("SELECT env_var_name, env_var_value FROM env_vars WHERE k8s_name = %s", (k8s_name,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.ENV_VARS, (k8s_name,))
         rows = cursor.fetchall()
 
     env_vars = []
@@ -61,8 +298,8 @@ def get_env_vars(k8s_name: str) -> list[dict]:
 
 
 def get_k8s_name_networks(k8s_name: str) -> list[str]:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("SELECT netname FROM net_rules WHERE k8s_name = %s", (k8s_name,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.K8S_NAME_NETWORKS, (k8s_name,))
         rows = cursor.fetchall()
 
     netnames = []
@@ -72,91 +309,106 @@ def get_k8s_name_networks(k8s_name: str) -> list[str]:
 
 
 def get_unique_networks(challengename: str) -> list[str]:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("SELECT DISTINCT netname FROM net_rules WHERE name = %s", (challengename,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.UNIQUE_NETWORKS, (challengename,))
         rows = cursor.fetchall()
     return [str(row[0]) for row in rows]
 
 
 def get_pods_in_network(challengename: str, netname: str) -> list[str]:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute(
-            "SELECT k8s_name FROM net_rules WHERE netname = %s AND name = %s", (netname, challengename)
-        )
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.PODS_IN_NETWORK, (netname, challengename))
         rows = cursor.fetchall()
     return [str(row[0]) for row in rows]
 
 
 def get_challenge_from_k8s_name(k8s_name: str) -> str:
-    with get_connection() as conn, conn.cursor() as cursor:
-        # FIXME: Add limit=1 to the query to avoid fetching unnecessary rows
-        cursor.execute("SELECT name FROM pods WHERE k8s_name = %s", (k8s_name,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.CHALLENGE_FROM_K8S_NAME, (k8s_name,))
         rows = cursor.fetchall()
     return str(rows[0][0])
 
 
 def insert_team_into_db(teamname: str) -> None:
-    with get_connection() as conn, conn.cursor() as cursor:
-        if get_team_id(teamname) != "null":
-            raise ValueError("team with that name already exists in db")
-        cursor.execute("INSERT INTO teams (name) VALUES (%s)", (teamname,))
-        conn.commit()
+    try:
+        with get_cursor() as cursor:
+            cursor.execute(queries.INSERT_TEAM, (teamname,))
+    except errors.IntegrityError as e:
+        if e.errno == errorcode.ER_DUP_ENTRY:
+            raise ValueError("team with that name already exists in db") from e
+        raise e
 
 
 def insert_vpn_port_into_db(teamname: str, port: int) -> str | None:
-    if get_team_port(teamname) != "null":
+    try:
+        with get_cursor() as cursor:
+            cursor.execute(queries.INSERT_VPN_PORT, (port, teamname))
+            inserted = cursor.rowcount
+    except errors.IntegrityError as e:
+        if e.errno != errorcode.ER_DUP_ENTRY:
+            raise e
+        if "vpn_map_port" in str(e.msg):
+            return "port " + str(port) + " is already allocated"
         return "team already has port allocated to it"
-    if get_port_team(port) != "null":
-        return "port " + str(port) + " is already allocated"
-    with get_connection() as conn, conn.cursor() as cursor:
-        teamid = get_team_id(teamname)
-        cursor.execute("INSERT INTO vpn_map(port,teamid) VALUES (%s, %s)", (port, teamid))
-        conn.commit()
-
-
-# Mmmmm, cider...
-def cidr_to_netmask(cidr: int) -> str:
-    mask = (0xFFFFFFFF >> (32 - cidr)) << (32 - cidr)
-    return f"{(mask >> 24) & 0xFF}.{(mask >> 16) & 0xFF}.{(mask >> 8) & 0xFF}.{mask & 0xFF}"
-
-
-def ip_and_cidr_to_netmask(ip_cidr: str) -> str:
-    ip, cidr = ip_cidr.split("/")
-    cidr = int(cidr)
-    netmask = cidr_to_netmask(cidr)
-    return ip + " " + netmask
+    if inserted == 0:
+        return "team " + teamname + " does not exist"
 
 
-def parse_ip_range(ip_range: str) -> str:
-    if ip_range.count("/") == 1:
-        return ip_and_cidr_to_netmask(ip_range)
-    elif ip_range.count(" ") == 1:
-        return ip_range
-    else:
-        raise ValueError("Invalid IP range format")
+def user_vpn_config_statements(teamname: str, username: str, config: str) -> list[tuple[str, tuple]]:
+    """Statements storing a client config, split into team and user material when certmanager rendered it"""
+    config = str(config).replace("\\n", "\n")
+    material = vpnconfig.split(config)
+    if material is None:
+        config = vpnconfig.apply_client_options(config)
+        return [(queries.UPSERT_USER_VPN_CONFIG, (username, config, teamname, config))]
+    team, user = material
+    team_values = (team.options, team.ca, team.tls_auth)
+    return [
+        (queries.UPSERT_TEAM_MATERIAL, (*team_values, teamname, *team_values, *team_values)),
+        (queries.UPSERT_USER_MATERIAL, (username, user.cert, user.key, teamname, user.cert, user.key)),
+    ]
 
 
 def insert_user_vpn_config(teamname: str, username: str, config: str) -> None:
-    config = str(config).replace("\\n", "\n")
-    config = config.replace(
-        "<key>", "route-nopull\nroute " + parse_ip_range(K8S_IP_RANGE) + "\n\n<key>"
-    )  # add IP route to the config
-    config = config.replace("redirect-gateway def1", "")  # remove the rule that replaces all routes with VPN
-    config = config + "\ncomp-lzo yes\nallow-compression yes"
-
-    with get_connection() as conn, conn.cursor() as cursor:
-        teamid = get_team_id(teamname)
-        cursor.execute(
-            "INSERT INTO vpn_storage(teamID,username,config) VALUES (%s, %s, %s)", (teamid, username, config)
-        )
-        conn.commit()
+    statements = user_vpn_config_statements(teamname, username, config)
+    if len(statements) == 1:
+        with get_cursor() as cursor:
+            cursor.execute(*statements[0])
+        return
+    with transaction() as cursor:
+        for statement, params in statements:
+            cursor.execute(statement, params)
+
+
+def split_user_vpn_configs() -> tuple[int, int]:
+    """Move configs stored whole into team and user material, returns the number split and left whole"""
+    with get_cursor() as cursor:
+        cursor.execute(queries.UNSPLIT_USER_VPN_CONFIGS)
+        rows = cursor.fetchall()
+
+    split, skipped = 0, 0
+    for team_id, username, config in rows:
+        unapplied = vpnconfig.unapply_client_options(str(config or ""))
+        material = None if unapplied is None else vpnconfig.split(unapplied)
+        if material is None:
+            skipped += 1
+            continue
+        team, user = material
+        team_values = (team.options, team.ca, team.tls_auth)
+        with transaction() as cursor:
+            cursor.execute(queries.INSERT_TEAM_MATERIAL, (team_id, *team_values))
+            cursor.execute(queries.TEAM_MATERIAL, (team_id,))
+            if tuple(cursor.fetchall()[0]) != team_values:
+                skipped += 1  # does not match the material of the other users of the team
+                continue
+            cursor.execute(queries.SPLIT_USER_VPN_CONFIG, (user.cert, user.key, team_id, username))
+        split += 1
+    return split, skipped
 
 
 def get_team_id(teamname: str) -> str:
-    with get_connection() as conn, conn.cursor() as cursor:
-        # FIXME: Add limit=1 to the query to avoid fetching unnecessary rows
-        # TODO: implement sanitization here
-        cursor.execute("SELECT teamID FROM teams WHERE name=%s", (teamname,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.TEAM_ID, (teamname,))
         rows = cursor.fetchall()
 
     if len(rows) == 0 or len(rows[0]) == 0:
@@ -166,10 +418,8 @@ def get_team_id(teamname: str) -> str:
 
 
 def get_team_port(teamname: str) -> str:
-    teamID = get_team_id(teamname)
-    with get_connection() as conn, conn.cursor() as cursor:
-        # FIXME: Add limit=1 to the query to avoid fetching unnecessary rows
-        cursor.execute("SELECT port FROM vpn_map WHERE teamID=%s", (teamID,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.TEAM_PORT, (teamname,))
         rows = cursor.fetchall()
 
     if len(rows) == 0 or len(rows[0]) == 0:
@@ -179,9 +429,8 @@ def get_team_port(teamname: str) -> str:
 
 
 def get_port_team(port: int) -> str:
-    with get_connection() as conn, conn.cursor() as cursor:
-        # FIXME: Add limit=1 to the query to avoid fetching unnecessary rows
-        cursor.execute("SELECT teamID FROM vpn_map WHERE port=%s", (port,))
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.PORT_TEAM, (port,))
         rows = cursor.fetchall()
 
     if len(rows) == 0 or len(rows[0]) == 0:
@@ -191,40 +440,54 @@ def get_port_team(port: int) -> str:
 
 
 def get_user_vpn_config(teamname: str, username: str) -> str:
-    teamID = get_team_id(teamname)
-    with get_connection() as conn, conn.cursor() as cursor:
-        # FIXME: Add limit=1 to the query to avoid fetching unnecessary rows
-        cursor.execute("SELECT config FROM vpn_storage WHERE teamID=%s and username=%s", (teamID, username))
+    """The rendered client config, only the material versions are read if it is in the render cache"""
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.USER_VPN_CONFIG_VERSION, (teamname, username))
+        rows = cursor.fetchall()
+        if len(rows) == 0:
+            return "null"
+        team_id, storage_id, user_version, team_version = rows[0]
+        key = (team_id, storage_id, user_version, team_version)
+        config = vpnconfig.cached(key)
+        if config is not None:
+            return config
+        cursor.execute(queries.USER_VPN_CONFIG, (team_id, username))
         rows = cursor.fetchall()
 
-    if len(rows) == 0 or len(rows[0]) == 0:
+    if len(rows) == 0:
         return "null"
-
-    return rows[0][0]
+    config = vpnconfig.from_row(rows[0])
+    vpnconfig.remember(key, config)
+    return config
 
 
 def get_last_port() -> int:
-    with get_connection() as conn, conn.cursor() as cursor:
-        # FIXME: Add limit=1 to the query to avoid fetching unnecessary rows
-        cursor.execute("SELECT port FROM vpn_map ORDER BY port DESC")
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.LAST_PORT)
         rows = cursor.fetchall()
 
     return int(rows[0][0])
 
 
 def delete_team_and_vpn(teamname: str) -> None:
-    teamID = get_team_id(teamname)
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("DELETE from register_status WHERE name = %s", (teamname,))
-        cursor.execute("DELETE FROM vpn_map WHERE teamID = %s", (teamID,))
-        cursor.execute("DELETE FROM vpn_storage WHERE teamID = %s", (teamID,))
-        cursor.execute("DELETE from teams WHERE teamID = %s", (teamID,))
-        conn.commit()
+    with transaction() as cursor:
+        cursor.execute(queries.DELETE_TEAM_REGISTRATION, (teamname,))
+        cursor.execute(queries.DELETE_TEAM, (teamname,))
+
+
+def delete_user_vpn_config(teamname: str, username: str) -> None:
+    with transaction() as cursor:
+        cursor.execute(queries.DELETE_USER_VPN_CONFIG, (teamname, username))
+        cursor.execute(queries.DELETE_USER_REGISTRATION, (teamname, username))
+
+
+# Registration progress is kept in registration_state, one row per (team, user) and one row with
+# user "" for the team. The team row holds the highest state reached by any of its members.
 
 
 def get_registration_progress_team(teamname: str) -> int:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute("SELECT state FROM register_status WHERE name='" + teamname + "' ORDER BY state DESC")
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.REGISTRATION_PROGRESS_TEAM, (teamname,))
         rows = cursor.fetchall()
 
     if len(rows) == 0 or len(rows[0]) == 0:
@@ -233,11 +496,8 @@ def get_registration_progress_team(teamname: str) -> int:
 
 
 def get_registration_progress_user(teamname: str, username: str) -> str:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute(
-            "SELECT state FROM register_status WHERE name=%s and user=%s ORDER BY state DESC",
-            (teamname, username),
-        )
+    with get_cursor(read=True) as cursor:
+        cursor.execute(queries.REGISTRATION_PROGRESS_USER, (teamname, username))
         rows = cursor.fetchall()
     if len(rows) == 0 or len(rows[0]) == 0:
         return "null"
@@ -245,9 +505,42 @@ def get_registration_progress_user(teamname: str, username: str) -> str:
 
 
 def set_registration_progress_team(teamname: str, username: str, status: int) -> None:
-    with get_connection() as conn, conn.cursor() as cursor:
-        cursor.execute(
-            "INSERT INTO register_status (name, user, state, timestamp) VALUES (%s, %s, %s, %s)",
-            (teamname, username, status, getUTCasStr()),
-        )
-        conn.commit()
+    """Raise the progress of the user and of the team to `status`, progress never goes backwards"""
+    timestamp = getUTCasStr()
+    rows = [(teamname, "", status, timestamp)]
+    if username != "":
+        rows.append((teamname, username, status, timestamp))
+    upsert = queries.raise_registration_progress(len(rows))
+    params = tuple(value for row in rows for value in row)
+
+    if not DB_REGISTRATION_HISTORY:
+        with get_cursor() as cursor:
+            cursor.execute(upsert, params)
+        return
+    with transaction() as cursor:
+        cursor.execute(upsert, params)
+        cursor.execute(queries.LOG_REGISTRATION_PROGRESS, (teamname, username, status, timestamp))
+
+
+def compare_and_set_registration_progress(
+    teamname: str, username: str, expected: int | None, status: int
+) -> bool:
+    """Atomically set the progress to `status` if it is `expected` (None: not started), returns if it did"""
+    timestamp = getUTCasStr()
+    with transaction() if DB_REGISTRATION_HISTORY else get_cursor() as cursor:
+        if expected is None:
+            cursor.execute(queries.INSERT_REGISTRATION_PROGRESS, (teamname, username, status, timestamp))
+        else:
+            cursor.execute(
+                queries.COMPARE_AND_SET_REGISTRATION_PROGRESS,
+                (status, timestamp, teamname, username, expected),
+            )
+        updated = cursor.rowcount == 1
+        if updated and DB_REGISTRATION_HISTORY:
+            cursor.execute(queries.LOG_REGISTRATION_PROGRESS, (teamname, username, status, timestamp))
+    return updated
+
+
+def claim_team_registration(teamname: str) -> bool:
+    """Mark the team as being registered. Returns False if its registration was already started."""
+    return compare_and_set_registration_progress(teamname, "", None, 1)
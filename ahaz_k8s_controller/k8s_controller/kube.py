@@ -0,0 +1,143 @@
+import logging
+import os
+import socket
+from threading import Lock
+
+from kubernetes import config
+from kubernetes.client import (
+    ApiClient,
+    Configuration,
+    CoreV1Api,
+    NetworkingV1Api,
+    V1ConfigMap,
+    V1NetworkPolicy,
+    V1Pod,
+    V1Service,
+)
+from urllib3.connection import HTTPConnection
+
+logger = logging.getLogger()
+
+# Connections to the API server kept open by the shared client, per host
+K8S_CONNECTION_POOL_SIZE = int(os.getenv("K8S_CONNECTION_POOL_SIZE", "32"))
+# Seconds of idleness after which TCP keepalive probes are sent on API server connections, 0 disables them
+K8S_TCP_KEEPALIVE = int(os.getenv("K8S_TCP_KEEPALIVE", "30"))
+# Owner of every field the controller applies, see apply()
+FIELD_MANAGER = "ahaz-controller"
+
+Manifest = V1ConfigMap | V1NetworkPolicy | V1Pod | V1Service
+
+
+# Quick heuristic to determine if the kube folder has a valid kubeconfig file
+# or merely a service account token.
+def is_valid_kubeconfig(kube_folder: str) -> bool:
+    # Check for the presence of a valid kubeconfig file
+    kubeconfig_path = os.path.join(kube_folder, "config")
+    if os.path.exists(kubeconfig_path):
+        return True
+
+    # Check for the presence of a service account token
+    token_path = os.path.join(kube_folder, "token")
+    if os.path.exists(token_path):
+        return True
+
+    return False
+
+
+def load_kube_config():
+    # Load kube config based on environment
+    if is_valid_kubeconfig("/.kube"):
+        config.load_kube_config(config_file="/.kube/config")
+    else:
+        config.load_incluster_config()
+
+
+_kube_config_loaded = False
+
+
+def ensure_kube_config_loaded():
+    global _kube_config_loaded
+    if not _kube_config_loaded:
+        try:
+            load_kube_config()
+        except Exception as e:
+            logger.error(f"Failed to load Kubernetes configuration: {e}")
+            raise e
+
+        _kube_config_loaded = True
+
+
+def keepalive_socket_options(idle: int) -> list[tuple[int, int, int]]:
+    options = [*HTTPConnection.default_socket_options, (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Not every platform allows tuning the probes
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", max(idle // 3, 1)), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+def new_api_client(
+    configuration: Configuration | None = None,
+    pool_size: int = K8S_CONNECTION_POOL_SIZE,
+    keepalive: int = K8S_TCP_KEEPALIVE,
+) -> ApiClient:
+    """An ApiClient with its own connection pool, for the default configuration unless one is given"""
+    if configuration is None:
+        ensure_kube_config_loaded()
+        configuration = Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = pool_size
+    if keepalive > 0:
+        configuration.socket_options = keepalive_socket_options(keepalive)
+    return ApiClient(configuration)
+
+
+_api_client: ApiClient | None = None
+_api_client_lock = Lock()
+
+
+def get_api_client() -> ApiClient:
+    """The ApiClient shared by the whole process, whose connections are reused by every thread"""
+    global _api_client
+    if _api_client is None:
+        with _api_client_lock:
+            if _api_client is None:
+                _api_client = new_api_client()
+                logger.debug(
+                    f"Created shared Kubernetes API client with {K8S_CONNECTION_POOL_SIZE} connections"
+                )
+    return _api_client
+
+
+# The API objects only hold the client, creating one per call is cheap. Never pass a shared one to
+# kubernetes.stream.stream(), which swaps out the client's call_api while the stream is open.
+def core_api() -> CoreV1Api:
+    return CoreV1Api(get_api_client())
+
+
+def networking_api() -> NetworkingV1Api:
+    return NetworkingV1Api(get_api_client())
+
+
+# kind -> API object and the patch method which applies it
+_APPLY_METHODS = {
+    "ConfigMap": (core_api, "patch_namespaced_config_map"),
+    "NetworkPolicy": (networking_api, "patch_namespaced_network_policy"),
+    "Pod": (core_api, "patch_namespaced_pod"),
+    "Service": (core_api, "patch_namespaced_service"),
+}
+
+
+def apply(namespace: str, manifest: Manifest) -> Manifest:
+    """Server-side apply `manifest` in `namespace` as FIELD_MANAGER, returns the object as stored
+
+    Creates the object if it does not exist and leaves it unchanged if it already matches, so applying
+    the same manifest again never conflicts. Fields claimed by other managers are taken over."""
+    api, method = _APPLY_METHODS[manifest.kind]
+    return getattr(api(), method)(
+        name=manifest.metadata.name,
+        namespace=namespace,
+        body=manifest,
+        field_manager=FIELD_MANAGER,
+        force=True,
+        _content_type="application/apply-patch+yaml",
+    )  # type: ignore
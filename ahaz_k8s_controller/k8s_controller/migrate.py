@@ -0,0 +1,103 @@
+import argparse
+import logging
+import re
+from os import getenv, listdir, path
+
+import dboperator
+
+# Versioned schema migrations for the controller database.
+#
+# Migrations are the numbered <version>_<name>.sql files in migrations/, applied
+# in order and recorded in schema_migrations. Every worker runs upgrade() on
+# startup, a MySQL named lock makes sure only one of them migrates at a time.
+# MySQL commits DDL implicitly, so a migration failing halfway is not rolled
+# back and has to be finished by hand before the controller can start.
+
+logger = logging.getLogger()
+
+MIGRATIONS_DIR = path.join(path.dirname(path.realpath(__file__)), "migrations")
+MIGRATION_FILE_PATTERN = re.compile(r"^(\d+)_(\w+)\.sql$")
+LOCK_NAME = "ahaz_schema_migrations"
+LOCK_TIMEOUT = 300
+
+# "startup" to upgrade the schema when the server starts, "manual" to only do so with `python migrate.py`
+DB_MIGRATE = getenv("DB_MIGRATE", "startup")
+
+
+def available_migrations() -> list[tuple[int, str, str]]:
+    """(version, name, filename) of every migration, in the order they are applied"""
+    migrations = []
+    for filename in listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE_PATTERN.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+
+def split_statements(sql: str) -> list[str]:
+    lines = [line for line in sql.splitlines() if not line.lstrip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def applied_versions(cursor) -> set[int]:
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations("
+        "version int NOT NULL PRIMARY KEY, name varchar(255) NOT NULL, applied_at bigint NOT NULL)"
+    )
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {int(row[0]) for row in cursor.fetchall()}
+
+
+def upgrade(target: int | None = None) -> list[int]:
+    """Apply all pending migrations up to and including `target`, returns the versions applied"""
+    applied_now = []
+    with dboperator.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+        if cursor.fetchall()[0][0] != 1:  # type: ignore
+            raise TimeoutError(f"could not acquire the {LOCK_NAME} lock within {LOCK_TIMEOUT}s")
+        try:
+            applied = applied_versions(cursor)
+            for version, name, filename in available_migrations():
+                if version in applied or (target is not None and version > target):
+                    continue
+                logger.info(f"Applying database migration {version:04d}_{name}")
+                with open(filename, "r", encoding="utf-8") as f:
+                    statements = split_statements(f.read())
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)",
+                    (version, name, dboperator.getUTCasStr()),
+                )
+                conn.commit()
+                applied_now.append(version)
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            cursor.fetchall()
+
+    if applied_now:
+        logger.info(f"Database schema upgraded to version {applied_now[-1]}")
+    else:
+        logger.debug("Database schema is up to date")
+    return applied_now
+
+
+def status() -> list[tuple[int, str, bool]]:
+    """(version, name, applied) of every migration"""
+    with dboperator.get_connection() as conn, conn.cursor() as cursor:
+        applied = applied_versions(cursor)
+        conn.commit()
+    return [(version, name, version in applied) for version, name, _ in available_migrations()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the controller database schema")
+    parser.add_argument("command", choices=("upgrade", "status"), nargs="?", default="upgrade")
+    parser.add_argument("--target", type=int, help="upgrade only up to this version")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getenv("LOGLEVEL", "INFO").upper())
+    if args.command == "upgrade":
+        upgrade(args.target)
+    for version, name, applied in status():
+        print(f"{version:04d}_{name}: {'applied' if applied else 'pending'}")
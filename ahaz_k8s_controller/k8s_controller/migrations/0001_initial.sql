@@ -0,0 +1,11 @@
+-- Schema as originally created by ahaz_data/mysqldb/init.sh. IF NOT EXISTS
+-- lets databases created by that script be adopted as they are.
+
+CREATE TABLE IF NOT EXISTS teams(name varchar(255), teamID INT NOT NULL AUTO_INCREMENT, PRIMARY KEY (teamID));
+CREATE TABLE IF NOT EXISTS vpn_map(teamID int, port int);
+CREATE TABLE IF NOT EXISTS vpn_storage(teamID int, username varchar(255), config varchar(8000));
+CREATE TABLE IF NOT EXISTS challenges(name varchar(255), ctfd_desc varchar(1024), ctfd_score int, ctfd_type varchar(255));
+CREATE TABLE IF NOT EXISTS pods(name varchar(255), k8s_name varchar(50), image varchar(1024), ram varchar(32), cpu int, visible_to_user bool);
+CREATE TABLE IF NOT EXISTS net_rules(name varchar(255), netname varchar(255), k8s_name varchar(50));
+CREATE TABLE IF NOT EXISTS env_vars(name varchar(255), k8s_name varchar(50), env_var_name varchar(1024), env_var_value varchar(1024));
+CREATE TABLE IF NOT EXISTS register_status(name varchar(255), user varchar(255), state int, timestamp bigint);
@@ -0,0 +1,74 @@
+-- Primary keys, unique constraints and indexes for the lookups done by dboperator.
+-- Duplicate rows written by older versions are removed first, keeping the oldest one,
+-- which is also the one the lookups used to return.
+
+-- teams: looked up by name
+DELETE t1 FROM teams t1 JOIN teams t2 ON t1.name = t2.name AND t1.teamID > t2.teamID;
+DELETE FROM teams WHERE name IS NULL;
+ALTER TABLE teams MODIFY name varchar(255) NOT NULL, ADD UNIQUE KEY teams_name (name);
+
+-- vpn_map: one port per team, looked up by team and by port
+DELETE FROM vpn_map WHERE teamID IS NULL OR port IS NULL;
+ALTER TABLE vpn_map ADD COLUMN dedupe_id INT NOT NULL AUTO_INCREMENT UNIQUE;
+DELETE m1 FROM vpn_map m1 JOIN vpn_map m2 ON m1.teamID = m2.teamID AND m1.dedupe_id > m2.dedupe_id;
+DELETE m1 FROM vpn_map m1 JOIN vpn_map m2 ON m1.port = m2.port AND m1.dedupe_id > m2.dedupe_id;
+ALTER TABLE vpn_map
+    DROP COLUMN dedupe_id,
+    MODIFY teamID int NOT NULL,
+    MODIFY port int NOT NULL,
+    ADD PRIMARY KEY (teamID),
+    ADD UNIQUE KEY vpn_map_port (port);
+
+-- vpn_storage: one config per user of a team
+DELETE FROM vpn_storage WHERE teamID IS NULL OR username IS NULL;
+ALTER TABLE vpn_storage ADD COLUMN dedupe_id INT NOT NULL AUTO_INCREMENT UNIQUE;
+DELETE s1 FROM vpn_storage s1 JOIN vpn_storage s2
+    ON s1.teamID = s2.teamID AND s1.username = s2.username AND s1.dedupe_id > s2.dedupe_id;
+ALTER TABLE vpn_storage
+    DROP COLUMN dedupe_id,
+    MODIFY teamID int NOT NULL,
+    MODIFY username varchar(255) NOT NULL,
+    ADD PRIMARY KEY (teamID, username);
+
+-- challenges: looked up by name
+DELETE FROM challenges WHERE name IS NULL;
+ALTER TABLE challenges ADD COLUMN dedupe_id INT NOT NULL AUTO_INCREMENT UNIQUE;
+DELETE c1 FROM challenges c1 JOIN challenges c2 ON c1.name = c2.name AND c1.dedupe_id > c2.dedupe_id;
+ALTER TABLE challenges DROP COLUMN dedupe_id, MODIFY name varchar(255) NOT NULL, ADD PRIMARY KEY (name);
+
+-- pods: looked up by challenge name and by k8s_name
+DELETE FROM pods WHERE name IS NULL OR k8s_name IS NULL;
+ALTER TABLE pods ADD COLUMN dedupe_id INT NOT NULL AUTO_INCREMENT UNIQUE;
+DELETE p1 FROM pods p1 JOIN pods p2
+    ON p1.name = p2.name AND p1.k8s_name = p2.k8s_name AND p1.dedupe_id > p2.dedupe_id;
+ALTER TABLE pods
+    DROP COLUMN dedupe_id,
+    MODIFY name varchar(255) NOT NULL,
+    MODIFY k8s_name varchar(50) NOT NULL,
+    ADD PRIMARY KEY (name, k8s_name),
+    ADD KEY pods_k8s_name (k8s_name);
+
+-- net_rules: looked up by challenge and network, and by k8s_name
+DELETE FROM net_rules WHERE name IS NULL OR netname IS NULL OR k8s_name IS NULL;
+ALTER TABLE net_rules ADD COLUMN dedupe_id INT NOT NULL AUTO_INCREMENT UNIQUE;
+DELETE n1 FROM net_rules n1 JOIN net_rules n2
+    ON n1.name = n2.name AND n1.netname = n2.netname AND n1.k8s_name = n2.k8s_name
+    AND n1.dedupe_id > n2.dedupe_id;
+ALTER TABLE net_rules
+    DROP COLUMN dedupe_id,
+    MODIFY name varchar(255) NOT NULL,
+    MODIFY netname varchar(255) NOT NULL,
+    MODIFY k8s_name varchar(50) NOT NULL,
+    ADD PRIMARY KEY (name, netname, k8s_name),
+    ADD KEY net_rules_k8s_name (k8s_name);
+
+-- env_vars: looked up by k8s_name
+ALTER TABLE env_vars
+    ADD COLUMN id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    ADD KEY env_vars_k8s_name (k8s_name);
+
+-- register_status: progress log, looked up by team and user, highest state first
+ALTER TABLE register_status
+    ADD COLUMN id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    ADD KEY register_status_name_user_state (name, user, state),
+    ADD KEY register_status_name_state (name, state);
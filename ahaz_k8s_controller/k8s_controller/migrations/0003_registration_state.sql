@@ -0,0 +1,24 @@
+-- Current registration progress, one row per team member plus one row with user '' for the
+-- team itself. register_status is kept as an optional append-only log.
+
+CREATE TABLE registration_state(
+    name varchar(255) NOT NULL,
+    user varchar(255) NOT NULL,
+    state int NOT NULL,
+    updated_at bigint NOT NULL,
+    PRIMARY KEY (name, user)
+);
+
+-- Progress used to be the highest state logged, for the team across all of its members
+INSERT INTO registration_state (name, user, state, updated_at)
+    SELECT name, COALESCE(user, ''), MAX(state), COALESCE(MAX(timestamp), 0)
+    FROM register_status WHERE name IS NOT NULL AND state IS NOT NULL
+    GROUP BY name, COALESCE(user, '');
+
+INSERT INTO registration_state (name, user, state, updated_at)
+    SELECT * FROM (
+        SELECT name, '' AS user, MAX(state) AS team_state, COALESCE(MAX(timestamp), 0) AS team_updated_at
+        FROM register_status WHERE name IS NOT NULL AND state IS NOT NULL
+        GROUP BY name
+    ) AS team_progress
+    ON DUPLICATE KEY UPDATE state = team_state, updated_at = team_updated_at;
@@ -0,0 +1,10 @@
+-- Version of the challenge catalog (challenges, pods, net_rules and env_vars). Controllers cache the
+-- catalog in memory and reload it when this changes, so it has to be bumped after editing those tables.
+
+CREATE TABLE catalog_version(
+    id tinyint NOT NULL,
+    version bigint NOT NULL,
+    PRIMARY KEY (id)
+);
+
+INSERT INTO catalog_version (id, version) VALUES (1, 1);
@@ -0,0 +1,17 @@
+-- Client VPN configs stored as the material shared by the team plus each user's certificate and key,
+-- see vpnconfig.py. Existing configs stay in vpn_storage.config until split with `python vpnconfig.py split`.
+-- The versions are raised on every change and key the in-memory render cache.
+
+CREATE TABLE vpn_team_material(
+    teamID int NOT NULL,
+    options text NOT NULL,
+    ca text NOT NULL,
+    tls_auth text NOT NULL,
+    version int NOT NULL DEFAULT 1,
+    PRIMARY KEY (teamID)
+);
+
+ALTER TABLE vpn_storage
+    ADD COLUMN cert text NULL,
+    ADD COLUMN `key` text NULL,
+    ADD COLUMN version int NOT NULL DEFAULT 1;
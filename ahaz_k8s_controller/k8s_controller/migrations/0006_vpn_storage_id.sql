@@ -0,0 +1,4 @@
+-- Identifies a user's vpn_storage row for the render cache. Unlike (teamID, username) and version, it is
+-- never reused, so a config rendered before the user was revoked and registered again is never served.
+
+ALTER TABLE vpn_storage ADD COLUMN id bigint NOT NULL AUTO_INCREMENT UNIQUE;
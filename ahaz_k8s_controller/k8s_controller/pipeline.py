@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+# Runs blocking steps as a dependency graph.
+#
+# Each step runs in a thread as soon as the steps it comes after have finished,
+# so independent steps (e.g. certificate generation and namespace creation)
+# overlap. Steps get the results of the steps finished so far, keyed by name.
+# The first failing step fails the whole run; steps which have not started yet
+# are not started anymore.
+
+logger = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class Step:
+    name: str
+    run: Callable[[dict[str, Any]], Any]
+    after: tuple[str, ...] = ()
+
+
+async def run_steps(
+    steps: list[Step], on_done: Callable[[str], Awaitable[None]] | None = None
+) -> dict[str, Any]:
+    """Run `steps`, each listed after the steps it depends on, returns the result of every step"""
+    results: dict[str, Any] = {}
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def run_step(step: Step) -> None:
+        await asyncio.gather(*(tasks[name] for name in step.after))
+        start = time.perf_counter()
+        results[step.name] = await asyncio.to_thread(step.run, results)
+        logger.debug(f"Step {step.name} finished in {time.perf_counter() - start:.2f}s")
+        if on_done is not None:
+            await on_done(step.name)
+
+    for step in steps:
+        unknown = [name for name in step.after if name not in tasks]
+        if unknown:
+            raise ValueError(f"step {step.name} comes after steps not listed before it: {', '.join(unknown)}")
+        tasks[step.name] = asyncio.ensure_future(run_step(step))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return results
+
+
+class Milestones:
+    """Reports numbered milestones in order, each once all of its steps and the earlier milestones are done"""
+
+    def __init__(
+        self, milestones: list[tuple[int, tuple[str, ...]]], report: Callable[[int], Awaitable[None]]
+    ):
+        self.pending = list(milestones)
+        self.report = report
+        self.done: set[str] = set()
+
+    async def step_done(self, name: str) -> None:
+        self.done.add(name)
+        while self.pending and self.done.issuperset(self.pending[0][1]):
+            milestone, _ = self.pending.pop(0)
+            await self.report(milestone)
@@ -0,0 +1,326 @@
+import datetime
+import fcntl
+import logging
+import os
+import re
+import secrets
+from contextlib import contextmanager
+from os import makedirs, path
+from shutil import rmtree
+from typing import Iterator
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+# Native replacement for the easyrsa + openvpn --genkey subprocess chain.
+# Produces the same pki/ layout that easyrsa does, so everything reading the
+# team directory (ConfigMap creation, client config assembly) keeps working.
+
+logger = logging.getLogger()
+
+CURVE = ec.SECP384R1()
+DIGEST = hashes.SHA512()
+# Same defaults as EasyRSA 3.1.0
+CA_VALIDITY_DAYS = 3650
+CERT_VALIDITY_DAYS = 825
+TA_KEY_BYTES = 256
+# Pre-generated client keys not yet handed out to a user, one stock/<id> directory per key. The
+# certificate is only issued when the key is claimed, so that its CN is the user's.
+STOCK_DIR = "stock"
+STOCK_KEY = "client.key"
+# Stocked keys are written under stock/.building-<id> and renamed to stock/<id> once complete
+STOCK_BUILDING_PREFIX = ".building-"
+# Taken with flock() around every change of index.txt, which is replaced as a whole on revoke
+INDEX_LOCK = "index.txt.lock"
+# OpenVPN rejects every client once the CRL expires, so keep it valid as long as the CA
+CRL_VALIDITY_DAYS = CA_VALIDITY_DAYS
+INDEX_TIME_FORMAT = "%y%m%d%H%M%SZ"
+
+PEM_CERT_PATTERN = re.compile(r"-----BEGIN CERTIFICATE-----\r?\n.+?\r?\n-----END CERTIFICATE-----", re.S)
+
+VARS_CONTENT = """# Easy-RSA default variables file
+set_var EASYRSA_ALGO "ec"
+set_var EASYRSA_CURVE "secp384r1"
+set_var EASYRSA_DIGEST "sha512"
+"""
+
+
+def gen_key() -> ec.EllipticCurvePrivateKey:
+    return ec.generate_private_key(CURVE)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _subject(cn: str) -> x509.Name:
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+
+
+def build_ca(cn: str) -> tuple[ec.EllipticCurvePrivateKey, x509.Certificate]:
+    """Build a self-signed CA equivalent to `easyrsa build-ca nopass`"""
+    key = gen_key()
+    now = _now()
+    ski = x509.SubjectKeyIdentifier.from_public_key(key.public_key())
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(_subject(cn))
+        .issuer_name(_subject(cn))
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=CA_VALIDITY_DAYS))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(ski, critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski), critical=False)
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=False,
+                content_commitment=False,
+                key_encipherment=False,
+                data_encipherment=False,
+                key_agreement=False,
+                key_cert_sign=True,
+                crl_sign=True,
+                encipher_only=False,
+                decipher_only=False,
+            ),
+            critical=False,
+        )
+        .sign(key, DIGEST)
+    )
+    return key, cert
+
+
+def build_cert(
+    ca_key: ec.EllipticCurvePrivateKey,
+    ca_cert: x509.Certificate,
+    cn: str,
+    server: bool,
+    key: ec.EllipticCurvePrivateKey | None = None,
+) -> tuple[ec.EllipticCurvePrivateKey, x509.Certificate]:
+    """Build a leaf certificate equivalent to `easyrsa build-{server,client}-full <cn> nopass`,
+    for `key` if given, otherwise for a new key"""
+    key = key or gen_key()
+    now = _now()
+    usage = ExtendedKeyUsageOID.SERVER_AUTH if server else ExtendedKeyUsageOID.CLIENT_AUTH
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(_subject(cn))
+        .issuer_name(ca_cert.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=CERT_VALIDITY_DAYS))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False
+        )
+        .add_extension(x509.ExtendedKeyUsage([usage]), critical=False)
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=True,
+                content_commitment=False,
+                key_encipherment=server,
+                data_encipherment=False,
+                key_agreement=False,
+                key_cert_sign=False,
+                crl_sign=False,
+                encipher_only=False,
+                decipher_only=False,
+            ),
+            critical=False,
+        )
+    )
+    if server:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(cn)]), critical=False)
+    return key, builder.sign(ca_key, DIGEST)
+
+
+def gen_ta_key() -> str:
+    """Generate an OpenVPN static key, the same format as `openvpn --genkey secret`"""
+    hexkey = secrets.token_bytes(TA_KEY_BYTES).hex()
+    lines = [hexkey[i : i + 32] for i in range(0, len(hexkey), 32)]
+    return (
+        "#\n# 2048 bit OpenVPN static key\n#\n-----BEGIN OpenVPN Static key V1-----\n"
+        + "\n".join(lines)
+        + "\n-----END OpenVPN Static key V1-----\n"
+    )
+
+
+def normalise_pem(content: str) -> str:
+    """In-process equivalent of `openssl x509 -in <file>`: strip the text dump easyrsa
+    prepends to issued certificates and return only the PEM block"""
+    match = PEM_CERT_PATTERN.search(content)
+    if match is None:
+        raise ValueError("no PEM certificate found")
+    return match.group(0).replace("\r\n", "\n") + "\n"
+
+
+def key_to_pem(key: ec.EllipticCurvePrivateKey) -> bytes:
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+
+
+def cert_to_pem(cert: x509.Certificate) -> bytes:
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+
+def _write(filename: str, content: bytes, private: bool = False) -> None:
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600 if private else 0o644)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+
+
+def _serial_hex(serial: int) -> str:
+    serial_hex = format(serial, "X")
+    return "0" + serial_hex if len(serial_hex) % 2 else serial_hex
+
+
+def _index_entry(cert: x509.Certificate, cn: str) -> str:
+    # OpenSSL CA database format, as maintained by easyrsa
+    expiry = cert.not_valid_after_utc.strftime(INDEX_TIME_FORMAT)
+    return f"V\t{expiry}\t\t{_serial_hex(cert.serial_number)}\tunknown\t/CN={cn}\n"
+
+
+@contextmanager
+def index_lock(pki_dir: str) -> Iterator[None]:
+    """Serialise changes of index.txt between threads and processes"""
+    with open(path.join(pki_dir, INDEX_LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _append_index(pki_dir: str, cert: x509.Certificate, cn: str) -> None:
+    with index_lock(pki_dir), open(path.join(pki_dir, "index.txt"), "a", encoding="utf-8") as f:
+        f.write(_index_entry(cert, cn))
+
+
+def write_cert_pair(pki_dir: str, cn: str, key: ec.EllipticCurvePrivateKey, cert: x509.Certificate) -> None:
+    cert_path = path.join(pki_dir, "issued", f"{cn}.crt")
+    _write(cert_path, cert_to_pem(cert))
+    try:
+        _write(path.join(pki_dir, "private", f"{cn}.key"), key_to_pem(key), private=True)
+    except BaseException:
+        # Never leave a certificate without its key, the next attempt would find it and fail
+        os.remove(cert_path)
+        raise
+    _append_index(pki_dir, cert, cn)
+
+
+def load_ca(pki_dir: str) -> tuple[ec.EllipticCurvePrivateKey, x509.Certificate]:
+    with open(path.join(pki_dir, "private", "ca.key"), "rb") as f:
+        ca_key = serialization.load_pem_private_key(f.read(), password=None)
+    with open(path.join(pki_dir, "ca.crt"), "rb") as f:
+        ca_cert = x509.load_pem_x509_certificate(f.read())
+    return ca_key, ca_cert  # type: ignore
+
+
+def init_pki(directory: str, cn: str) -> None:
+    """Create <directory>/pki with a CA, a server certificate for `cn` and ta.key"""
+    pki_dir = path.join(directory, "pki")
+    for subdir in ("private", "issued", "reqs", STOCK_DIR):
+        makedirs(path.join(pki_dir, subdir))
+    with open(path.join(pki_dir, "vars"), "w", encoding="utf-8") as f:
+        f.write(VARS_CONTENT)
+    _write(path.join(pki_dir, "index.txt"), b"")
+
+    logger.info("Building certificiate authority (CA)")
+    ca_key, ca_cert = build_ca(f"ca.{cn}")
+    _write(path.join(pki_dir, "private", "ca.key"), key_to_pem(ca_key), private=True)
+    _write(path.join(pki_dir, "ca.crt"), cert_to_pem(ca_cert))
+
+    logger.info("Building server certificiate")
+    write_cert_pair(pki_dir, cn, *build_cert(ca_key, ca_cert, cn, server=True))
+
+    _write(path.join(pki_dir, "ta.key"), gen_ta_key().encode(), private=True)
+    gen_crl(pki_dir)
+
+
+def build_client_full(pki_dir: str, cn: str, key: ec.EllipticCurvePrivateKey | None = None) -> None:
+    """Issue a client certificate for `cn` signed by the CA in `pki_dir`, for `key` if given"""
+    ca_key, ca_cert = load_ca(pki_dir)
+    write_cert_pair(pki_dir, cn, *build_cert(ca_key, ca_cert, cn, server=False, key=key))
+
+
+def build_client_stock(pki_dir: str, stock_id: str) -> None:
+    """Generate a client key into stock/<stock_id>, which only appears once the key is written"""
+    building = path.join(pki_dir, STOCK_DIR, STOCK_BUILDING_PREFIX + stock_id)
+    makedirs(building)
+    try:
+        _write(path.join(building, STOCK_KEY), key_to_pem(gen_key()), private=True)
+        os.rename(building, path.join(pki_dir, STOCK_DIR, stock_id))
+    except BaseException:
+        rmtree(building, ignore_errors=True)
+        raise
+
+
+def load_key(filename: str) -> ec.EllipticCurvePrivateKey:
+    with open(filename, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), password=None)  # type: ignore
+
+
+def _read_index(pki_dir: str) -> list[list[str]]:
+    with open(path.join(pki_dir, "index.txt"), "r", encoding="utf-8") as f:
+        return [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+
+def revoke(pki_dir: str, cn: str) -> None:
+    """Mark the certificate issued to `cn` as revoked, equivalent to `easyrsa revoke <cn>`"""
+    cert_path = path.join(pki_dir, "issued", f"{cn}.crt")
+    with open(cert_path, "rb") as f:
+        serial = _serial_hex(x509.load_pem_x509_certificate(f.read()).serial_number)
+
+    with index_lock(pki_dir):
+        entries = _read_index(pki_dir)
+        for entry in entries:
+            if entry[0] == "V" and entry[3] == serial:
+                entry[0] = "R"
+                entry[2] = _now().strftime(INDEX_TIME_FORMAT)
+                break
+        else:
+            raise ValueError(f"no valid certificate with serial {serial} in index")
+
+        index_tmp = path.join(pki_dir, "index.txt.tmp")
+        with open(index_tmp, "w", encoding="utf-8") as f:
+            f.writelines("\t".join(entry) + "\n" for entry in entries)
+        os.replace(index_tmp, path.join(pki_dir, "index.txt"))
+
+    makedirs(path.join(pki_dir, "revoked"), exist_ok=True)
+    os.replace(cert_path, path.join(pki_dir, "revoked", f"{serial}.crt"))
+    key_path = path.join(pki_dir, "private", f"{cn}.key")
+    if path.exists(key_path):
+        os.remove(key_path)
+
+
+def gen_crl(pki_dir: str) -> str:
+    """Write pki/crl.pem listing every revoked certificate in the index, equivalent to `easyrsa gen-crl`"""
+    ca_key, ca_cert = load_ca(pki_dir)
+    now = _now()
+    builder = (
+        x509.CertificateRevocationListBuilder()
+        .issuer_name(ca_cert.subject)
+        .last_update(now)
+        .next_update(now + datetime.timedelta(days=CRL_VALIDITY_DAYS))
+    )
+    for entry in _read_index(pki_dir):
+        if entry[0] != "R":
+            continue
+        revoked_at = datetime.datetime.strptime(entry[2].split(",")[0], INDEX_TIME_FORMAT)
+        builder = builder.add_revoked_certificate(
+            x509.RevokedCertificateBuilder()
+            .serial_number(int(entry[3], 16))
+            .revocation_date(revoked_at.replace(tzinfo=datetime.timezone.utc))
+            .build()
+        )
+    crl = builder.sign(ca_key, DIGEST).public_bytes(serialization.Encoding.PEM).decode()
+
+    crl_tmp = path.join(pki_dir, "crl.pem.tmp")
+    with open(crl_tmp, "w", encoding="utf-8") as f:
+        f.write(crl)
+    os.replace(crl_tmp, path.join(pki_dir, "crl.pem"))
+    return crl
@@ -0,0 +1,207 @@
+import base64
+import io
+import logging
+import os
+import tarfile
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from os import getenv, makedirs, path
+from shutil import rmtree
+from threading import Lock
+from typing import Iterator
+
+import kube
+from kube import ensure_kube_config_loaded
+from kubernetes.client import V1ObjectMeta, V1Secret
+from kubernetes.client.rest import ApiException
+
+# Storage backends for team PKI directories.
+#
+# Every operation on a team's PKI gets a local directory to work in through
+# create() or checkout(). The filesystem store hands out the directory under
+# CERT_DIR_CONTAINER itself. The secret store keeps each team's PKI as a
+# tarball in a Kubernetes Secret, so every controller replica can generate
+# and read any team's material, and unpacks it into a local scratch
+# directory for the duration of the operation.
+
+logger = logging.getLogger()
+
+SERVICE_ACCOUNT_NAMESPACE_FILE = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+
+# "filesystem" or "secret"
+PKI_STORE = getenv("PKI_STORE", "filesystem")
+
+
+def default_namespace() -> str:
+    if path.exists(SERVICE_ACCOUNT_NAMESPACE_FILE):
+        with open(SERVICE_ACCOUNT_NAMESPACE_FILE, "r") as f:
+            return f.read().strip()
+    return "default"
+
+
+K8S_PKI_NAMESPACE = getenv("K8S_PKI_NAMESPACE") or default_namespace()
+
+
+class StoreConflict(Exception):
+    """Raised when a team's PKI was modified concurrently by someone else; the operation should be retried"""
+
+
+class PKIStore(ABC):
+    @abstractmethod
+    def create(self, teamname: str) -> Iterator[str]:
+        """Context manager yielding an empty directory for a new team, saved when the block exits"""
+
+    @abstractmethod
+    def checkout(self, teamname: str, write: bool = False) -> Iterator[str]:
+        """Context manager yielding the team's directory, saved when the block exits if `write` is set"""
+
+    @abstractmethod
+    def delete(self, teamname: str) -> None:
+        """Remove the team's PKI"""
+
+
+class FilesystemStore(PKIStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def team_dir(self, teamname: str) -> str:
+        return self.root + teamname
+
+    @contextmanager
+    def create(self, teamname: str) -> Iterator[str]:
+        teamdir = self.team_dir(teamname)
+        makedirs(teamdir)
+        yield teamdir
+
+    @contextmanager
+    def checkout(self, teamname: str, write: bool = False) -> Iterator[str]:
+        teamdir = self.team_dir(teamname)
+        if not path.isdir(teamdir):
+            raise FileNotFoundError(f"no PKI directory for team {teamname}")
+        yield teamdir
+
+    def delete(self, teamname: str) -> None:
+        rmtree(self.team_dir(teamname))
+
+
+class SecretStore(PKIStore):
+    ARCHIVE_KEY = "pki.tar.gz"
+
+    def __init__(self, root: str, namespace: str):
+        self.namespace = namespace
+        # Kept next to the PKI pool so pooled bundles can be renamed into it
+        self.scratch = path.join(root, ".store-cache", str(os.getpid()))
+        self._versions: dict[str, str] = {}
+        self._locks: defaultdict[str, Lock] = defaultdict(Lock)
+
+    def secret_name(self, teamname: str) -> str:
+        return f"ahaz-pki-{teamname}"
+
+    def team_dir(self, teamname: str) -> str:
+        return path.join(self.scratch, teamname)
+
+    def _pack(self, teamdir: str) -> str:
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tarball:
+            tarball.add(teamdir, arcname=".")
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    def _unpack(self, data: str, teamdir: str) -> None:
+        rmtree(teamdir, ignore_errors=True)
+        makedirs(teamdir)
+        with tarfile.open(fileobj=io.BytesIO(base64.b64decode(data)), mode="r:gz") as tarball:
+            tarball.extractall(teamdir, filter="data")
+
+    @contextmanager
+    def create(self, teamname: str) -> Iterator[str]:
+        ensure_kube_config_loaded()
+        with self._locks[teamname]:
+            teamdir = self.team_dir(teamname)
+            rmtree(teamdir, ignore_errors=True)
+            makedirs(teamdir)
+            self._versions.pop(teamname, None)
+            yield teamdir
+
+            secret = V1Secret(
+                metadata=V1ObjectMeta(
+                    name=self.secret_name(teamname),
+                    labels={"app.kubernetes.io/managed-by": "ahaz", "team": teamname},
+                ),
+                data={self.ARCHIVE_KEY: self._pack(teamdir)},
+            )
+            try:
+                created: V1Secret = kube.core_api().create_namespaced_secret(self.namespace, secret)  # type: ignore
+            except ApiException as e:
+                rmtree(teamdir, ignore_errors=True)
+                if e.status == 409:
+                    raise FileExistsError(f"PKI for team {teamname} already exists") from e
+                raise e
+            self._versions[teamname] = created.metadata.resource_version  # type: ignore
+
+    @contextmanager
+    def checkout(self, teamname: str, write: bool = False) -> Iterator[str]:
+        ensure_kube_config_loaded()
+        core_api = kube.core_api()
+        with self._locks[teamname]:
+            try:
+                secret: V1Secret = core_api.read_namespaced_secret(self.secret_name(teamname), self.namespace)  # type: ignore
+            except ApiException as e:
+                if e.status == 404:
+                    raise FileNotFoundError(f"no PKI secret for team {teamname}") from e
+                raise e
+
+            teamdir = self.team_dir(teamname)
+            version = secret.metadata.resource_version  # type: ignore
+            if self._versions.get(teamname) != version or not path.isdir(teamdir):
+                self._unpack(secret.data[self.ARCHIVE_KEY], teamdir)  # type: ignore
+                self._versions[teamname] = version
+
+            try:
+                yield teamdir
+            except BaseException:
+                if write:
+                    # The local copy may be half modified, unpack it again next time
+                    self._versions.pop(teamname, None)
+                raise
+
+            if not write:
+                return
+            secret.data = {self.ARCHIVE_KEY: self._pack(teamdir)}
+            try:
+                # Carries the resource version we read, so a concurrent write makes this fail with 409
+                replaced: V1Secret = core_api.replace_namespaced_secret(
+                    self.secret_name(teamname), self.namespace, secret
+                )  # type: ignore
+            except ApiException as e:
+                self._versions.pop(teamname, None)
+                if e.status == 409:
+                    raise StoreConflict(f"PKI of team {teamname} was modified concurrently") from e
+                raise e
+            self._versions[teamname] = replaced.metadata.resource_version  # type: ignore
+
+    def delete(self, teamname: str) -> None:
+        ensure_kube_config_loaded()
+        with self._locks[teamname]:
+            try:
+                kube.core_api().delete_namespaced_secret(self.secret_name(teamname), self.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    raise e
+            self._versions.pop(teamname, None)
+            rmtree(self.team_dir(teamname), ignore_errors=True)
+
+
+_stores: dict[str, PKIStore] = {}
+_stores_lock = Lock()
+
+
+def get_store(root: str) -> PKIStore:
+    """The configured store for team PKI directories under `root`"""
+    with _stores_lock:
+        if root not in _stores:
+            if PKI_STORE == "secret":
+                _stores[root] = SecretStore(root, K8S_PKI_NAMESPACE)
+            else:
+                _stores[root] = FilesystemStore(root)
+        return _stores[root]
@@ -0,0 +1,130 @@
+import json
+import logging
+import time
+from os import getenv
+
+from events import RedisEventManager
+
+# Summaries of the pods of every team namespace, as returned by controller.summarise_pods_list.
+#
+# The watcher of the master process keeps them from pod events and mirrors every change into a Redis
+# hash per namespace, so that every worker can list a team's pods without asking the API server. Until
+# the watcher has loaded the current pods, or once it stopped, the view is not ready and callers list
+# the pods themselves. The ready mark expires after POD_VIEW_READY_TTL seconds unless the watcher keeps
+# refreshing it, so a view left behind by a watcher that died is not trusted for long.
+
+logger = logging.getLogger()
+
+VIEW_KEY_PREFIX = "ahaz_pods:"
+READY_KEY = "ahaz_pods_ready"
+POD_VIEW_READY_TTL = int(getenv("POD_VIEW_READY_TTL", "60"))
+# How often the watcher refreshes the ready mark
+READY_REFRESH_INTERVAL = POD_VIEW_READY_TTL / 3
+
+
+def view_key(namespace: str) -> str:
+    return VIEW_KEY_PREFIX + namespace
+
+
+class PodView:
+    def __init__(self, event_manager: RedisEventManager):
+        self.event_manager = event_manager
+        # namespace -> pod name -> JSON summary, only kept by the watcher
+        self.pods: dict[str, dict[str, str]] = {}
+        # Namespaces whose last change could not be written to Redis
+        self.unsynced: set[str] = set()
+        self.refreshed_at = 0.0
+
+    async def load(self, pods: dict[str, dict[str, dict]]) -> None:
+        """Replace the view with `pods`, namespace -> pod name -> summary, and mark it ready"""
+        redis = self.event_manager.redis_client
+        self.pods = {
+            namespace: {name: json.dumps(summary) for name, summary in summaries.items()}
+            for namespace, summaries in pods.items()
+            if summaries
+        }
+        stale = [key async for key in redis.scan_iter(match=view_key("*"))]
+        async with redis.pipeline(transaction=True) as pipe:
+            if stale:
+                pipe.delete(*stale)
+            for namespace, summaries in self.pods.items():
+                pipe.hset(view_key(namespace), mapping=summaries)  # type: ignore
+            pipe.set(READY_KEY, 1, ex=POD_VIEW_READY_TTL)
+            await pipe.execute()
+        self.unsynced.clear()
+        self.refreshed_at = time.monotonic()
+        logger.info(f"Loaded pod view of {sum(map(len, self.pods.values()))} pods")
+
+    def snapshot(self) -> dict[str, dict[str, dict]]:
+        """The summaries kept by the watcher, namespace -> pod name -> summary"""
+        return {
+            namespace: {name: json.loads(summary) for name, summary in summaries.items()}
+            for namespace, summaries in self.pods.items()
+        }
+
+    async def update(self, namespace: str, name: str, summary: dict | None) -> None:
+        """Set the summary of a pod, None removes it"""
+        summaries = self.pods.setdefault(namespace, {})
+        value = json.dumps(summary) if summary is not None else None
+        if summaries.get(name) == value and not self.unsynced:
+            # Most pod updates (conditions, resource versions) do not change the summary
+            if not summaries:
+                del self.pods[namespace]
+            return
+        if value is None:
+            summaries.pop(name, None)
+        else:
+            summaries[name] = value
+        if not summaries:
+            del self.pods[namespace]
+        self.unsynced.add(namespace)
+        await self._mirror()
+
+    async def _mirror(self) -> None:
+        """Write the unsynced namespaces to Redis, each one replaced as a whole"""
+        redis = self.event_manager.redis_client
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                for namespace in self.unsynced:
+                    pipe.delete(view_key(namespace))
+                    if namespace in self.pods:
+                        pipe.hset(view_key(namespace), mapping=self.pods[namespace])  # type: ignore
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error writing pod view of {', '.join(self.unsynced)} to Redis: {e}")
+            return
+        self.unsynced.clear()
+
+    async def keep_ready(self) -> None:
+        """Refresh the ready mark once every READY_REFRESH_INTERVAL, while every change is in Redis"""
+        if time.monotonic() - self.refreshed_at < READY_REFRESH_INTERVAL:
+            return
+        if self.unsynced:
+            await self._mirror()
+            if self.unsynced:
+                return  # let it expire, the view in Redis is out of date
+        try:
+            # Only extends a mark set by load(), the view is not ready before it
+            await self.event_manager.redis_client.set(READY_KEY, 1, ex=POD_VIEW_READY_TTL, xx=True)
+        except Exception as e:
+            logger.error(f"Error refreshing pod view ready mark: {e}")
+            return
+        self.refreshed_at = time.monotonic()
+
+    async def stop(self) -> None:
+        """Mark the view as not ready, so that workers stop relying on it"""
+        try:
+            await self.event_manager.redis_client.delete(READY_KEY)
+        except Exception as e:
+            logger.error(f"Error marking pod view as not ready: {e}")
+
+    async def get(self, namespace: str, show_invisible: bool) -> list[dict] | None:
+        """The pod summaries of `namespace` ordered by pod name, None if the view is not ready"""
+        async with self.event_manager.redis_client.pipeline(transaction=True) as pipe:
+            pipe.get(READY_KEY)
+            pipe.hgetall(view_key(namespace))
+            ready, pods = await pipe.execute()
+        if not ready:
+            return None
+        summaries = [json.loads(pods[name]) for name in sorted(pods)]
+        return [summary for summary in summaries if show_invisible or summary["visibleIP"] == 1]
@@ -0,0 +1,162 @@
+import logging
+from os import getenv
+from threading import Lock
+
+import dboperator
+import queries
+
+# VPN NodePort allocation.
+#
+# The ports of TEAM_PORT_RANGE_START..END, followed by the backup range, are
+# tracked in a bitmap with one bit per port. Each worker keeps its own bitmap,
+# loaded from vpn_map, and the unique key on vpn_map.port decides which worker
+# gets a port: a reservation that loses the race marks the port as taken and
+# moves on to the next free one. Ports freed by other workers are seen again
+# when the bitmap is reloaded, which happens whenever it looks full.
+
+logger = logging.getLogger()
+
+# 31200 is where ports were derived from team IDs before the bitmap, so that existing ports stay in range
+TEAM_PORT_RANGE_START = int(getenv("TEAM_PORT_RANGE_START", "31200"))
+TEAM_PORT_RANGE_END = int(getenv("TEAM_PORT_RANGE_END", "32767"))
+TEAM_BACKUP_PORT_RANGE_START = int(getenv("TEAM_BACKUP_PORT_RANGE_START", "30500"))
+TEAM_BACKUP_PORT_RANGE_END = int(getenv("TEAM_BACKUP_PORT_RANGE_END", "30999"))
+
+
+class PortBitmap:
+    """Free/used bit per port of the given inclusive ranges, handed out in range order"""
+
+    def __init__(self, ranges: list[tuple[int, int]]):
+        self.ranges = [(start, end) for start, end in ranges if start <= end]
+        self.size = sum(end - start + 1 for start, end in self.ranges)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.used = 0
+        # No free port below this index
+        self.cursor = 0
+
+    def index(self, port: int) -> int | None:
+        offset = 0
+        for start, end in self.ranges:
+            if start <= port <= end:
+                return offset + port - start
+            offset += end - start + 1
+        return None
+
+    def port(self, index: int) -> int:
+        for start, end in self.ranges:
+            if index <= end - start:
+                return start + index
+            index -= end - start + 1
+        raise IndexError(index)
+
+    def is_free(self, port: int) -> bool:
+        """Whether `port` is in the ranges and not in use"""
+        i = self.index(port)
+        return i is not None and not self.bits[i >> 3] & (1 << (i & 7))
+
+    def mark(self, port: int) -> None:
+        i = self.index(port)
+        if i is None or self.bits[i >> 3] & (1 << (i & 7)):
+            return
+        self.bits[i >> 3] |= 1 << (i & 7)
+        self.used += 1
+
+    def clear(self, port: int) -> None:
+        i = self.index(port)
+        if i is None or not self.bits[i >> 3] & (1 << (i & 7)):
+            return
+        self.bits[i >> 3] &= ~(1 << (i & 7))
+        self.used -= 1
+        self.cursor = min(self.cursor, i)
+
+    def first_free(self) -> int | None:
+        """Lowest free port, skipping whole bytes of used ports"""
+        if self.used >= self.size:
+            return None
+        byte = self.cursor >> 3
+        while byte < len(self.bits):
+            if self.bits[byte] != 0xFF:
+                for bit in range(8):
+                    i = (byte << 3) | bit
+                    if i < self.size and not self.bits[byte] & (1 << bit):
+                        self.cursor = i
+                        return self.port(i)
+            byte += 1
+        return None
+
+
+_lock = Lock()
+_bitmap: PortBitmap | None = None
+
+
+def _load() -> PortBitmap:
+    bitmap = PortBitmap(
+        [
+            (TEAM_PORT_RANGE_START, TEAM_PORT_RANGE_END),
+            (TEAM_BACKUP_PORT_RANGE_START, TEAM_BACKUP_PORT_RANGE_END),
+        ]
+    )
+    outside = []
+    with dboperator.get_cursor() as cursor:
+        cursor.execute(queries.ALL_PORTS)
+        for (port,) in cursor.fetchall():
+            if bitmap.index(int(port)) is None:
+                outside.append(int(port))
+            bitmap.mark(int(port))
+    if outside:
+        # Kept by their teams and never handed out again, but they do not count towards the ranges
+        logger.warning(
+            f"{len(outside)} VPN ports in vpn_map are outside of the team and backup port ranges: "
+            + ", ".join(map(str, sorted(outside)[:10]))
+            + (", ..." if len(outside) > 10 else "")
+        )
+    logger.debug(f"Loaded VPN port bitmap, {bitmap.used} of {bitmap.size} ports in use")
+    return bitmap
+
+
+def reserve(teamname: str, preferred: int | None = None) -> int:
+    """The VPN port of the team, reserving one in vpn_map if it has none yet: `preferred` if it is in
+    the port ranges and free, otherwise the first free one"""
+    global _bitmap
+    port = dboperator.get_team_port(teamname)
+    if port != "null":
+        return int(port)
+
+    with _lock:
+        if _bitmap is None:
+            _bitmap = _load()
+        if preferred is not None and not _bitmap.is_free(preferred):
+            logger.warning(
+                f"VPN port {preferred} of team {teamname} is taken or out of range, allocating one"
+            )
+            preferred = None
+        reloaded = False
+        while True:
+            candidate = preferred if preferred is not None else _bitmap.first_free()
+            # Only tried once, it may have been taken by another worker
+            preferred = None
+            if candidate is None:
+                if reloaded:
+                    raise RuntimeError("no free VPN ports left in the team and backup port ranges")
+                _bitmap, reloaded = _load(), True
+                continue
+            _bitmap.mark(candidate)
+            error = dboperator.insert_vpn_port_into_db(teamname, candidate)
+            if error is None:
+                logger.info(f"Reserved VPN port {candidate} for team {teamname}")
+                return candidate
+            if error.startswith("port "):
+                continue  # taken by another worker since the bitmap was loaded
+            _bitmap.clear(candidate)
+            if error.startswith("team already has"):
+                return int(dboperator.get_team_port(teamname))
+            raise ValueError(error)
+
+
+def release(port: int | str) -> None:
+    """Make a port freed by deleting its team available again, call after removing it from vpn_map"""
+    if port == "null":
+        return
+    with _lock:
+        if _bitmap is not None:
+            _bitmap.clear(int(port))
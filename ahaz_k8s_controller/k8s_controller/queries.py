@@ -0,0 +1,130 @@
+# SQL shared by the blocking (dboperator) and the asyncio (adboperator) database layers
+
+CHALLENGES = "SELECT name FROM challenges"
+PODS = "SELECT * FROM pods WHERE name = %s"
+ENV_VARS = "SELECT env_var_name, env_var_value FROM env_vars WHERE k8s_name = %s"
+K8S_NAME_NETWORKS = "SELECT netname FROM net_rules WHERE k8s_name = %s"
+UNIQUE_NETWORKS = "SELECT DISTINCT netname FROM net_rules WHERE name = %s"
+PODS_IN_NETWORK = "SELECT k8s_name FROM net_rules WHERE netname = %s AND name = %s"
+CHALLENGE_FROM_K8S_NAME = "SELECT name FROM pods WHERE k8s_name = %s LIMIT 1"
+
+INSERT_TEAM = "INSERT INTO teams (name) VALUES (%s)"
+INSERT_VPN_PORT = "INSERT INTO vpn_map(teamID, port) SELECT teamID, %s FROM teams WHERE name = %s"
+UPSERT_USER_VPN_CONFIG = (
+    "INSERT INTO vpn_storage(teamID, username, config) "
+    "SELECT teamID, %s, %s FROM teams WHERE name = %s "
+    "ON DUPLICATE KEY UPDATE vpn_storage.version = vpn_storage.version + 1, "
+    "config = %s, cert = NULL, `key` = NULL"
+)
+UPSERT_USER_MATERIAL = (
+    "INSERT INTO vpn_storage(teamID, username, cert, `key`) "
+    "SELECT teamID, %s, %s, %s FROM teams WHERE name = %s "
+    "ON DUPLICATE KEY UPDATE vpn_storage.version = vpn_storage.version + 1, "
+    "config = NULL, cert = %s, `key` = %s"
+)
+UPSERT_TEAM_MATERIAL = (
+    "INSERT INTO vpn_team_material(teamID, options, ca, tls_auth) "
+    "SELECT teamID, %s, %s, %s FROM teams WHERE name = %s "
+    "ON DUPLICATE KEY UPDATE vpn_team_material.version = IF("
+    "options = %s AND ca = %s AND tls_auth = %s, vpn_team_material.version, vpn_team_material.version + 1), "
+    "options = %s, ca = %s, tls_auth = %s"
+)
+
+TEAM_ID = "SELECT teamID FROM teams WHERE name=%s LIMIT 1"
+TEAM_PORT = (
+    "SELECT vpn_map.port FROM vpn_map JOIN teams ON teams.teamID = vpn_map.teamID WHERE teams.name=%s LIMIT 1"
+)
+PORT_TEAM = "SELECT teamID FROM vpn_map WHERE port=%s LIMIT 1"
+USER_VPN_CONFIG_VERSION = (
+    "SELECT vpn_storage.teamID, vpn_storage.id, vpn_storage.version, vpn_team_material.version "
+    "FROM vpn_storage JOIN teams ON teams.teamID = vpn_storage.teamID "
+    "LEFT JOIN vpn_team_material ON vpn_team_material.teamID = vpn_storage.teamID "
+    "WHERE teams.name=%s and vpn_storage.username=%s LIMIT 1"
+)
+USER_VPN_CONFIG = (
+    "SELECT vpn_storage.config, vpn_storage.cert, vpn_storage.`key`, "
+    "vpn_team_material.options, vpn_team_material.ca, vpn_team_material.tls_auth "
+    "FROM vpn_storage LEFT JOIN vpn_team_material ON vpn_team_material.teamID = vpn_storage.teamID "
+    "WHERE vpn_storage.teamID=%s and vpn_storage.username=%s LIMIT 1"
+)
+UNSPLIT_USER_VPN_CONFIGS = "SELECT teamID, username, config FROM vpn_storage WHERE cert IS NULL"
+SPLIT_USER_VPN_CONFIG = (
+    "UPDATE vpn_storage SET version = version + 1, config = NULL, cert = %s, `key` = %s "
+    "WHERE teamID = %s AND username = %s AND cert IS NULL"
+)
+TEAM_MATERIAL = "SELECT options, ca, tls_auth FROM vpn_team_material WHERE teamID = %s"
+INSERT_TEAM_MATERIAL = (
+    "INSERT IGNORE INTO vpn_team_material(teamID, options, ca, tls_auth) VALUES (%s, %s, %s, %s)"
+)
+LAST_PORT = "SELECT port FROM vpn_map ORDER BY port DESC LIMIT 1"
+ALL_PORTS = "SELECT port FROM vpn_map"
+
+DELETE_TEAM_REGISTRATION = "DELETE from registration_state WHERE name = %s"
+DELETE_TEAM = (
+    "DELETE teams, vpn_map, vpn_storage, vpn_team_material FROM teams "
+    "LEFT JOIN vpn_map ON vpn_map.teamID = teams.teamID "
+    "LEFT JOIN vpn_storage ON vpn_storage.teamID = teams.teamID "
+    "LEFT JOIN vpn_team_material ON vpn_team_material.teamID = teams.teamID "
+    "WHERE teams.name = %s"
+)
+DELETE_USER_VPN_CONFIG = (
+    "DELETE vpn_storage FROM vpn_storage JOIN teams ON teams.teamID = vpn_storage.teamID "
+    "WHERE teams.name = %s and vpn_storage.username = %s"
+)
+DELETE_USER_REGISTRATION = "DELETE from registration_state WHERE name = %s and user = %s"
+
+REGISTRATION_PROGRESS_TEAM = "SELECT state FROM registration_state WHERE name=%s and user=''"
+REGISTRATION_PROGRESS_USER = "SELECT state FROM registration_state WHERE name=%s and user=%s"
+INSERT_REGISTRATION_PROGRESS = (
+    "INSERT IGNORE INTO registration_state (name, user, state, updated_at) VALUES (%s, %s, %s, %s)"
+)
+COMPARE_AND_SET_REGISTRATION_PROGRESS = (
+    "UPDATE registration_state SET state = %s, updated_at = %s WHERE name = %s and user = %s and state = %s"
+)
+LOG_REGISTRATION_PROGRESS = (
+    "INSERT INTO register_status (name, user, state, timestamp) VALUES (%s, %s, %s, %s)"
+)
+
+CATALOG_VERSION = "SELECT version FROM catalog_version WHERE id = 1"
+BUMP_CATALOG_VERSION = "UPDATE catalog_version SET version = version + 1 WHERE id = 1"
+CATALOG_CHALLENGES = "SELECT name FROM challenges"
+CATALOG_PODS = "SELECT name, k8s_name, image, ram, cpu, visible_to_user FROM pods ORDER BY name, k8s_name"
+CATALOG_NET_RULES = "SELECT name, netname, k8s_name FROM net_rules ORDER BY name, netname, k8s_name"
+CATALOG_ENV_VARS = "SELECT k8s_name, env_var_name, env_var_value FROM env_vars ORDER BY id"
+
+TASK_CHALLENGE = "SELECT ctfd_desc, ctfd_score, ctfd_type FROM challenges WHERE name = %s"
+TASK_PODS = "SELECT k8s_name, image, ram, cpu, visible_to_user FROM pods WHERE name = %s"
+TASK_NET_RULES = "SELECT netname, k8s_name FROM net_rules WHERE name = %s"
+TASK_ENV_VARS = "SELECT id, k8s_name, env_var_name, env_var_value FROM env_vars WHERE name = %s"
+TASK_NAMES = "SELECT name FROM challenges UNION SELECT name FROM pods"
+UPSERT_CHALLENGE = (
+    "INSERT INTO challenges (name, ctfd_desc, ctfd_score, ctfd_type) VALUES (%s, %s, %s, %s) AS new "
+    "ON DUPLICATE KEY UPDATE ctfd_desc = new.ctfd_desc, ctfd_score = new.ctfd_score, "
+    "ctfd_type = new.ctfd_type"
+)
+UPSERT_POD = (
+    "INSERT INTO pods (name, k8s_name, image, ram, cpu, visible_to_user) VALUES (%s, %s, %s, %s, %s, %s) "
+    "AS new ON DUPLICATE KEY UPDATE image = new.image, ram = new.ram, cpu = new.cpu, "
+    "visible_to_user = new.visible_to_user"
+)
+DELETE_POD = "DELETE FROM pods WHERE name = %s AND k8s_name = %s"
+INSERT_NET_RULE = "INSERT INTO net_rules (name, netname, k8s_name) VALUES (%s, %s, %s)"
+DELETE_NET_RULE = "DELETE FROM net_rules WHERE name = %s AND netname = %s AND k8s_name = %s"
+INSERT_ENV_VAR = "INSERT INTO env_vars (name, k8s_name, env_var_name, env_var_value) VALUES (%s, %s, %s, %s)"
+DELETE_ENV_VAR = "DELETE FROM env_vars WHERE id = %s"
+DELETE_TASK = [
+    "DELETE FROM env_vars WHERE name = %s",
+    "DELETE FROM net_rules WHERE name = %s",
+    "DELETE FROM pods WHERE name = %s",
+    "DELETE FROM challenges WHERE name = %s",
+]
+
+
+def raise_registration_progress(rows: int) -> str:
+    """Upsert of `rows` (name, user, state, updated_at) rows which never lowers a state"""
+    return (
+        "INSERT INTO registration_state (name, user, state, updated_at) VALUES "
+        + ", ".join(["(%s, %s, %s, %s)"] * rows)
+        + " AS new ON DUPLICATE KEY UPDATE "
+        "state = GREATEST(registration_state.state, new.state), updated_at = new.updated_at"
+    )
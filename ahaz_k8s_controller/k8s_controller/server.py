@@ -4,17 +4,27 @@ import logging
 import traceback
 from os import getenv
 from threading import Thread
-from time import sleep
+from time import perf_counter, sleep
+from typing import Awaitable, Callable
 
+import adboperator
+import bulk
+import catalog
 import certmanager
+import certpool
 import controller
 import dboperator
+import migrate
+import pipeline
+import podview
+import ports
 import uvicorn
 from events import RedisEventManager
 from pydantic import ValidationError
 from quart import Quart, make_response, request
 
 from ahaz_common import (
+    BulkRegisterTeamRequest,
     ChallengeRequest,
     RegisterTeamRequest,
     TeamRequest,
@@ -23,12 +33,12 @@ from ahaz_common import (
 
 CERT_DIR_CONTAINER = getenv("CERT_DIR_CONTAINER", "/etc/ahaz/certs/")
 PUBLIC_DOMAINNAME = getenv("PUBLIC_DOMAINNAME", "ahaz.lan")
-TEAM_PORT_RANGE_START = int(getenv("TEAM_PORT_RANGE_START", 31200))
 
 app = Quart(__name__)
 
 REDIS_URL = getenv("REDIS_URL", "redis://localhost:6379")
 redis_event_manager = RedisEventManager(REDIS_URL)
+pod_view = podview.PodView(redis_event_manager)
 
 LOGLEVEL = getenv("LOGLEVEL", "INFO").upper()
 logging.basicConfig(
@@ -43,12 +53,31 @@ logging.getLogger("kubernetes").setLevel(logging.INFO)
 logging.getLogger("mysql").setLevel(logging.INFO)
 
 
+@app.before_serving
+async def migrate_database():
+    if migrate.DB_MIGRATE == "startup":
+        migrate.upgrade()
+
+
+@app.before_serving
+async def resolve_toolchain():
+    if certmanager.PKI_BACKEND == "easyrsa":
+        # Resolve once per worker so registrations never go looking for it
+        certmanager.get_easyrsa()
+
+
+@app.after_serving
+async def close_database_pools():
+    await adboperator.close_pools()
+
+
 @app.route("/ping", methods=["GET"])
 def ping():
     return "pong", 200, {"Content-Type": "text/plain"}
 
 
 @app.route("/start_challenge", methods=["POST", "GET"])
+@adboperator.scoped
 async def start_challenge():
     try:
         request_data = ChallengeRequest(**await request.get_json())
@@ -60,10 +89,11 @@ async def start_challenge():
         f"Received start challenge request for challenge {request_data.challenge_id}"
         + f" from {request_data.team_id}"
     )
-    status = controller.start_challenge(request_data.team_id, request_data.challenge_id)
-    if status == 0:
-        status = "successfully created challenge"
-    return str(status), 200
+    challenge = await catalog.get_challenge_async(request_data.challenge_id)
+    if challenge is None:
+        return f"challenge {request_data.challenge_id} does not exist", 200
+    await asyncio.to_thread(controller.start_challenge, request_data.team_id, challenge)
+    return "successfully created challenge", 200
 
 
 @app.route("/stop_challenge", methods=["POST", "GET"])
@@ -78,17 +108,18 @@ async def stop_challenge():
         f"Received stop challenge request for challenge {request_data.challenge_id}"
         + f" from {request_data.team_id}"
     )
-    status = controller.stop_challenge(request_data.team_id, request_data.challenge_id)
-    return status
+    return await asyncio.to_thread(controller.stop_challenge, request_data.team_id, request_data.challenge_id)
 
 
 @app.route("/get_challenges", methods=["GET"])
-def get_challenges():
-    challenges = dboperator.get_challenges_from_db()
+@adboperator.replica_scoped
+async def get_challenges():
+    challenges = await adboperator.get_challenges_from_db()
     return json.dumps([{"challengename": challenge} for challenge in challenges])
 
 
 @app.route("/get_pods_namespace", methods=["GET"])
+@adboperator.replica_scoped
 async def get_pods_namespace():
     try:
         request_data = TeamRequest(**await request.get_json())
@@ -97,11 +128,22 @@ async def get_pods_namespace():
         return "Invalid request data", 400
 
     logger.info(f"Getting pods for team {request_data.team_id}")
-    podresult = controller.get_pods_namespace(str(request_data.team_id), False)
+    try:
+        pods = await pod_view.get(str(request_data.team_id), False)
+    except Exception as e:
+        logger.error(f"Error reading pod view, listing pods from the API server: {e}")
+        pods = None
+    if pods is not None:
+        podresult = json.dumps(pods)
+    else:
+        # Refresh the catalog here so that summarising the pods in the thread finds their challenges
+        await catalog.get_catalog_async()
+        podresult = await asyncio.to_thread(controller.get_pods_namespace, str(request_data.team_id), False)
     logger.debug(f"Pods for team {request_data.team_id}:\n{podresult}")
     return podresult
 
 
+@dboperator.scoped
 def register_user_threaded(request_data: UserRequest):
     logger.info(f"Registering user {request_data.user_id} to team {request_data.team_id}...")
     logger.debug("About to register user in docker")
@@ -117,6 +159,7 @@ def register_user_threaded(request_data: UserRequest):
 
 
 @app.route("/add_user", methods=["POST"])
+@adboperator.scoped
 async def adduser():
     try:
         request_data = UserRequest(**await request.get_json())
@@ -124,7 +167,9 @@ async def adduser():
         logger.error(f"Validation error: {e}")
         return "Invalid request data", 400
 
-    userExists = dboperator.get_user_vpn_config(teamname=request_data.team_id, username=request_data.user_id)
+    userExists = await adboperator.get_user_vpn_config(
+        teamname=request_data.team_id, username=request_data.user_id
+    )
 
     if userExists != "null":
         return "user already registered"
@@ -133,7 +178,44 @@ async def adduser():
     return "Started user creation as a thread"
 
 
+def revoke_user_threaded(request_data: UserRequest):
+    logger.info(f"Revoking user {request_data.user_id} of team {request_data.team_id}...")
+    try:
+        controller.revoke_user_ovpn(teamname=request_data.team_id, username=request_data.user_id)
+    except Exception as e:
+        logger.error(f"Failed to revoke user {request_data.user_id} of team {request_data.team_id}: {e}")
+        return
+    logger.info(f"Revoked user {request_data.user_id} of team {request_data.team_id}")
+
+
+# TODO: add token
+@app.route("/revoke_user", methods=["POST"])
+@adboperator.scoped
+async def revoke_user():
+    try:
+        request_data = UserRequest(**await request.get_json())
+    except ValidationError as e:
+        logger.error(f"Validation error: {e}")
+        return "Invalid request data", 400
+
+    userExists = await adboperator.get_user_vpn_config(
+        teamname=request_data.team_id, username=request_data.user_id
+    )
+
+    if userExists == "null":
+        return "user not registered"
+
+    try:
+        await asyncio.to_thread(controller.check_team_vpn_crl, request_data.team_id)
+    except RuntimeError as e:
+        return str(e), 409
+
+    Thread(target=revoke_user_threaded, args=(request_data,), daemon=True).start()
+    return f"Started revocation of user {request_data.user_id} as a thread"
+
+
 @app.route("/get_user", methods=["GET"])
+@adboperator.replica_scoped
 async def getuser():
     try:
         request_data = UserRequest(**await request.get_json())
@@ -141,13 +223,18 @@ async def getuser():
         logger.error(f"Validation error: {e}")
         return "Invalid request data", 400
 
-    return dboperator.get_user_vpn_config(teamname=request_data.team_id, username=request_data.user_id)
+    return await adboperator.get_user_vpn_config(teamname=request_data.team_id, username=request_data.user_id)
+
+
+@app.route("/pki_pool", methods=["GET"])
+def pki_pool():
+    return json.dumps(certpool.get_stats(CERT_DIR_CONTAINER))
 
 
 def gen_team_from_flask_for_subprocess(request_data: RegisterTeamRequest) -> str:
     try:
         logger.debug("doing except")
-        certmanager.gen_team(
+        bundle = certmanager.gen_team(
             request_data.team_id,
             request_data.domain_name,
             request_data.port,
@@ -156,12 +243,13 @@ def gen_team_from_flask_for_subprocess(request_data: RegisterTeamRequest) -> str
         )
         controller.create_team_namespace(request_data.team_id)
         logger.debug("=8")
-        controller.create_team_vpn_container(request_data.team_id)
+        controller.create_team_vpn_container(request_data.team_id, bundle)
         logger.debug("about to expose team vpn container")
         controller.expose_team_vpn_container(request_data.team_id, request_data.port)
         logger.debug("=9")
-        dboperator.insert_team_into_db(request_data.team_id)
-        dboperator.insert_vpn_port_into_db(request_data.team_id, request_data.port)
+        with dboperator.connection_scope():
+            dboperator.insert_team_into_db(request_data.team_id)
+            dboperator.insert_vpn_port_into_db(request_data.team_id, request_data.port)
         return "Successfully made a team"
     except Exception as e:
         logger.error(f"Error creating team: {e}")
@@ -181,8 +269,86 @@ async def team_post():
     return "Started team creation as a thread"
 
 
+@app.route("/bulk_gen_team", methods=["POST"])
+async def bulk_gen_team():
+    try:
+        request_data = BulkRegisterTeamRequest(**await request.get_json())
+    except ValidationError as e:
+        logger.error(f"Validation error: {e}")
+        return "Invalid request data", 400
+
+    Thread(
+        target=adboperator.run,
+        args=(bulk.provision(request_data.teams, CERT_DIR_CONTAINER, RedisEventManager(REDIS_URL)),),
+        daemon=True,
+    ).start()
+    logger.info(f"Started bulk provisioning of {len(request_data.teams)} teams")
+    return f"Started bulk provisioning of {len(request_data.teams)} teams"
+
+
+# Registration progress reported once the steps of each stage have finished, in this order
+TEAM_REGISTRATION_STAGES = [
+    (2, ("certificates",)),
+    (3, ("namespace", "image_pull_secret", "default_service_account")),
+    (4, ("vpn_pod",)),
+    (5, ("vpn_service", "network_policies")),
+]
+
+
+async def register_team(teamname: str, report_progress: Callable[[int], Awaitable[None]]) -> None:
+    """Create the database rows, certificates and Kubernetes resources of a team, independent ones at once"""
+
+    def insert_team(results: dict) -> None:
+        try:
+            dboperator.insert_team_into_db(teamname)
+        except ValueError:
+            pass  # left over from an earlier registration of the team
+
+    steps = [
+        pipeline.Step("team", insert_team),
+        pipeline.Step("port", lambda results: ports.reserve(teamname), after=("team",)),
+        pipeline.Step(
+            "certificates",
+            lambda results: certmanager.gen_team(
+                teamname, PUBLIC_DOMAINNAME, results["port"], "tcp", CERT_DIR_CONTAINER
+            ),
+            after=("port",),
+        ),
+        pipeline.Step("namespace", lambda results: controller.create_namespace(teamname)),
+        pipeline.Step(
+            "image_pull_secret",
+            lambda results: controller.copy_image_pull_secret(teamname),
+            after=("namespace",),
+        ),
+        pipeline.Step(
+            "default_service_account",
+            lambda results: controller.disable_default_token_automount(teamname),
+            after=("namespace",),
+        ),
+        pipeline.Step(
+            "network_policies",
+            lambda results: controller.create_team_network_policies(teamname),
+            after=("namespace",),
+        ),
+        pipeline.Step(
+            "vpn_pod",
+            lambda results: controller.create_team_vpn_container(teamname, results["certificates"]),
+            after=("namespace", "certificates"),
+        ),
+        pipeline.Step(
+            "vpn_service",
+            lambda results: controller.create_team_vpn_service(teamname, results["port"]),
+            after=("namespace", "port"),
+        ),
+    ]
+    start = perf_counter()
+    milestones = pipeline.Milestones(TEAM_REGISTRATION_STAGES, report_progress)
+    await pipeline.run_steps(steps, milestones.step_done)
+    logger.info(f"Created the resources of team {teamname} in {perf_counter() - start:.2f}s")
+
+
 # TODO: Reduce complexity here
-async def autogenerate_subprocess(request_data: UserRequest, port=-1) -> str:  # noqa: C901
+async def autogenerate_subprocess(request_data: UserRequest) -> str:  # noqa: C901
     redis_event_mgr = RedisEventManager(REDIS_URL)
 
     # HACK: Function in function is ugly, but need this working for 21.11.2025 :3
@@ -199,47 +365,22 @@ async def autogenerate_subprocess(request_data: UserRequest, port=-1) -> str:  #
             ),
         )
 
-    if port == -1:
-        try:
-            port = (
-                TEAM_PORT_RANGE_START + int(request_data.team_id)  # HACK: GOD PLEASE HAVE GOOD INPUTS ONLY
-            )
-        except Exception as e:
-            logger.error(f"Invalid team_id for port calculation: {request_data.team_id}")
-            logger.error(e)
-            port = TEAM_PORT_RANGE_START
     try:
         if dboperator.get_registration_progress_team(request_data.team_id) == 10:
             return "team is being reregistered"
         logger.debug(dboperator.get_registration_progress_team(request_data.team_id))
-        if (
-            dboperator.get_registration_progress_team(request_data.team_id) == -999
-        ):  # if no team has been registered, register it
+        if dboperator.claim_team_registration(
+            request_data.team_id
+        ):  # if no team has been registered, register it. Only one of the team's users gets to do so
             await set_registration_progress_threaded(request_data.team_id, request_data.user_id, 1)
             logger.debug("started registration proces for a team")
 
-            certmanager.gen_team(request_data.team_id, PUBLIC_DOMAINNAME, port, "tcp", CERT_DIR_CONTAINER)
-            await set_registration_progress_threaded(request_data.team_id, request_data.user_id, 2)
-            logger.debug(f"generated certificates for team {request_data.team_id}")
-
-            controller.create_team_namespace(request_data.team_id)
-            logger.debug(f"created namespace for team {request_data.team_id}")
-
-            await set_registration_progress_threaded(request_data.team_id, request_data.user_id, 3)
-            controller.create_team_vpn_container(request_data.team_id)
-            logger.debug(f"created VPN Container for team {request_data.team_id}")
-
-            await set_registration_progress_threaded(request_data.team_id, request_data.user_id, 4)
-            controller.expose_team_vpn_container(request_data.team_id, port)
-            logger.debug(f"exposed VPN Container for team {request_data.team_id}")
-
-            await set_registration_progress_threaded(request_data.team_id, request_data.user_id, 5)
-            logger.debug("mystical 5th step performed")
-
-            dboperator.insert_team_into_db(request_data.team_id)
-            dboperator.insert_vpn_port_into_db(request_data.team_id, port)
-            logger.debug(f"inserted data into db for team {request_data.team_id}")
-
+            await register_team(
+                request_data.team_id,
+                lambda progress: set_registration_progress_threaded(
+                    request_data.team_id, request_data.user_id, progress
+                ),
+            )
             await set_registration_progress_threaded(request_data.team_id, request_data.user_id, 6)
             logger.info(f"Successfully registered a team {request_data.team_id}")
         elif (
@@ -295,6 +436,7 @@ async def autogenerate_subprocess(request_data: UserRequest, port=-1) -> str:  #
 
 
 @app.route("/autogenerate", methods=["POST", "GET"])
+@adboperator.replica_scoped
 async def autogenerate():
     try:
         request_data = UserRequest(**await request.get_json())
@@ -302,13 +444,15 @@ async def autogenerate():
         logger.error(f"Validation error: {e}")
         return "Invalid request data", 400
 
-    status_user = dboperator.get_registration_progress_user(request_data.team_id, request_data.user_id)
+    status_user = await adboperator.get_registration_progress_user(request_data.team_id, request_data.user_id)
 
-    if status_user == "null":
-        # if progress is null, only then start the thread
-        Thread(target=asyncio.run, args=(autogenerate_subprocess(request_data),), daemon=True).start()
+    if status_user == "null" and await adboperator.compare_and_set_registration_progress(
+        request_data.team_id, request_data.user_id, None, 0
+    ):
+        # if progress is null, only then start the thread, once even if the user polls concurrently
+        Thread(target=adboperator.run, args=(autogenerate_subprocess(request_data),), daemon=True).start()
 
-    status_team = dboperator.get_registration_progress_team(request_data.team_id)
+    status_team = await adboperator.get_registration_progress_team(request_data.team_id)
 
     if str(status_team) == "-999":
         status_team = "1"  # set to 1 because thread has possibly just started
@@ -334,18 +478,16 @@ def del_team_subprocess(request_data: UserRequest | TeamRequest, reregister=Fals
     logger.debug(
         str(request_data.team_id) + " cert Directory deleted, about to remove entries of team from db"
     )
+    port = dboperator.get_team_port(request_data.team_id)
     dboperator.delete_team_and_vpn(request_data.team_id)
+    ports.release(port)
     logger.debug(str(request_data.team_id) + " entries of team removed from db")
 
     if reregister:
         if not isinstance(request_data, UserRequest):
             logger.error("Reregister flag set but request_data is not UserRequest")
             return
-        Thread(
-            target=autogenerate_subprocess,
-            args=(request_data, TEAM_PORT_RANGE_START + int(request_data.team_id.replace("a", ""))),
-            daemon=True,
-        ).start()
+        Thread(target=adboperator.run, args=(autogenerate_subprocess(request_data),), daemon=True).start()
 
 
 # TODO: add token
@@ -429,8 +571,12 @@ async def events():
 if __name__ == "__main__":
     Thread(
         # This is an async function, but we are in a thread, so we need to run it in an event loop
-        target=asyncio.run,
-        args=(controller.k8s_watcher(redis_event_manager),),
+        target=adboperator.run,
+        args=(controller.k8s_watcher(redis_event_manager, pod_view),),
         daemon=True,
     ).start()
+    if certpool.enabled() and certmanager.PKI_BACKEND != "easyrsa":
+        Thread(
+            target=certpool.refill_worker, args=(CERT_DIR_CONTAINER, PUBLIC_DOMAINNAME), daemon=True
+        ).start()
     uvicorn.run("server:app", host="0.0.0.0", port=5000, workers=4)
@@ -0,0 +1,216 @@
+import argparse
+import logging
+import sys
+from dataclasses import dataclass, field
+from os import getenv, path, walk
+
+import catalog
+import dboperator
+import queries
+import yaml
+from pydantic import ValidationError
+
+from ahaz_common import Task
+
+# Import of task.yaml challenge definitions into the challenge tables.
+#
+# Every task is compared with what the database holds for it and only the
+# differing rows are written, batched with executemany in one transaction per
+# task. The catalog version is bumped once at the end if anything changed.
+
+logger = logging.getLogger()
+
+TASK_FILENAMES = ("task.yaml", "task.yml")
+# Prefixed to the image names of imported tasks, e.g. registry.example.com/ctf
+TASK_IMAGE_REGISTRY = getenv("TASK_IMAGE_REGISTRY", "")
+
+
+@dataclass
+class TaskRows:
+    """The rows of the challenge tables describing one task"""
+
+    challenge: tuple | None = None
+    # k8s_name -> (image, ram, cpu, visible_to_user)
+    pods: dict[str, tuple] = field(default_factory=dict)
+    # (netname, k8s_name)
+    net_rules: set[tuple[str, str]] = field(default_factory=set)
+    # (k8s_name, env_var_name, env_var_value), with their ids when read from the database
+    env_vars: dict[tuple[str, str, str], list[int]] = field(default_factory=dict)
+
+
+@dataclass
+class TaskChanges:
+    name: str
+    statements: list[tuple[str, list[tuple]]] = field(default_factory=list)
+
+    def add(self, statement: str, rows: list[tuple]) -> None:
+        if rows:
+            self.statements.append((statement, rows))
+
+    @property
+    def rows(self) -> int:
+        return sum(len(rows) for _, rows in self.statements)
+
+
+def find_tasks(directory: str) -> list[str]:
+    found = []
+    for root, dirs, files in walk(directory):
+        dirs.sort()
+        for filename in TASK_FILENAMES:
+            if filename in files:
+                found.append(path.join(root, filename))
+                break
+    return found
+
+
+def load_task(filename: str) -> Task:
+    with open(filename, "r", encoding="utf-8") as f:
+        return Task(**yaml.safe_load(f))
+
+
+def image_reference(task: Task, image_name: str, registry: str) -> str:
+    reference = f"{image_name}:{task.version}"
+    return f"{registry.rstrip('/')}/{reference}" if registry else reference
+
+
+def desired_rows(task: Task, registry: str) -> TaskRows:
+    rows = TaskRows(challenge=(task.description, task.score, task.scoring_type))
+    for pod in task.pods:
+        rows.pods[pod.name] = (
+            image_reference(task, pod.image.image_name, registry),
+            pod.limits_ram,
+            pod.limits_cpu,
+            pod.visible_to_user,
+        )
+    rows.net_rules = {(network.name, device) for network in task.networks for device in network.devices}
+    for env_var in task.env_vars or []:
+        rows.env_vars.setdefault((env_var.pod_name, env_var.name, env_var.value), []).append(0)
+    return rows
+
+
+def current_rows(cursor, name: str) -> TaskRows:
+    rows = TaskRows()
+    cursor.execute(queries.TASK_CHALLENGE, (name,))
+    challenge = cursor.fetchall()
+    if challenge:
+        rows.challenge = tuple(challenge[0])
+    cursor.execute(queries.TASK_PODS, (name,))
+    for k8s_name, image, ram, cpu, visible_to_user in cursor.fetchall():
+        rows.pods[k8s_name] = (image, ram, cpu, bool(visible_to_user))
+    cursor.execute(queries.TASK_NET_RULES, (name,))
+    rows.net_rules = {(netname, k8s_name) for netname, k8s_name in cursor.fetchall()}
+    cursor.execute(queries.TASK_ENV_VARS, (name,))
+    for env_id, k8s_name, env_var_name, env_var_value in cursor.fetchall():
+        rows.env_vars.setdefault((k8s_name, env_var_name, env_var_value), []).append(env_id)
+    return rows
+
+
+def diff(name: str, current: TaskRows, desired: TaskRows) -> TaskChanges:
+    changes = TaskChanges(name)
+    if current.challenge != desired.challenge:
+        changes.add(queries.UPSERT_CHALLENGE, [(name, *desired.challenge)])  # type: ignore
+    changes.add(
+        queries.DELETE_POD, [(name, k8s_name) for k8s_name in current.pods.keys() - desired.pods.keys()]
+    )
+    changes.add(
+        queries.UPSERT_POD,
+        [
+            (name, k8s_name, *pod)
+            for k8s_name, pod in desired.pods.items()
+            if current.pods.get(k8s_name) != pod
+        ],
+    )
+    changes.add(
+        queries.DELETE_NET_RULE, [(name, *rule) for rule in sorted(current.net_rules - desired.net_rules)]
+    )
+    changes.add(
+        queries.INSERT_NET_RULE, [(name, *rule) for rule in sorted(desired.net_rules - current.net_rules)]
+    )
+
+    removed_env_vars, added_env_vars = [], []
+    for env_var in current.env_vars.keys() | desired.env_vars.keys():
+        ids, wanted = current.env_vars.get(env_var, []), len(desired.env_vars.get(env_var, []))
+        removed_env_vars.extend((env_id,) for env_id in ids[wanted:])
+        added_env_vars.extend([(name, *env_var)] * (wanted - len(ids)))
+    changes.add(queries.DELETE_ENV_VAR, sorted(removed_env_vars))
+    changes.add(queries.INSERT_ENV_VAR, added_env_vars)
+    return changes
+
+
+def import_task(task: Task, registry: str, dry_run: bool = False) -> TaskChanges:
+    with dboperator.transaction() as cursor:
+        changes = diff(task.name, current_rows(cursor, task.name), desired_rows(task, registry))
+        if not dry_run:
+            for statement, rows in changes.statements:
+                cursor.executemany(statement, rows)
+    return changes
+
+
+def remove_task(name: str, dry_run: bool = False) -> None:
+    if dry_run:
+        return
+    with dboperator.transaction() as cursor:
+        for statement in queries.DELETE_TASK:
+            cursor.execute(statement, (name,))
+
+
+def import_directory(
+    directory: str, registry: str = TASK_IMAGE_REGISTRY, prune: bool = False, dry_run: bool = False
+) -> tuple[list[TaskChanges], list[str], list[str]]:
+    """Import every task.yaml below `directory`, returns the changed tasks, removed tasks and failed files"""
+    changed: list[TaskChanges] = []
+    removed: list[str] = []
+    failed: list[str] = []
+    imported: set[str] = set()
+    with dboperator.connection_scope():
+        for filename in find_tasks(directory):
+            try:
+                task = load_task(filename)
+            except (OSError, yaml.YAMLError, ValidationError, TypeError) as e:
+                logger.error(f"Could not load task {filename}: {e}")
+                failed.append(filename)
+                continue
+            if task.name in imported:
+                logger.error(f"Task {task.name} in {filename} was already imported from another file")
+                failed.append(filename)
+                continue
+            imported.add(task.name)
+
+            changes = import_task(task, registry, dry_run)
+            if changes.statements:
+                logger.info(f"Task {task.name}: {changes.rows} rows changed")
+                changed.append(changes)
+
+        if prune and not failed:
+            with dboperator.get_cursor() as cursor:
+                cursor.execute(queries.TASK_NAMES)
+                removed = sorted({str(row[0]) for row in cursor.fetchall()} - imported)
+            for name in removed:
+                logger.info(f"Task {name}: removed")
+                remove_task(name, dry_run)
+
+        if (changed or removed) and not dry_run:
+            catalog.bump_version()
+    return changed, removed, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import the task.yaml files of a directory into the database"
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--registry", default=TASK_IMAGE_REGISTRY, help="prefix of the task images")
+    parser.add_argument("--prune", action="store_true", help="remove tasks which are not in the directory")
+    parser.add_argument("--dry-run", action="store_true", help="only show what would change")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getenv("LOGLEVEL", "INFO").upper())
+    changed, removed, failed = import_directory(args.directory, args.registry, args.prune, args.dry_run)
+    suffix = " (dry run)" if args.dry_run else ""
+    for changes in changed:
+        print(f"{changes.name}: {changes.rows} rows changed{suffix}")
+    for name in removed:
+        print(f"{name}: removed{suffix}")
+    if failed:
+        print(f"{len(failed)} task files failed to import: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,155 @@
+import argparse
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from os import getenv
+from threading import Lock
+
+# Client VPN configs are stored split into the part shared by the whole team
+# (the options up to the inline blocks, the CA and the tls-auth key, kept in
+# vpn_team_material) and the user's own certificate and key (vpn_storage).
+# The config is put together again on read, with the controller's client
+# options (routes, compression) applied at that point, so changing those
+# does not require rewriting any rows.
+
+K8S_IP_RANGE = getenv("K8S_IP_RANGE", "10.42.0.0 255.255.0.0")
+# Number of rendered configs kept in memory per worker
+VPN_RENDER_CACHE_SIZE = int(getenv("VPN_RENDER_CACHE_SIZE", "4096"))
+
+BLOCK_PATTERN = re.compile(r"<(key|cert|ca|tls-auth)>\n(.*?)\n</\1>", re.DOTALL)
+CLIENT_OPTIONS_SUFFIX = "\ncomp-lzo yes\nallow-compression yes"
+
+
+@dataclass(frozen=True)
+class TeamMaterial:
+    options: str
+    ca: str
+    tls_auth: str
+
+
+@dataclass(frozen=True)
+class UserMaterial:
+    cert: str
+    key: str
+
+
+# Mmmmm, cider...
+def cidr_to_netmask(cidr: int) -> str:
+    mask = (0xFFFFFFFF >> (32 - cidr)) << (32 - cidr)
+    return f"{(mask >> 24) & 0xFF}.{(mask >> 16) & 0xFF}.{(mask >> 8) & 0xFF}.{mask & 0xFF}"
+
+
+def ip_and_cidr_to_netmask(ip_cidr: str) -> str:
+    ip, cidr = ip_cidr.split("/")
+    cidr = int(cidr)
+    netmask = cidr_to_netmask(cidr)
+    return ip + " " + netmask
+
+
+def parse_ip_range(ip_range: str) -> str:
+    if ip_range.count("/") == 1:
+        return ip_and_cidr_to_netmask(ip_range)
+    elif ip_range.count(" ") == 1:
+        return ip_range
+    else:
+        raise ValueError("Invalid IP range format")
+
+
+def route_options() -> str:
+    return "route-nopull\nroute " + parse_ip_range(K8S_IP_RANGE) + "\n\n"
+
+
+def apply_client_options(config: str) -> str:
+    config = config.replace("<key>", route_options() + "<key>")  # add IP route to the config
+    config = config.replace("redirect-gateway def1", "")  # remove the rule that replaces all routes with VPN
+    return config + CLIENT_OPTIONS_SUFFIX
+
+
+def join(team: TeamMaterial, user: UserMaterial) -> str:
+    """The config as certmanager.get_client_ovpn_config renders it"""
+    return "\n".join(
+        [
+            team.options,
+            "\n<key>",
+            user.key,
+            "</key>",
+            "<cert>",
+            user.cert,
+            "</cert>",
+            "<ca>",
+            team.ca,
+            "</ca>",
+            "key-direction 1",
+            "<tls-auth>",
+            team.tls_auth,
+            "</tls-auth>",
+        ]
+    )
+
+
+def split(config: str) -> tuple[TeamMaterial, UserMaterial] | None:
+    """Split a config rendered by certmanager into team and user material, None if it has another layout"""
+    options, separator, _ = config.partition("\n\n<key>")
+    if not separator:
+        return None
+    blocks = dict(BLOCK_PATTERN.findall(config))
+    if blocks.keys() != {"key", "cert", "ca", "tls-auth"}:
+        return None
+    team = TeamMaterial(options=options, ca=blocks["ca"], tls_auth=blocks["tls-auth"])
+    user = UserMaterial(cert=blocks["cert"], key=blocks["key"])
+    if join(team, user) != config:
+        return None
+    return team, user
+
+
+def unapply_client_options(config: str) -> str | None:
+    """The config before apply_client_options, None if the options are not found"""
+    routes = route_options()
+    if routes + "<key>" not in config or not config.endswith(CLIENT_OPTIONS_SUFFIX):
+        return None
+    return config[: -len(CLIENT_OPTIONS_SUFFIX)].replace(routes + "<key>", "<key>")
+
+
+def render(team: TeamMaterial, user: UserMaterial) -> str:
+    return apply_client_options(join(team, user))
+
+
+def from_row(row: tuple) -> str:
+    """The client config of a (config, cert, key, options, ca, tls_auth) row"""
+    config, cert, key, options, ca, tls_auth = row
+    if cert is None or key is None or options is None:
+        return config
+    return render(TeamMaterial(options=options, ca=ca, tls_auth=tls_auth), UserMaterial(cert=cert, key=key))
+
+
+# (teamID, vpn_storage id, user material version, team material version) -> rendered config
+_cache: OrderedDict[tuple, str] = OrderedDict()
+_cache_lock = Lock()
+
+
+def cached(key: tuple) -> str | None:
+    with _cache_lock:
+        config = _cache.get(key)
+        if config is not None:
+            _cache.move_to_end(key)
+        return config
+
+
+def remember(key: tuple, config: str) -> None:
+    with _cache_lock:
+        _cache[key] = config
+        if len(_cache) > VPN_RENDER_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the stored client VPN configs")
+    parser.add_argument(
+        "command", choices=("split",), help="split configs stored whole into team and user material"
+    )
+    args = parser.parse_args()
+
+    import dboperator
+
+    done, skipped = dboperator.split_user_vpn_configs()
+    print(f"{done} configs split, {skipped} left whole")